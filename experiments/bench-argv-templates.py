@@ -0,0 +1,68 @@
+# Compares expanding {param} placeholders in an argv with the original per-token regex loop
+# against the pre-parsed ArgvTemplate, as the number of parameter rows grows.
+#
+#   python experiments/bench-argv-templates.py --counts 10000,100000,1000000
+import argparse
+import re
+import time
+
+from sparklespray.spec import rewrite_argv_with_parameters
+
+ARGV = [
+    "python3",
+    "^model.py",
+    "--alpha",
+    "{alpha}",
+    "--seed={seed}",
+    "--out=results/{alpha}/{seed}.csv",
+    "--verbose",
+]
+
+
+def regex_rewrite_argv_with_parameters(argv, parameters):
+    "The implementation which ArgvTemplate replaced"
+    l = []
+    for task_params in parameters:
+
+        def expand_parameters(x):
+            while True:
+                m = re.match("(.*){([^}]+)}(.*)", x)
+                if m == None:
+                    return x
+                else:
+                    x = m.group(1) + task_params[m.group(2)] + m.group(3)
+
+        l.append([expand_parameters(x) for x in argv])
+    return l
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", default="10000,100000,1000000")
+    args = parser.parse_args()
+
+    print(
+        "{:>10} {:>12} {:>12} {:>8}".format(
+            "rows", "regex (s)", "template (s)", "speedup"
+        )
+    )
+    for count in [int(x) for x in args.counts.split(",")]:
+        parameters = [
+            {"alpha": str(i / 10), "seed": str(i), "extra": "x"} for i in range(count)
+        ]
+        start = time.time()
+        expected = regex_rewrite_argv_with_parameters(ARGV, parameters)
+        regex_elapsed = time.time() - start
+        start = time.time()
+        result = rewrite_argv_with_parameters(ARGV, parameters)
+        template_elapsed = time.time() - start
+        assert result == expected
+        print(
+            "{:>10} {:>12.2f} {:>12.2f} {:>7.1f}x".format(
+                count, regex_elapsed, template_elapsed, regex_elapsed / template_elapsed
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+# Compares uploading a large file whole against chunking it (see sparklespray/chunking.py) and
+# uploading only the chunks which aren't already in CAS, over a simulated link of --mb-per-sec.
+# Objects are written to a local directory, with each upload delayed as if it had been sent over
+# the link, while compose is treated as free since it happens server-side.
+#
+# Each method uploads a first version of the file, then a second version with a small edit in
+# the middle, which is the case chunking is meant for.
+#
+#   python experiments/bench-chunked-upload.py --size-mb 1000 --mb-per-sec 50
+import argparse
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from sparklespray.chunking import ContentDefinedChunker
+from sparklespray.io import IO, LocalStorage
+
+
+class ThrottledStorage(LocalStorage):
+    "LocalStorage which takes as long to write an object as sending it over a link would"
+
+    def __init__(self, bytes_per_sec):
+        self.bytes_per_sec = bytes_per_sec
+        # the link is shared between concurrent uploads
+        self.lock = threading.Lock()
+        self.bytes_sent = 0
+
+    def _send(self, size):
+        with self.lock:
+            self.bytes_sent += size
+            time.sleep(size / self.bytes_per_sec)
+
+    def put(self, src_filename, url):
+        self._send(os.path.getsize(src_filename))
+        super().put(src_filename, url)
+
+    def put_str(self, content, url, content_encoding=None):
+        self._send(len(content))
+        super().put_str(content, url, content_encoding=content_encoding)
+
+    def compose(self, src_urls, dst_url):
+        # GCS composes objects without reading them, so don't spend time copying them here
+        super().put_str(b"", dst_url)
+
+
+def make_versions(dirname, size):
+    first = os.path.join(dirname, "v1")
+    with open(first, "wb") as fd:
+        for _ in range(0, size, 1024 * 1024):
+            fd.write(os.urandom(1024 * 1024))
+    second = os.path.join(dirname, "v2")
+    shutil.copyfile(first, second)
+    with open(second, "r+b") as fd:
+        fd.seek(size // 2)
+        fd.write(b"edited")
+    return first, second
+
+
+def run(method, filenames, bytes_per_sec, cas_dir):
+    io = IO("project", "file://" + cas_dir)
+    storage = ThrottledStorage(bytes_per_sec)
+    io.storage_by_scheme["file"] = storage
+    if method == "chunked":
+        io.chunked_upload_threshold = 0
+        io.chunker = ContentDefinedChunker()
+    times = []
+    for i, filename in enumerate(filenames):
+        start = time.time()
+        io.put(filename, "file://{}/file{}".format(cas_dir, i))
+        times.append(time.time() - start)
+    io.close()
+    return times, storage.bytes_sent
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=1000)
+    parser.add_argument("--mb-per-sec", type=float, default=50)
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        filenames = make_versions(tmp_dir, args.size_mb * 1024 * 1024)
+
+        start = time.time()
+        chunks = ContentDefinedChunker().chunks(filenames[0])
+        chunk_secs = time.time() - start
+        print(
+            "chunking alone: {:.1f} MB/s, {} chunks".format(
+                args.size_mb / chunk_secs, len(chunks)
+            )
+        )
+
+        print(
+            "{:>8} {:>12} {:>12} {:>10}".format(
+                "method", "v1 seconds", "v2 seconds", "MB sent"
+            )
+        )
+        for method in ["whole", "chunked"]:
+            cas_dir = os.path.join(tmp_dir, method)
+            (v1, v2), sent = run(
+                method, filenames, args.mb_per_sec * 1024 * 1024, cas_dir
+            )
+            print(
+                "{:>8} {:>12.1f} {:>12.1f} {:>10.0f}".format(
+                    method, v1, v2, sent / 1024 / 1024
+                )
+            )
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
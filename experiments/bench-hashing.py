@@ -0,0 +1,59 @@
+# Measures how fast CachingHashFunction.prefetch hashes a tree of uncached files as the number of
+# worker threads grows. Each run starts from an empty hash cache, and the files are read once
+# beforehand so that they're served from the page cache.
+#
+#   python experiments/bench-hashing.py --files 64 --size-mb 32 --workers 1,2,4,8
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from sparklespray.hasher import CachingHashFunction
+
+
+def make_files(dirname, count, size):
+    block = os.urandom(1024 * 1024)
+    filenames = []
+    for i in range(count):
+        filename = os.path.join(dirname, "file{}".format(i))
+        with open(filename, "wb") as fd:
+            for _ in range(size // len(block)):
+                fd.write(block)
+            fd.write(block[: size % len(block)])
+        filenames.append(filename)
+    return filenames
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=64)
+    parser.add_argument("--size-mb", type=int, default=32)
+    parser.add_argument("--workers", default="1,2,4,8")
+    args = parser.parse_args()
+
+    dirname = tempfile.mkdtemp()
+    try:
+        size = args.size_mb * 1024 * 1024
+        filenames = make_files(dirname, args.files, size)
+        total_gb = args.files * size / 1e9
+        print(
+            "{} CPUs, {} files, {:.2f} GB".format(os.cpu_count(), args.files, total_gb)
+        )
+        print("{:>8} {:>10} {:>8}".format("workers", "seconds", "GB/s"))
+        for workers in [int(x) for x in args.workers.split(",")]:
+            db_path = os.path.join(dirname, "cache-{}".format(workers))
+            hash_db = CachingHashFunction(db_path)
+            start = time.time()
+            hash_db.prefetch(filenames, max_workers=workers)
+            elapsed = time.time() - start
+            hash_db.persist()
+            print(
+                "{:>8} {:>10.2f} {:>8.2f}".format(workers, elapsed, total_gb / elapsed)
+            )
+    finally:
+        shutil.rmtree(dirname)
+
+
+if __name__ == "__main__":
+    main()
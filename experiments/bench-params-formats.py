@@ -0,0 +1,86 @@
+# Times reading a --params file and expanding the command for every row, for the same rows stored
+# as csv, JSONL and (when pyarrow is installed) Parquet.
+#
+#   python experiments/bench-params-formats.py --rows 1000000
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from sparklespray.csv_utils import iter_csv_as_dicts
+from sparklespray.params import read_parameter_batches, pyarrow
+from sparklespray.spec import ArgvTemplate, TASK_BATCH_SIZE, _batches
+
+ARGV = [
+    "python3",
+    "model.py",
+    "--seed",
+    "{seed}",
+    "--alpha",
+    "{alpha}",
+    "out-{seed}.csv",
+]
+
+
+def write_files(dirname, rows):
+    seeds = list(range(rows))
+    alphas = [i * 0.001 for i in seeds]
+    filenames = {}
+
+    filenames["csv"] = os.path.join(dirname, "params.csv")
+    with open(filenames["csv"], "wt") as fd:
+        fd.write("seed,alpha\n")
+        for seed, alpha in zip(seeds, alphas):
+            fd.write("{},{}\n".format(seed, alpha))
+
+    filenames["jsonl"] = os.path.join(dirname, "params.jsonl")
+    with open(filenames["jsonl"], "wt") as fd:
+        for seed, alpha in zip(seeds, alphas):
+            fd.write(json.dumps(dict(seed=seed, alpha=alpha)) + "\n")
+
+    if pyarrow is not None:
+        filenames["parquet"] = os.path.join(dirname, "params.parquet")
+        pyarrow.parquet.write_table(
+            pyarrow.table(dict(seed=seeds, alpha=alphas)), filenames["parquet"]
+        )
+    return filenames
+
+
+def expand_csv(template, filename):
+    count = 0
+    for batch in _batches(iter_csv_as_dicts(filename), TASK_BATCH_SIZE):
+        count += len(template.expand_all(batch, first_row=count))
+    return count
+
+
+def expand_batches(template, filename):
+    count = 0
+    for batch in read_parameter_batches(filename, TASK_BATCH_SIZE):
+        count += len(template.expand_columns(batch.columns, len(batch), count))
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=1000000)
+    args = parser.parse_args()
+
+    template = ArgvTemplate(ARGV)
+    with tempfile.TemporaryDirectory() as dirname:
+        filenames = write_files(dirname, args.rows)
+        print("{:>8} {:>9} {:>9}".format("format", "MB", "seconds"))
+        for name, filename in filenames.items():
+            expand = expand_csv if name == "csv" else expand_batches
+            start = time.time()
+            assert expand(template, filename) == args.rows
+            elapsed = time.time() - start
+            print(
+                "{:>8} {:>9.1f} {:>9.2f}".format(
+                    name, os.path.getsize(filename) / 1e6, elapsed
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# Compares the peak memory used to turn a large --params csv into serialized task specs when the
+# whole spec is built up front against when tasks are streamed from the csv as they're written.
+#
+#   python experiments/bench-streaming-spec.py --rows 100000
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+from sparklespray.csv_utils import iter_csv_as_dicts, read_csv_as_dicts
+from sparklespray.spec import make_spec_from_command
+from sparklespray.submit import iter_expanded_tasks
+from sparklespray.upload import _to_json
+
+
+class FakeIO:
+    def write_json_to_cas(self, obj):
+        return "gs://bucket/CAS/common"
+
+
+def write_params(filename, rows):
+    with open(filename, "wt") as fd:
+        fd.write("seed,alpha,output\n")
+        for i in range(rows):
+            fd.write("{},{},out-{}.csv\n".format(i, i * 0.001, i))
+
+
+def serialize_tasks(params_filename, stream):
+    if stream:
+        parameters = iter_csv_as_dicts(params_filename)
+    else:
+        parameters = read_csv_as_dicts(params_filename)
+    _, spec = make_spec_from_command(
+        ["python3", "model.py", "--seed", "{seed}", "--alpha", "{alpha}", "{output}"],
+        docker_image="image",
+        dest_url="gs://bucket/job",
+        cas_url="gs://bucket/CAS",
+        parameters=parameters,
+        stream_tasks=stream,
+    )
+    count = 0
+    for task in iter_expanded_tasks(spec, FakeIO(), "gs://bucket", "gs://bucket/job"):
+        _to_json(task)
+        count += 1
+    return count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as dirname:
+        params_filename = os.path.join(dirname, "params.csv")
+        write_params(params_filename, args.rows)
+        print(
+            "{:>8} {:>10} {:>9} {:>10}".format("rows", "method", "seconds", "peak MB")
+        )
+        for name, stream in [("up front", False), ("streamed", True)]:
+            tracemalloc.start()
+            start = time.time()
+            count = serialize_tasks(params_filename, stream)
+            elapsed = time.time() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            assert count == args.rows
+            print(
+                "{:>8} {:>10} {:>9.2f} {:>10.1f}".format(
+                    args.rows, name, elapsed, peak / 1e6
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
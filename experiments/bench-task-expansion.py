@@ -0,0 +1,152 @@
+# Compares expanding and serializing task specs with the original deepcopy based expansion
+# against expand_tasks' TaskSpec overlays. Reports the time taken, the peak memory allocated
+# while expanding and serializing, and the number of memory blocks still held by the expanded
+# tasks afterwards.
+#
+#   python experiments/bench-task-expansion.py --counts 10000,100000
+import argparse
+import copy
+import os
+import sys
+import time
+import tracemalloc
+
+from sparklespray.submit import expand_tasks, rewrite_url_with_prefix
+from sparklespray.upload import _to_json
+
+
+class FakeIO:
+    def write_json_to_cas(self, obj):
+        return "gs://bucket/CAS/common"
+
+
+def make_spec(count):
+    return {
+        "common": {
+            "working_dir": ".",
+            "command_result_url": "result.json",
+            "stdout_url": "stdout.txt",
+            "pre-exec-script": "ls -al",
+            "post-exec-script": "ls -al",
+        },
+        "tasks": [
+            {
+                "downloads": [
+                    {
+                        "src_url": "gs://bucket/CAS/{:064x}".format(i),
+                        "dst": "file{}".format(i),
+                        "executable": False,
+                        "is_cas_key": True,
+                        "symlink_safe": False,
+                    }
+                    for i in range(20)
+                ],
+                "command": "python3 model.py --seed {}".format(task_i),
+                "uploads": {
+                    "include_patterns": ["**"],
+                    "exclude_patterns": [],
+                    "dst_url": "gs://bucket/job/{}".format(task_i + 1),
+                },
+                "parameters": {"seed": str(task_i)},
+            }
+            for task_i in range(count)
+        ],
+    }
+
+
+def deepcopy_expand_tasks(spec, default_url_prefix, default_job_url_prefix):
+    "The implementation which TaskSpec overlays replaced"
+
+    def rewrite_downloads(downloads):
+        result = []
+        for url in downloads:
+            d = dict(
+                src_url=url["src_url"],
+                dst=os.path.normpath(url["dst"]),
+                executable=url.get("executable", False),
+                is_cas_key=url.get("is_cas_key", False),
+                symlink_safe=url.get("symlink_safe", False),
+            )
+            d = dict(d)
+            d["src_url"] = rewrite_url_with_prefix(d["src_url"], default_url_prefix)
+            result.append(d)
+        return result
+
+    common = spec["common"]
+    common["downloads"] = rewrite_downloads(common.get("downloads", []))
+    tasks = []
+    for task_i, spec_task in enumerate(spec["tasks"]):
+        task_url_prefix = "{}/{}".format(default_job_url_prefix, task_i + 1)
+        task = copy.deepcopy(common)
+        for attr in ["helper_log", "command", "uploads"]:
+            if attr in spec_task:
+                task[attr] = spec_task[attr]
+        task["downloads"].extend(spec_task.get("downloads", []))
+        task["downloads"] = rewrite_downloads(task["downloads"])
+        task["stdout_url"] = rewrite_url_with_prefix(
+            task["stdout_url"], task_url_prefix
+        )
+        task["command_result_url"] = rewrite_url_with_prefix(
+            task["command_result_url"], task_url_prefix
+        )
+        task["parameters"] = spec_task["parameters"]
+        tasks.append(task)
+    return tasks
+
+
+def expand_and_serialize(expand, spec):
+    tasks = expand(spec)
+    for task in tasks:
+        _to_json(task)
+    return tasks
+
+
+def measure(expand, count):
+    start = time.time()
+    expand_and_serialize(expand, make_spec(count))
+    elapsed = time.time() - start
+
+    # tracemalloc slows everything down, so allocations are measured in a separate run
+    spec = make_spec(count)
+    blocks_before = sys.getallocatedblocks()
+    tracemalloc.start()
+    tasks = expand_and_serialize(expand, spec)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    retained_blocks = sys.getallocatedblocks() - blocks_before
+    del tasks
+    return elapsed, peak, retained_blocks
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", default="10000,100000")
+    args = parser.parse_args()
+
+    implementations = [
+        (
+            "deepcopy",
+            lambda spec: deepcopy_expand_tasks(spec, "gs://bucket", "gs://bucket/job"),
+        ),
+        (
+            "overlay",
+            lambda spec: expand_tasks(spec, FakeIO(), "gs://bucket", "gs://bucket/job"),
+        ),
+    ]
+    print(
+        "{:>8} {:>10} {:>9} {:>10} {:>15}".format(
+            "tasks", "method", "seconds", "peak MB", "retained blocks"
+        )
+    )
+    for count in [int(x) for x in args.counts.split(",")]:
+        for name, expand in implementations:
+            elapsed, peak, retained_blocks = measure(expand, count)
+            print(
+                "{:>8} {:>10} {:>9.2f} {:>10.1f} {:>15}".format(
+                    count, name, elapsed, peak / 1e6, retained_blocks
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+# Measures how many task specs per second submit() can write to CAS as the number of tasks grows.
+# Uses an in-memory store which sleeps for --latency seconds per request, plus the time to send the
+# body at --bandwidth MB/s, to approximate GCS round trips. Also reports the bytes stored with
+# and without gzip compression of the specs.
+#
+#   python experiments/bench-task-specs.py --counts 100,1000,10000 --latency 0.02
+import argparse
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from sparklespray.upload import parallel_write_json_to_cas
+from sparklespray.util import url_join
+
+
+class SlowMemoryStore:
+    def __init__(self, latency, bytes_per_sec=None):
+        self.latency = latency
+        self.bytes_per_sec = bytes_per_sec
+        self.objects = {}
+        self.lock = threading.Lock()
+
+    def exists(self, url):
+        time.sleep(self.latency)
+        with self.lock:
+            return url in self.objects
+
+    def put_str(self, text, url, content_encoding=None):
+        delay = self.latency
+        if self.bytes_per_sec:
+            delay += len(text) / self.bytes_per_sec
+        time.sleep(delay)
+        with self.lock:
+            self.objects[url] = text
+
+    def stored_bytes(self):
+        with self.lock:
+            return sum(len(text) for text in self.objects.values())
+
+
+def make_tasks(count):
+    return [
+        {
+            "downloads": [
+                {
+                    "src_url": "gs://bucket/CAS/{:064x}".format(i),
+                    "dst": "file{}".format(i),
+                }
+                for i in range(20)
+            ],
+            "command": "python3 model.py --alpha {} --seed {}".format(
+                task_i / 10, task_i
+            ),
+            "uploads": {
+                "include_patterns": ["**"],
+                "exclude_patterns": [],
+                "dst_url": "gs://bucket/job/{}".format(task_i + 1),
+            },
+            "stdout_url": "gs://bucket/job/{}/stdout.txt".format(task_i + 1),
+            "command_result_url": "gs://bucket/job/{}/result.json".format(task_i + 1),
+            "parameters": {"alpha": str(task_i / 10), "seed": str(task_i)},
+        }
+        for task_i in range(count)
+    ]
+
+
+def serial_write(tasks, store):
+    # equivalent of the original loop over io.write_json_to_cas()
+    urls = []
+    for task in tasks:
+        text = json.dumps(task).encode("utf8")
+        url = url_join("gs://bucket/CAS", hashlib.sha256(text).hexdigest())
+        store.put_str(text, url)
+        urls.append(url)
+    return urls
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--counts", default="100,1000,10000")
+    parser.add_argument("--latency", type=float, default=0.02)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument(
+        "--bandwidth", type=float, default=10, help="Simulated upload MB/s per request"
+    )
+    parser.add_argument(
+        "--serial-limit",
+        type=int,
+        default=1000,
+        help="Skip timing the serial loop for task counts above this",
+    )
+    args = parser.parse_args()
+
+    executor = ThreadPoolExecutor(max_workers=args.workers)
+    bytes_per_sec = args.bandwidth * 1024 * 1024
+    print(
+        "tasks\tserial tasks/sec\tparallel tasks/sec\tresubmit tasks/sec\tgzip tasks/sec\tJSON bytes\tgzip bytes"
+    )
+    for count in [int(x) for x in args.counts.split(",")]:
+        tasks = make_tasks(count)
+
+        serial_rate = "-"
+        if count <= args.serial_limit:
+            start = time.time()
+            serial_write(tasks, SlowMemoryStore(args.latency, bytes_per_sec))
+            serial_rate = "{:.0f}".format(count / (time.time() - start))
+
+        store = SlowMemoryStore(args.latency, bytes_per_sec)
+        start = time.time()
+        parallel_write_json_to_cas(tasks, "gs://bucket/CAS", store, executor)
+        parallel_rate = count / (time.time() - start)
+
+        # second submission of the same specs only needs the existence checks
+        start = time.time()
+        parallel_write_json_to_cas(tasks, "gs://bucket/CAS", store, executor)
+        resubmit_rate = count / (time.time() - start)
+
+        gzip_store = SlowMemoryStore(args.latency, bytes_per_sec)
+        start = time.time()
+        parallel_write_json_to_cas(
+            tasks, "gs://bucket/CAS", gzip_store, executor, compression="gzip"
+        )
+        gzip_rate = count / (time.time() - start)
+
+        print(
+            "{}\t{}\t{:.0f}\t{:.0f}\t{:.0f}\t{}\t{}".format(
+                count,
+                serial_rate,
+                parallel_rate,
+                resubmit_rate,
+                gzip_rate,
+                store.stored_bytes(),
+                gzip_store.stored_bytes(),
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
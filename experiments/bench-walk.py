@@ -0,0 +1,76 @@
+# Compares listing a pushed tree the way manifests used to (os.listdir, then os.path.isdir,
+# os.stat and os.access for every entry) against walk.scan_tree. The gap is much larger on network
+# filesystems, where every syscall is a round trip; point --dir at such a tree to measure that.
+#
+#   python experiments/bench-walk.py --dirs 200 --files-per-dir 100 --workers 1,4,16
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from sparklespray.walk import scan_tree
+
+
+def make_tree(root, dir_count, files_per_dir):
+    for i in range(dir_count):
+        dirname = os.path.join(root, "d{}".format(i // 20), "d{}".format(i))
+        os.makedirs(dirname)
+        for j in range(files_per_dir):
+            with open(os.path.join(dirname, "f{}".format(j)), "wt") as fd:
+                fd.write(str(j))
+
+
+def listdir_walk(dirname, listings):
+    files = {}
+    dirs = []
+    for name in os.listdir(dirname):
+        path = os.path.join(dirname, name)
+        if os.path.isdir(path):
+            dirs.append(name)
+            listdir_walk(path, listings)
+        else:
+            st = os.stat(path)
+            files[name] = (st.st_size, st.st_mtime_ns, os.access(path, os.X_OK))
+    listings[dirname] = (files, dirs)
+    return listings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--dir", help="An existing tree to walk instead of a generated one"
+    )
+    parser.add_argument("--dirs", type=int, default=200)
+    parser.add_argument("--files-per-dir", type=int, default=100)
+    parser.add_argument("--workers", default="1,4,16")
+    args = parser.parse_args()
+
+    tmp_dir = None
+    root = args.dir
+    if root is None:
+        tmp_dir = tempfile.mkdtemp()
+        root = os.path.join(tmp_dir, "tree")
+        make_tree(root, args.dirs, args.files_per_dir)
+    try:
+        print("{:>20} {:>9} {:>8}".format("method", "seconds", "dirs"))
+        start = time.time()
+        count = len(listdir_walk(root, {}))
+        print(
+            "{:>20} {:>9.3f} {:>8}".format("listdir+stat", time.time() - start, count)
+        )
+        for workers in [int(x) for x in args.workers.split(",")]:
+            start = time.time()
+            count = len(scan_tree(root, max_workers=workers))
+            print(
+                "{:>20} {:>9.3f} {:>8}".format(
+                    "scan_tree({})".format(workers), time.time() - start, count
+                )
+            )
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
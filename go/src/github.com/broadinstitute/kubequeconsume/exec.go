@@ -11,6 +11,7 @@ import (
 	"path"
 	"path/filepath"
 	"strings"
+	"sync"
 	"syscall"
 	"time"
 
@@ -24,6 +25,11 @@ type TaskDownload struct {
 	SymlinkSafe bool   `json:"symlink_safe"`
 	Dst         string `json:"dst"`
 	SrcURL      string `json:"src_url"`
+	// If set, the content of SrcURL is the PackLength bytes at PackOffset within the pack
+	// object PackURL, which holds many small files bundled together at submit time
+	PackURL    string `json:"pack_url,omitempty"`
+	PackOffset int64  `json:"pack_offset,omitempty"`
+	PackLength int64  `json:"pack_length,omitempty"`
 }
 
 type UploadSpec struct {
@@ -44,8 +50,17 @@ type TaskSpec struct {
 	Command            string            `json:"command"`
 	CommandResultURL   string            `json:"command_result_url"`
 	StdoutURL          string            `json:"stdout_url"`
+	// If set, a JSON list of downloads shared by every task in the job, which are done before
+	// this task's own Downloads
+	CommonDownloadsURL string `json:"common_downloads_url,omitempty"`
+	// Raised whenever a field is added which a consumer can't safely ignore. Specs without it
+	// are version 1.
+	SpecVersion int `json:"spec_version,omitempty"`
 }
 
+// The newest TaskSpec version this consumer understands. Version 2 added CommonDownloadsURL.
+const supportedSpecVersion = 2
+
 type ResultFile struct {
 	Src    string `json:"src"`
 	DstURL string `json:"dst_url"`
@@ -97,6 +112,46 @@ func copyFile(src, dst string) error {
 	return out.Close()
 }
 
+// Copies the member described by dl out of its pack to dest, first downloading the pack into
+// cacheDir if it isn't already there. Packs are cached like any other CAS object, so each is only
+// downloaded once no matter how many of its members are needed.
+func extractFromPack(ioc IOClient, dl *TaskDownload, cacheDir string, dest string) error {
+	packPath := path.Join(cacheDir, path.Base(dl.PackURL))
+	if _, err := os.Stat(packPath); os.IsNotExist(err) {
+		err = ioc.Download(dl.PackURL, packPath)
+		if err != nil {
+			return err
+		}
+	}
+
+	in, err := os.Open(packPath)
+	if err != nil {
+		return err
+	}
+	defer in.Close()
+
+	// write to a temp file and rename so an interrupted copy never leaves a truncated file in the cache
+	out, err := ioutil.TempFile(cacheDir, "extracting")
+	if err != nil {
+		return err
+	}
+	tmpPath := out.Name()
+
+	_, err = io.Copy(out, io.NewSectionReader(in, dl.PackOffset, dl.PackLength))
+	if err == nil {
+		err = out.Close()
+	} else {
+		out.Close()
+	}
+	if err != nil {
+		os.Remove(tmpPath)
+		return fmt.Errorf("Could not extract %s from %s: %s", dl.SrcURL, dl.PackURL, err)
+	}
+
+	log.Printf("Extracted %s from %s", dl.SrcURL, dl.PackURL)
+	return os.Rename(tmpPath, dest)
+}
+
 func downloadAll(ioc IOClient, workdir string, downloads []*TaskDownload, cacheDir string) (error, stringset) {
 	if !path.IsAbs(workdir) {
 		panic("bad workdir")
@@ -120,7 +175,11 @@ func downloadAll(ioc IOClient, workdir string, downloads []*TaskDownload, cacheD
 			cacheDest := path.Join(cacheDir, casKey)
 
 			if _, err := os.Stat(cacheDest); os.IsNotExist(err) {
-				err = ioc.Download(srcURL, cacheDest)
+				if dl.PackURL != "" {
+					err = extractFromPack(ioc, dl, cacheDir, cacheDest)
+				} else {
+					err = ioc.Download(srcURL, cacheDest)
+				}
 				if err != nil {
 					return err, downloaded
 				}
@@ -569,9 +628,53 @@ func loadTaskSpec(ioc IOClient, taskURL string) (*TaskSpec, error) {
 		return nil, err
 	}
 
+	if taskSpec.SpecVersion > supportedSpecVersion {
+		return nil, fmt.Errorf("Task spec is version %d but this consumer only supports up to version %d", taskSpec.SpecVersion, supportedSpecVersion)
+	}
+
+	if taskSpec.CommonDownloadsURL != "" {
+		commonDownloads, err := loadCommonDownloads(ioc, taskSpec.CommonDownloadsURL)
+		if err != nil {
+			return nil, err
+		}
+		downloads := make([]*TaskDownload, 0, len(commonDownloads)+len(taskSpec.Downloads))
+		downloads = append(downloads, commonDownloads...)
+		taskSpec.Downloads = append(downloads, taskSpec.Downloads...)
+	}
+
 	return &taskSpec, nil
 }
 
+// Only the most recently loaded list is kept. Every task of a job shares the same list, so it's
+// only fetched once per job, without holding on to the lists of earlier jobs.
+var lastCommonDownloadsURL string
+var lastCommonDownloads []*TaskDownload
+var commonDownloadsCacheLock sync.Mutex
+
+func loadCommonDownloads(ioc IOClient, url string) ([]*TaskDownload, error) {
+	commonDownloadsCacheLock.Lock()
+	defer commonDownloadsCacheLock.Unlock()
+
+	if url == lastCommonDownloadsURL {
+		return lastCommonDownloads, nil
+	}
+
+	data, err := ioc.DownloadAsBytes(url)
+	if err != nil {
+		return nil, err
+	}
+
+	var downloads []*TaskDownload
+	err = json.Unmarshal(data, &downloads)
+	if err != nil {
+		return nil, err
+	}
+
+	lastCommonDownloadsURL = url
+	lastCommonDownloads = downloads
+	return downloads, nil
+}
+
 func ExecuteTaskFromUrl(ioc IOClient, taskId string, taskURL string, cacheDir string, tasksDir string, monitor *Monitor) (string, error) {
 	taskSpec, err := loadTaskSpec(ioc, taskURL)
 	if err != nil {
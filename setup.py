@@ -30,6 +30,11 @@ setup(
         "google-api-python-client==1.7.4",
         "pyOpenSSL==18.0.0",
     ],
+    extras_require={
+        "asyncio": ["aiohttp>=3.6"],
+        "arrow": ["pyarrow"],
+        "chunking": ["numpy"],
+    },
     packages=find_packages(),
     entry_points={
         "console_scripts": [
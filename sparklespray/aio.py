@@ -0,0 +1,330 @@
+"""An asyncio based engine for issuing large numbers of GCS object requests from a single
+thread. Requests go straight to the GCS JSON API over one shared aiohttp session, with a
+semaphore capping how many are in flight. It's only used when io_engine=asyncio is set in the
+config, which needs aiohttp ("pip install sparklespray[asyncio]"); otherwise IO uses its
+thread pool."""
+
+import asyncio
+import os
+import re
+import itertools
+import threading
+from concurrent.futures import wait, FIRST_COMPLETED
+from urllib.parse import quote
+
+from .io import _verify_checksum, ChecksumMismatch, DEFAULT_ASYNC_CONCURRENCY
+from .upload import TRANSIENT_STATUS_CODES
+from .log import log
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+GCS_ENDPOINT = "https://storage.googleapis.com"
+
+
+def is_available():
+    return aiohttp is not None
+
+
+class AsyncGCSError(Exception):
+    def __init__(self, url, code, message):
+        super().__init__("{} failed with HTTP status {}: {}".format(url, code, message))
+        # named to match google.api_core exceptions so is_transient_error() understands it
+        self.code = code
+
+
+def _parse_url(url):
+    m = re.match("^gs://([^/]+)/(.*)$", url)
+    assert m != None, "invalid remote path: {}".format(url)
+    return m.group(1), m.group(2)
+
+
+class AsyncGCS:
+    """Must be used as an async context manager, from within the event loop that will make the
+    requests. Each method may be awaited concurrently with any of the others."""
+
+    def __init__(
+        self,
+        credentials,
+        max_concurrency=DEFAULT_ASYNC_CONCURRENCY,
+        parallel_download_threshold=None,
+        parallel_download_parts=8,
+        endpoint=GCS_ENDPOINT,
+        max_attempts=5,
+        retry_delay=0.5,
+    ):
+        assert aiohttp is not None, "aiohttp must be installed to use AsyncGCS"
+        self.credentials = credentials
+        self.max_concurrency = max_concurrency
+        self.parallel_download_threshold = parallel_download_threshold
+        self.parallel_download_parts = parallel_download_parts
+        self.endpoint = endpoint
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_concurrency)
+        )
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.refresh_lock = asyncio.Lock()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.session.close()
+        self.session = None
+
+    async def _auth_headers(self):
+        headers = {}
+        async with self.refresh_lock:
+            if not self.credentials.valid:
+                # refreshing is a blocking http call, so keep it off the event loop
+                import google.auth.transport.requests
+
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(
+                    None,
+                    self.credentials.refresh,
+                    google.auth.transport.requests.Request(),
+                )
+        self.credentials.apply(headers)
+        return headers
+
+    async def _request(self, method, url, path, handle_response, headers={}, **kwargs):
+        """Issue the request, retrying transient failures, and return the result of awaiting
+        handle_response(response). 404s are passed to handle_response, as is 416 when the
+        request has a Range header. Any other error status raises AsyncGCSError."""
+        attempt = 1
+        while True:
+            request_headers = await self._auth_headers()
+            request_headers.update(headers)
+            try:
+                async with self.semaphore:
+                    async with self.session.request(
+                        method, self.endpoint + path, headers=request_headers, **kwargs
+                    ) as response:
+                        if response.status < 400 or response.status == 404:
+                            return await handle_response(response)
+                        if response.status == 416 and "Range" in headers:
+                            return await handle_response(response)
+                        raise AsyncGCSError(url, response.status, await response.text())
+            except (AsyncGCSError, aiohttp.ClientConnectionError) as ex:
+                transient = not isinstance(ex, AsyncGCSError) or (
+                    ex.code in TRANSIENT_STATUS_CODES
+                )
+                if attempt >= self.max_attempts or not transient:
+                    raise
+                delay = self.retry_delay * (2 ** (attempt - 1))
+                log.warning("%s failed (%s), retrying in %.1f seconds", url, ex, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    def _object_path(self, url, media=False):
+        bucket, name = _parse_url(url)
+        path = "/storage/v1/b/{}/o/{}".format(quote(bucket), quote(name, safe=""))
+        if media:
+            return "/download" + path + "?alt=media"
+        return path
+
+    async def exists(self, url):
+        async def handle(response):
+            return response.status != 404
+
+        return await self._request(
+            "GET", url, self._object_path(url), handle, params={"fields": "name"}
+        )
+
+    async def read(self, url, start=None):
+        "Returns the bytes of the object from start onwards, None if it's missing or b'' if there's nothing past start"
+
+        async def handle(response):
+            if response.status == 404:
+                return None
+            if response.status == 416:
+                return b""
+            return await response.read()
+
+        headers = {}
+        if start is not None:
+            headers["Range"] = "bytes={}-".format(start)
+        return await self._request(
+            "GET", url, self._object_path(url, media=True), handle, headers=headers
+        )
+
+    async def get(self, url, dst_filename):
+        """Download the object to dst_filename, returning False if it does not exist. Objects larger
+        than parallel_download_threshold have the remainder fetched as concurrent byte ranges.
+        """
+        threshold = self.parallel_download_threshold
+        headers = {}
+        if threshold is not None:
+            headers["Range"] = "bytes=0-{}".format(threshold - 1)
+
+        async def handle(response):
+            if response.status == 404:
+                return None
+            size = None
+            if response.status == 206:
+                size = int(response.headers["Content-Range"].split("/")[1])
+            with open(dst_filename, "wb") as fd:
+                if response.status != 416:
+                    async for chunk in response.content.iter_chunked(1024 * 1024):
+                        fd.write(chunk)
+            return (
+                size,
+                response.headers.get("x-goog-hash"),
+                response.headers.get("x-goog-generation"),
+            )
+
+        result = await self._request(
+            "GET", url, self._object_path(url, media=True), handle, headers=headers
+        )
+        if result is None:
+            if os.path.exists(dst_filename):
+                os.unlink(dst_filename)
+            return False
+
+        size, goog_hash, generation = result
+        if size is not None and size > threshold:
+            await self._get_remainder_in_parts(
+                url, dst_filename, threshold, size, generation
+            )
+            hashes = dict(
+                h.split("=", 1) for h in (goog_hash or "").split(",") if "=" in h
+            )
+            # reading back a large file to checksum it would stall every other request
+            await asyncio.get_running_loop().run_in_executor(
+                None,
+                _verify_checksum,
+                dst_filename,
+                url,
+                hashes.get("crc32c"),
+                hashes.get("md5"),
+            )
+        return True
+
+    async def _get_remainder_in_parts(
+        self, url, dst_filename, offset, size, generation
+    ):
+        part_size = -(-(size - offset) // self.parallel_download_parts)
+        ranges = [
+            (start, min(start + part_size, size) - 1)
+            for start in range(offset, size, part_size)
+        ]
+
+        # pin the generation so every part comes from the same version of the object. If it's
+        # been replaced since the first part was read, the request fails rather than mixing
+        # the two versions.
+        params = {}
+        if generation is not None:
+            params["generation"] = generation
+
+        async def download_range(start, end):
+            async def handle(response):
+                if response.status != 206:
+                    raise ChecksumMismatch("{} changed during download".format(url))
+                position = start
+                async for chunk in response.content.iter_chunked(1024 * 1024):
+                    os.pwrite(fd, chunk, position)
+                    position += len(chunk)
+
+            await self._request(
+                "GET",
+                url,
+                self._object_path(url, media=True),
+                handle,
+                headers={"Range": "bytes={}-{}".format(start, end)},
+                params=params,
+            )
+
+        fd = os.open(dst_filename, os.O_WRONLY)
+        try:
+            os.ftruncate(fd, size)
+            await asyncio.gather(*[download_range(start, end) for start, end in ranges])
+        finally:
+            os.close(fd)
+
+    async def put_str(self, content, url):
+        if isinstance(content, str):
+            content = content.encode("utf8")
+        bucket, name = _parse_url(url)
+
+        async def handle(response):
+            await response.read()
+
+        await self._request(
+            "POST",
+            url,
+            "/upload/storage/v1/b/{}/o".format(quote(bucket)),
+            handle,
+            params={"uploadType": "media", "name": name},
+            headers={"Content-Type": "application/octet-stream"},
+            data=content,
+        )
+
+
+class AsyncEngineThread:
+    """Runs an event loop in a background thread, with one AsyncGCS opened on it which every
+    bulk operation shares, so its connections and access token are reused from one operation to
+    the next. close() must be called to close the session and stop the thread."""
+
+    def __init__(self, make_engine):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+            target=self.loop.run_forever, name="sparkles-aio", daemon=True
+        )
+        self.thread.start()
+
+        async def open_engine():
+            return await make_engine().__aenter__()
+
+        try:
+            self.engine = self._run(open_engine())
+        except BaseException:
+            self._stop()
+            raise
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def _stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.run_until_complete(self.loop.shutdown_default_executor())
+        self.loop.close()
+
+    def close(self):
+        try:
+            self._run(self.engine.__aexit__(None, None, None))
+        finally:
+            self._stop()
+
+    def iter_results(self, func, items, max_in_flight):
+        """Run func(engine, item) for each of items on the loop, yielding (item, result) pairs in
+        the order they complete. At most max_in_flight calls are outstanding, and only those
+        calls' futures are held. items is iterated on the calling thread, so producing an item
+        (which may mean hashing a file) never holds up requests already running on the loop.
+        """
+
+        async def call(item):
+            return item, await func(self.engine, item)
+
+        def submit(item):
+            return asyncio.run_coroutine_threadsafe(call(item), self.loop)
+
+        items = iter(items)
+        pending = set(submit(item) for item in itertools.islice(items, max_in_flight))
+        try:
+            while len(pending) > 0:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                # top up before handing results back so calls continue while the caller works
+                for item in itertools.islice(items, len(done)):
+                    pending.add(submit(item))
+                for future in done:
+                    yield future.result()
+        finally:
+            # if the caller stopped early, let the outstanding calls wind down
+            wait(pending)
@@ -0,0 +1,75 @@
+import os
+import sqlite3
+import threading
+import time
+
+from .log import log
+
+DEFAULT_CAS_INDEX_PATH = "~/.sparkles-cache/known-cas-keys.db"
+# entries older than this are checked against the bucket again, in case the object was removed
+# by a lifecycle rule or a cleanup. Uploaded objects are only read by workers, so the client
+# would otherwise never find out that they're gone.
+DEFAULT_MAX_AGE_DAYS = 7
+
+
+class KnownCASKeys:
+    """A persistent record of CAS urls which we've previously seen exist in (or uploaded to) GCS,
+    stored in a sqlite db so that concurrent submissions can add to it without losing each
+    other's keys. CAS keys are content hashes, so an object which is known to exist only needs
+    checking again once its entry is older than max_age_days, or if it's found to be missing
+    (in which case discard() drops it). The db is only opened the first time it's used.
+    """
+
+    def __init__(self, filename, max_age_days=DEFAULT_MAX_AGE_DAYS):
+        self.filename = filename
+        self.max_age = max_age_days * 24 * 60 * 60
+        self.lock = threading.Lock()
+        self.db = None
+
+    def _get_db(self):
+        # must be called with self.lock held
+        if self.db is None:
+            parent = os.path.dirname(self.filename)
+            if parent != "" and not os.path.exists(parent):
+                os.makedirs(parent, exist_ok=True)
+            # each change is committed straight away, so that concurrent submissions never
+            # wait on each other for long. It's only a cache, so commits needn't be synced.
+            self.db = sqlite3.connect(
+                self.filename, timeout=60, check_same_thread=False, isolation_level=None
+            )
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("PRAGMA synchronous=NORMAL")
+            self.db.execute(
+                "CREATE TABLE IF NOT EXISTS cas_keys (url TEXT PRIMARY KEY, verified_at REAL)"
+            )
+        return self.db
+
+    def __contains__(self, url):
+        with self.lock:
+            row = (
+                self._get_db()
+                .execute("SELECT verified_at FROM cas_keys WHERE url = ?", (url,))
+                .fetchone()
+            )
+        return row is not None and time.time() - row[0] < self.max_age
+
+    def add(self, url):
+        "Records that url exists as of now"
+        with self.lock:
+            self._get_db().execute(
+                "INSERT OR REPLACE INTO cas_keys VALUES (?, ?)", (url, time.time())
+            )
+
+    def discard(self, url):
+        with self.lock:
+            cursor = self._get_db().execute(
+                "DELETE FROM cas_keys WHERE url = ?", (url,)
+            )
+            if cursor.rowcount > 0:
+                log.warning("%s was expected to be in CAS but is missing", url)
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
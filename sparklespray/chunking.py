@@ -0,0 +1,116 @@
+"""Content-defined chunking, used to upload large files to CAS as chunks which are shared between
+versions of the file. Chunk boundaries are placed where a hash of the preceding _WINDOW bytes
+matches a mask, so they depend only on nearby content: editing part of a file only changes the
+chunks around the edit, and the rest keep the same hashes as before.
+
+The hash of a window is the sum of a pseudo-random value per byte, which numpy computes for a
+whole block of the file at once with a cumulative sum, rather than a byte at a time in Python.
+numpy is optional ("pip install sparklespray[chunking]"), and without it files are uploaded
+whole."""
+
+import hashlib
+import mmap
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+DEFAULT_CHUNK_MIN_SIZE = 1024 * 1024
+DEFAULT_CHUNK_AVG_SIZE = 4 * 1024 * 1024
+DEFAULT_CHUNK_MAX_SIZE = 16 * 1024 * 1024
+
+_WINDOW = 64
+# a fixed table of pseudo-random values, so that boundaries are the same on every machine
+_TABLE = [
+    int.from_bytes(hashlib.sha256(bytes([i])).digest()[:4], "big") for i in range(256)
+]
+# how much of the file to hash at once. Small blocks keep the temporary arrays in the CPU cache.
+_BLOCK_SIZE = 256 * 1024
+
+
+def is_available():
+    return numpy is not None
+
+
+class ContentDefinedChunker:
+    def __init__(
+        self,
+        min_size=DEFAULT_CHUNK_MIN_SIZE,
+        avg_size=DEFAULT_CHUNK_AVG_SIZE,
+        max_size=DEFAULT_CHUNK_MAX_SIZE,
+    ):
+        assert _WINDOW < min_size <= avg_size <= max_size
+        self.min_size = min_size
+        self.max_size = max_size
+        # a boundary occurs where the top bits of the 32 bit hash are all zero, which happens
+        # on average once every 2**bits bytes after the minimum size
+        bits = min(max((avg_size - min_size).bit_length() - 1, 1), 31)
+        self.mask = ((1 << bits) - 1) << (32 - bits)
+
+    def _iter_boundaries(self, data, size):
+        """Yields, in increasing order, every offset in data at which a chunk may end, being
+        those where the hash of the _WINDOW bytes before the offset matches the mask"""
+        table = numpy.array(_TABLE, dtype=numpy.uint32)
+        # the mask covers the top bits, so it matches wherever the hash is below this
+        limit = numpy.uint32((~self.mask & 0xFFFFFFFF) + 1)
+        values = numpy.empty(_BLOCK_SIZE + _WINDOW, dtype=numpy.uint32)
+        sums = numpy.empty(_BLOCK_SIZE + _WINDOW, dtype=numpy.uint32)
+        hashes = numpy.empty(_BLOCK_SIZE, dtype=numpy.uint32)
+        matches = numpy.empty(_BLOCK_SIZE, dtype=bool)
+        for start in range(0, size, _BLOCK_SIZE):
+            # start early enough to hash the windows which end in this block
+            lo = max(start - _WINDOW, 0)
+            n = min(start + _BLOCK_SIZE, size) - lo
+            if n <= _WINDOW:
+                continue
+            block = numpy.frombuffer(data, dtype=numpy.uint8, count=n, offset=lo)
+            numpy.take(table, block, out=values[:n])
+            # don't hold on to the mapping between yields, so that it can be closed
+            del block
+            # the sums wrap around, which leaves the difference of two of them intact
+            numpy.cumsum(values[:n], out=sums[:n])
+            # the hash of the window ending at each offset from lo + _WINDOW + 1 onwards
+            numpy.subtract(
+                sums[_WINDOW:n], sums[: n - _WINDOW], out=hashes[: n - _WINDOW]
+            )
+            numpy.less(hashes[: n - _WINDOW], limit, out=matches[: n - _WINDOW])
+            for i in numpy.flatnonzero(matches[: n - _WINDOW]):
+                yield lo + _WINDOW + 1 + int(i)
+
+    def iter_chunks(self, filename):
+        """Yields (offset, length, sha256 hexdigest) for each chunk of filename, as each is found,
+        so that the chunks found so far can be uploaded while the rest of the file is read
+        """
+        assert numpy is not None, "numpy must be installed to split files into chunks"
+        size = os.path.getsize(filename)
+        if size == 0:
+            return
+        with open(filename, "rb") as fd:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                boundaries = self._iter_boundaries(data, size)
+                try:
+                    with memoryview(data) as view:
+                        boundary = next(boundaries, None)
+                        start = 0
+                        while start < size:
+                            end = min(start + self.max_size, size)
+                            while (
+                                boundary is not None
+                                and boundary < start + self.min_size
+                            ):
+                                boundary = next(boundaries, None)
+                            cut = end
+                            if boundary is not None and boundary < end:
+                                cut = boundary
+                            with view[start:cut] as chunk:
+                                sha256 = hashlib.sha256(chunk).hexdigest()
+                            yield start, cut - start, sha256
+                            start = cut
+                finally:
+                    boundaries.close()
+
+    def chunks(self, filename):
+        "Returns a list of (offset, length, sha256 hexdigest) for each chunk of filename"
+        return list(self.iter_chunks(filename))
@@ -0,0 +1,26 @@
+import gzip
+
+# the values accepted for the "compression" config parameter
+COMPRESSION_METHODS = ["none", "gzip"]
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def compress(data, method):
+    """Returns (data, content_encoding) with data compressed by method. The content encoding is
+    stored on the object so that GCS transparently decompresses it for clients (like the worker)
+    which don't ask for the compressed bytes."""
+    if method is None or method == "none":
+        return data, None
+    assert method == "gzip", "unknown compression method: {}".format(method)
+    # a fixed mtime keeps the output deterministic so identical specs produce identical objects
+    return gzip.compress(data, mtime=0), "gzip"
+
+
+def decompress_if_needed(data):
+    """Returns data, decompressed if it is gzip compressed. JSON (or any UTF-8 text) can never
+    start with the gzip magic number, so it's safe to apply to JSON written by compress(), but
+    not to arbitrary objects which might legitimately be gzip files."""
+    if data is not None and data[:2] == GZIP_MAGIC:
+        return gzip.decompress(data)
+    return data
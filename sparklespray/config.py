@@ -3,7 +3,16 @@ import os
 import sys
 
 
-from .io import IO
+from . import aio
+from .compression import COMPRESSION_METHODS
+from .io import (
+    IO,
+    DEFAULT_CONCURRENCY,
+    DEFAULT_PARALLEL_DOWNLOAD_THRESHOLD,
+    DEFAULT_PARALLEL_DOWNLOAD_PARTS,
+    DEFAULT_PARALLEL_UPLOAD_THRESHOLD,
+    DEFAULT_PARALLEL_UPLOAD_PARTS,
+)
 from configparser import RawConfigParser, NoSectionError, NoOptionError
 from .cluster_service import Cluster
 from .node_req_store import AddNodeReqStore
@@ -20,6 +29,11 @@ SCOPES = [
     "https://www.googleapis.com/auth/cloud-platform",
 ]
 
+# the worker built alongside this version, which is used unless kubequeconsume_exe_path is set
+BUNDLED_KUBEQUECONSUME_EXE_PATH = os.path.join(
+    os.path.dirname(__file__), "bin/kubequeconsume"
+)
+
 
 def _safe_get(config, section, key, default=None):
     try:
@@ -107,9 +121,7 @@ def load_only_config_dict(
         sys.exit(1)
 
     if "kubequeconsume_exe_path" not in merged_config:
-        merged_config["kubequeconsume_exe_path"] = os.path.join(
-            os.path.dirname(__file__), "bin/kubequeconsume"
-        )
+        merged_config["kubequeconsume_exe_path"] = BUNDLED_KUBEQUECONSUME_EXE_PATH
         assert os.path.exists(merged_config["kubequeconsume_exe_path"])
 
     if "cas_url_prefix" not in merged_config:
@@ -134,10 +146,10 @@ def load_config(config_file):
     if not os.path.exists(service_account_key):
         raise Exception("Could not find service account key at %s", service_account_key)
 
-    merged_config[
-        "credentials"
-    ] = service_account.Credentials.from_service_account_file(
-        service_account_key, scopes=SCOPES
+    merged_config["credentials"] = (
+        service_account.Credentials.from_service_account_file(
+            service_account_key, scopes=SCOPES
+        )
     )
 
     jq, io, cluster = load_config_from_dict(merged_config)
@@ -166,6 +178,18 @@ def load_config_from_dict(config):
             "gpu_type",
             "mount",
             "sparkles_config_path",
+            "io_concurrency",
+            "parallel_download_threshold",
+            "parallel_download_parts",
+            "parallel_upload_threshold",
+            "parallel_upload_parts",
+            "cas_index_path",
+            "cas_index_max_age_days",
+            "io_engine",
+            "async_io_concurrency",
+            "compression",
+            "chunked_upload_threshold",
+            "hash_daemon_socket",
         ]
     )
     unknown_parameters = set(config.keys()).difference(allowed_parameters)
@@ -177,7 +201,46 @@ def load_config_from_dict(config):
 
     credentials = config["credentials"]
     project_id = config["project"]
-    io = IO(project_id, config["cas_url_prefix"], credentials)
+    # the asyncio engine for bulk operations is opt-in
+    io_engine = config.get("io_engine", "threads")
+    assert io_engine in ["asyncio", "threads"], "io_engine must be asyncio or threads"
+    assert (
+        io_engine == "threads" or aio.is_available()
+    ), "io_engine=asyncio requires aiohttp (pip install sparklespray[asyncio])"
+    compression = config.get("compression", "none")
+    assert compression in COMPRESSION_METHODS, "compression must be one of: {}".format(
+        ", ".join(COMPRESSION_METHODS)
+    )
+    io = IO(
+        project_id,
+        config["cas_url_prefix"],
+        credentials,
+        concurrency=int(config.get("io_concurrency", DEFAULT_CONCURRENCY)),
+        parallel_download_threshold=int(
+            config.get(
+                "parallel_download_threshold", DEFAULT_PARALLEL_DOWNLOAD_THRESHOLD
+            )
+        ),
+        parallel_download_parts=int(
+            config.get("parallel_download_parts", DEFAULT_PARALLEL_DOWNLOAD_PARTS)
+        ),
+        parallel_upload_threshold=int(
+            config.get("parallel_upload_threshold", DEFAULT_PARALLEL_UPLOAD_THRESHOLD)
+        ),
+        parallel_upload_parts=int(
+            config.get("parallel_upload_parts", DEFAULT_PARALLEL_UPLOAD_PARTS)
+        ),
+        use_asyncio=io_engine == "asyncio",
+        async_concurrency=int(
+            config.get("async_io_concurrency", aio.DEFAULT_ASYNC_CONCURRENCY)
+        ),
+        compression=compression,
+        chunked_upload_threshold=(
+            int(config["chunked_upload_threshold"])
+            if "chunked_upload_threshold" in config
+            else None
+        ),
+    )
 
     client = datastore.Client(project_id, credentials=credentials)
     job_store = JobStore(client)
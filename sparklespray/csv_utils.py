@@ -25,7 +25,8 @@ import codecs
 #         return list(csv.DictReader(fd))
 
 
-def read_csv_as_dicts(filename):
+def iter_csv_as_dicts(filename):
+    "Yields each row of the csv as a dict, reading the file as the rows are consumed"
     # Check for BOM in case csv was written by excel
     with open(filename, "rb") as fd:
         possible_bom = fd.read(len(codecs.BOM_UTF8))
@@ -35,4 +36,8 @@ def read_csv_as_dicts(filename):
             encoding = "ascii"
 
     with open(filename, "rt", encoding=encoding) as fd:
-        return list(csv.DictReader(fd))
+        yield from csv.DictReader(fd)
+
+
+def read_csv_as_dicts(filename):
+    return list(iter_csv_as_dicts(filename))
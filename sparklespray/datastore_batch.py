@@ -3,11 +3,19 @@ from typing import Set, Any, List
 
 
 class Batch:
-    def __init__(self, client: datastore.Client, batch_size: int = 300) -> None:
+    def __init__(
+        self,
+        client: datastore.Client,
+        batch_size: int = 300,
+        write_full_batches: bool = False,
+    ) -> None:
         self.deletes = set()  # type: Set[Any]
         self.puts = []  # type: List[Any]
         self.batch_size = batch_size
         self.client = client
+        # if set, puts are written as soon as there's a full batch of them instead of all being
+        # held until flush
+        self.write_full_batches = write_full_batches
 
     def __repr__(self):
         return f"<Batch {len(self.deletes)} deletes, {len(self.puts)} puts>"
@@ -17,6 +25,9 @@ class Batch:
 
     def put(self, entity) -> None:
         self.puts.append(entity)
+        if self.write_full_batches and len(self.puts) >= self.batch_size:
+            self.client.put_multi(self.puts)
+            self.puts = []
 
     def flush(self) -> None:
         deletes = list(self.deletes)
@@ -0,0 +1,288 @@
+"""An optional local daemon which keeps the manifests (see hasher.DirManifest) of pushed
+directories up to date using inotify, so that submitting doesn't need to stat every file of a
+large tree. Start it with "sparkles hash-daemon". When submit can't connect to it, manifests
+are computed in-process as before.
+
+The daemon answers one request per connection: a line of JSON {"manifest": <absolute path>} to
+which it replies with a line of JSON holding either the manifest or an "error". Before answering
+it applies every pending inotify event, so changes made before the request are always seen.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import json
+import os
+import select
+import socket
+import socketserver
+import struct
+import threading
+
+from .hasher import CachingHashFunction, DirManifest
+from .log import log
+
+DEFAULT_SOCKET_PATH = "~/.sparkles-cache/hashd.sock"
+DEFAULT_CACHE_DB_PATH = "~/.sparkles-cache/hashd-file-hashes"
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_CLOSE_WRITE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+# events which mean the named entry may now be a different directory than before
+REPLACED_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+_EVENT = struct.Struct("iIII")
+
+
+class HashDaemonError(Exception):
+    pass
+
+
+def _load_libc():
+    name = ctypes.util.find_library("c")
+    if name is None:
+        return None
+    libc = ctypes.CDLL(name, use_errno=True)
+    if not hasattr(libc, "inotify_init1"):
+        return None
+    return libc
+
+
+class Inotify:
+    "Minimal inotify binding using ctypes. Only available on Linux."
+
+    def __init__(self):
+        self.libc = _load_libc()
+        if self.libc is None:
+            raise HashDaemonError("inotify is not available on this platform")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.path_by_wd = {}
+
+    def add_watch(self, path):
+        "Returns True if path is now watched"
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            log.warning("Could not watch %s: %s", path, os.strerror(ctypes.get_errno()))
+            return False
+        self.path_by_wd[wd] = path
+        return True
+
+    def read_events(self):
+        "Returns a list of (path, mask, name) for each event which is waiting to be read"
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, name_len = _EVENT.unpack_from(buf, offset)
+                offset += _EVENT.size
+                name = os.fsdecode(buf[offset : offset + name_len].rstrip(b"\0"))
+                offset += name_len
+                path = self.path_by_wd.get(wd)
+                if mask & IN_IGNORED:
+                    # the watch was removed because its directory was deleted or unmounted
+                    self.path_by_wd.pop(wd, None)
+                events.append((path, mask, name))
+
+    def close(self):
+        os.close(self.fd)
+
+
+class HashDaemon:
+    def __init__(self, hash_db, inotify):
+        self.hash_db = hash_db
+        self.inotify = inotify
+        self._lock = threading.Lock()
+        self.watched = set()
+
+    def _apply_events(self):
+        for path, mask, name in self.inotify.read_events():
+            if mask & IN_Q_OVERFLOW:
+                log.warning("Missed some file changes, forgetting all manifests")
+                self.hash_db.forget_manifests("/", subtree=True)
+                self.watched.clear()
+                continue
+            if path is None:
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                self.hash_db.forget_manifests(path, subtree=True)
+                self.watched.discard(path)
+            elif name != "" and mask & IN_ISDIR and mask & REPLACED_MASK:
+                child = os.path.join(path, name)
+                self.hash_db.forget_manifests(child, subtree=True)
+                prefix = os.path.join(child, "")
+                self.watched = set(
+                    p for p in self.watched if p != child and not p.startswith(prefix)
+                )
+            else:
+                self.hash_db.forget_manifests(path)
+
+    def _watch(self, dirname, manifest):
+        if dirname not in self.watched:
+            # either changes here can't be noticed, or they may have happened after the scan but
+            # before the watch was added, so don't reuse this manifest next time
+            self.hash_db.forget_manifests(dirname)
+            if not self.inotify.add_watch(dirname):
+                return
+            self.watched.add(dirname)
+        for name, child in manifest.dirs.items():
+            self._watch(os.path.join(dirname, name), child)
+
+    def get_manifest(self, dirname):
+        with self._lock:
+            self._apply_events()
+            # watch before scanning, so a change made while scanning is picked up next time
+            if dirname not in self.watched and self.inotify.add_watch(dirname):
+                self.watched.add(dirname)
+            manifest = self.hash_db.get_manifest(dirname)
+            self._watch(dirname, manifest)
+            self.hash_db.persist()
+            return manifest
+
+    def _apply_events_forever(self):
+        # keep the kernel's event queue from overflowing between requests
+        while True:
+            select.select([self.inotify.fd], [], [])
+            with self._lock:
+                self._apply_events()
+
+    def serve(self, socket_path):
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                try:
+                    request = json.loads(self.rfile.readline())
+                    manifest = daemon.get_manifest(
+                        os.path.normpath(request["manifest"])
+                    )
+                    response = dict(manifest=_manifest_to_json(manifest))
+                except Exception as ex:
+                    log.exception("Request failed")
+                    response = dict(error=str(ex))
+                self.wfile.write(json.dumps(response).encode("utf8") + b"\n")
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        server = socketserver.ThreadingUnixStreamServer(socket_path, Handler)
+        server.daemon_threads = True
+        threading.Thread(target=self._apply_events_forever, daemon=True).start()
+        log.info("Listening on %s", socket_path)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.unlink(socket_path)
+
+
+def _manifest_to_json(manifest):
+    return dict(
+        digest=manifest.digest,
+        files=manifest.files,
+        dirs={name: _manifest_to_json(child) for name, child in manifest.dirs.items()},
+        executables=sorted(manifest.executables),
+    )
+
+
+def _manifest_from_json(obj):
+    return DirManifest(
+        obj["digest"],
+        obj["files"],
+        {name: _manifest_from_json(child) for name, child in obj["dirs"].items()},
+        frozenset(obj["executables"]),
+    )
+
+
+class HashDaemonClient:
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self._manifests = {}
+
+    def _request(self, request):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socket_path)
+            with sock.makefile("rwb") as fd:
+                fd.write(json.dumps(request).encode("utf8") + b"\n")
+                fd.flush()
+                response = json.loads(fd.readline())
+        if "error" in response:
+            raise HashDaemonError(response["error"])
+        return response
+
+    def get_manifest(self, dirname):
+        # the daemon doesn't share our working directory
+        dirname = os.path.abspath(dirname)
+        if dirname not in self._manifests:
+            response = self._request(dict(manifest=dirname))
+            self._manifests[dirname] = _manifest_from_json(response["manifest"])
+        return self._manifests[dirname]
+
+
+def connect(socket_path):
+    "Returns a HashDaemonClient if a daemon is listening on socket_path, otherwise None"
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except OSError as ex:
+        if ex.errno in (errno.ENOENT, errno.ECONNREFUSED):
+            return None
+        raise
+    finally:
+        sock.close()
+    log.info("Using hash daemon at %s", socket_path)
+    return HashDaemonClient(socket_path)
+
+
+def hash_daemon_cmd(args):
+    socket_path = os.path.expanduser(args.socket)
+    cache_db_path = os.path.expanduser(args.cache_db)
+    for path in [socket_path, cache_db_path]:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    daemon = HashDaemon(CachingHashFunction(cache_db_path), Inotify())
+    daemon.serve(socket_path)
+
+
+def add_hash_daemon_cmd(subparser):
+    parser = subparser.add_parser(
+        "hash-daemon",
+        help="Run a daemon which watches pushed directories for changes so that submitting doesn't need to rescan them",
+    )
+    parser.set_defaults(func=hash_daemon_cmd)
+    parser.add_argument(
+        "--socket",
+        default=DEFAULT_SOCKET_PATH,
+        help="The unix socket to listen on (sub uses the hash_daemon_socket config parameter to find it)",
+    )
+    parser.add_argument(
+        "--cache-db",
+        default=DEFAULT_CACHE_DB_PATH,
+        help="Where the daemon caches file hashes",
+    )
@@ -1,56 +1,273 @@
 import os
 import hashlib
 import json
+import mmap
+import collections
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .log import log
+from .walk import scan_tree
+
+# how many new hashes to record before committing them, so that an interrupted run keeps most
+# of its work
+COMMIT_EVERY = 1000
+
+_SQLITE_HEADER = b"SQLite format 3\x00"
+
+# files at least this large are mapped into memory rather than read
+MMAP_THRESHOLD = 1024 * 1024
+# mapped files are hashed a block at a time so that, when computing several digests, each block
+# is still in the CPU cache for the second one
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_digests(filename, algorithms=("sha256",)):
+    """Returns a tuple of the hex digests of filename computed with each of the hashlib
+    algorithms named in algorithms. Large files are hashed straight out of a memory mapping,
+    without copying them into Python bytes."""
+    hashes = [hashlib.new(algorithm) for algorithm in algorithms]
+    with open(filename, "rb") as fd:
+        size = os.fstat(fd.fileno()).st_size
+        if size < MMAP_THRESHOLD:
+            content = fd.read()
+            for h in hashes:
+                h.update(content)
+        else:
+            with mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                with memoryview(data) as view:
+                    for start in range(0, size, HASH_BLOCK_SIZE):
+                        with view[start : start + HASH_BLOCK_SIZE] as block:
+                            for h in hashes:
+                                h.update(block)
+    return tuple(h.hexdigest() for h in hashes)
 
 
 def hashes_from_file(filename):
-    sha256 = hashlib.sha256()
-    md5 = hashlib.md5()
+    return file_digests(filename, ("sha256", "md5"))
 
+
+# files maps each file's name to its sha256, dirs maps each subdirectory's name to its manifest
+# and executables lists the names of the files which are executable
+DirManifest = collections.namedtuple("DirManifest", "digest files dirs executables")
+
+
+def _merkle_digest(files, dirs):
+    entries = [("f", name, sha256) for name, sha256 in files.items()]
+    entries.extend(("d", name, manifest.digest) for name, manifest in dirs.items())
+    entries.sort()
+    return hashlib.sha256(json.dumps(entries).encode("utf8")).hexdigest()
+
+
+def _is_sqlite_db(filename):
     with open(filename, "rb") as fd:
-        for chunk in iter(lambda: fd.read(200000), b""):
-            sha256.update(chunk)
-            md5.update(chunk)
-    return sha256.hexdigest(), md5.hexdigest()
+        header = fd.read(len(_SQLITE_HEADER))
+    # sqlite leaves an empty file behind if it's interrupted while creating the db
+    return header == _SQLITE_HEADER or header == b""
+
+
+def _read_json_cache(filename):
+    """Returns file_hashes rows for the entries of the JSON hash cache written by older versions
+    which are still valid, judged by the same mtime check those versions used"""
+    try:
+        with open(filename, "rt") as fd:
+            cache = json.load(fd)
+    except (ValueError, UnicodeDecodeError):
+        log.warning("Discarding hash cache %s which could not be read", filename)
+        return []
+    rows = []
+    for path, entry in cache.items():
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        if entry.get("mtime") == st.st_mtime and "sha256" in entry:
+            key = (st.st_size, st.st_mtime_ns, st.st_ino)
+            rows.append((path,) + key + (entry["sha256"], entry.get("md5")))
+    return rows
 
 
 class CachingHashFunction:
+    """Caches the hashes of files in a sqlite db. Entries are looked up as they're needed and
+    are only trusted while the file's size, mtime and inode are unchanged. The db is in WAL mode
+    so that concurrent runs can share it."""
+
     def __init__(self, filename):
         self.filename = filename
-        self.cache = {}
-        self.dirty = False
-        if os.path.exists(filename):
-            with open(filename, "rt") as fd:
-                self.cache = json.load(fd)
+        migrated_rows = []
+        if os.path.exists(filename) and not _is_sqlite_db(filename):
+            # the JSON file written by older versions, whose entries are carried over
+            migrated_rows = _read_json_cache(filename)
+            log.info(
+                "Migrating %d hashes from %s to sqlite", len(migrated_rows), filename
+            )
+            os.unlink(filename)
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS file_hashes ("
+            "path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, "
+            "sha256 TEXT, md5 TEXT)"
+        )
+        # per-directory manifests were once stored too, but only duplicated file_hashes
+        self.db.execute("DROP TABLE IF EXISTS dir_manifests")
+        self.db.executemany(
+            "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?, ?)",
+            migrated_rows,
+        )
+        self.db.commit()
+        self.uncommitted = 0
+        # manifests already computed by this process
+        self._manifests = {}
 
     def get_sha256(self, filename):
-        sha256, _ = self.get_hashes(filename)
+        (sha256,) = self.get_digests(filename, ("sha256",))
         return sha256
 
     def get_md5(self, filename):
-        _, md5 = self.get_hashes(filename)
+        (md5,) = self.get_digests(filename, ("md5",))
         return md5
 
     def get_hashes(self, filename):
+        return self.get_digests(filename, ("sha256", "md5"))
+
+    def _lookup(self, filename, key=None):
+        """Returns (key, digests) where digests is a dict of the cached digests by algorithm, which
+        is empty unless the cached entry is still valid. key is the file's (size, mtime_ns, inode),
+        and is taken from stat'ing the file unless it's provided."""
+        if key is None:
+            st = os.stat(filename)
+            key = (st.st_size, st.st_mtime_ns, st.st_ino)
+        with self._lock:
+            row = self.db.execute(
+                "SELECT size, mtime_ns, inode, sha256, md5 FROM file_hashes WHERE path = ?",
+                (filename,),
+            ).fetchone()
+        if row is not None and tuple(row[:3]) == key:
+            return key, dict(sha256=row[3], md5=row[4])
+        return key, {}
+
+    def _record(self, filename, key, digests):
+        with self._lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?, ?)",
+                (filename,) + key + (digests.get("sha256"), digests.get("md5")),
+            )
+            self.uncommitted += 1
+            if self.uncommitted >= COMMIT_EVERY:
+                self._commit()
+
+    def get_digests(self, filename, algorithms):
+        """Returns a tuple of the digests of filename for each of algorithms ("sha256" or "md5").
+        Each digest is only computed the first time it's asked for, so files which are never
+        given to get_md5 are never md5 hashed."""
         filename = os.path.normpath(filename)
-        mtime = os.path.getmtime(filename)
-        if filename in self.cache:
-            cache_entry = self.cache[filename]
+        key, digests = self._lookup(filename)
+        missing = [
+            algorithm for algorithm in algorithms if digests.get(algorithm) is None
+        ]
+        if len(missing) > 0:
+            digests.update(zip(missing, file_digests(filename, missing)))
+            self._record(filename, key, digests)
+        return tuple(digests[algorithm] for algorithm in algorithms)
+
+    def prefetch(self, filenames, max_workers=None):
+        """Compute the sha256 of each of filenames which isn't already cached, max_workers at a
+        time (defaulting to the number of CPUs), so later calls to get_sha256 are answered from
+        the cache. hashlib releases the GIL while hashing, so threads are enough to use every
+        core."""
+        self._get_sha256s(
+            [(filename, None) for filename in set(map(os.path.normpath, filenames))],
+            max_workers,
+        )
+
+    def _get_sha256s(self, keyed_filenames, max_workers=None):
+        """Takes a list of (filename, key) where key is as for _lookup, and returns a dict of the
+        sha256 of each filename, hashing those which aren't cached in parallel (see prefetch)
+        """
+        sha256s = {}
+        misses = []
+        for filename, key in keyed_filenames:
+            key, digests = self._lookup(filename, key)
+            if digests.get("sha256") is None:
+                misses.append((filename, key, digests))
+            else:
+                sha256s[filename] = digests["sha256"]
+        if len(misses) == 0:
+            return sha256s
+
+        log.info("Hashing %d files", len(misses))
+        with ThreadPoolExecutor(max_workers=max_workers or os.cpu_count()) as executor:
+            for (filename, key, digests), (sha256,) in zip(
+                misses,
+                executor.map(lambda miss: file_digests(miss[0], ("sha256",)), misses),
+            ):
+                digests["sha256"] = sha256
+                self._record(filename, key, digests)
+                sha256s[filename] = sha256
+        return sha256s
+
+    def get_manifest(self, dirname):
+        """Returns a DirManifest of dirname, holding the sha256 of every file beneath it and a
+        Merkle digest of the whole tree. The tree is listed by walk.scan_tree, which stats each
+        file once, and each file's hash is taken from the cache while its stats are unchanged.
+        Every file is still stat'ed, since editing a file in place doesn't change its
+        directory's mtime, so only manifests this process has already computed (which the hash
+        daemon keeps up to date by watching for changes) are reused without walking the tree.
+        Files which need hashing are hashed in parallel (see prefetch)."""
+        dirname = os.path.normpath(dirname)
+        if dirname not in self._manifests:
+            listings = scan_tree(dirname, prune=self._manifests.__contains__)
+            sha256s = self._get_sha256s(
+                [
+                    (os.path.join(path, name), (st.size, st.mtime_ns, st.ino))
+                    for path, listing in listings.items()
+                    for name, st in listing.files.items()
+                ]
+            )
+            self._make_manifest(dirname, listings, sha256s)
+        return self._manifests[dirname]
+
+    def forget_manifests(self, dirname, subtree=False):
+        """Drops the manifests this process has computed for dirname and each directory containing
+        it, so the next get_manifest looks at dirname again. If subtree is set, the manifests of
+        directories beneath dirname are dropped too."""
+        dirname = os.path.normpath(dirname)
+        prefix = os.path.join(dirname, "")
+        for path in list(self._manifests):
             if (
-                "mtime" in cache_entry
-                and cache_entry["mtime"] == mtime
-                and "sha256" in cache_entry
-                and "md5" in cache_entry
+                path == dirname
+                or dirname.startswith(os.path.join(path, ""))
+                or (subtree and path.startswith(prefix))
             ):
-                return cache_entry["sha256"], cache_entry["md5"]
-        sha256, md5 = hashes_from_file(filename)
-        cache_entry = dict(sha256=sha256, md5=md5, mtime=mtime)
-        self.cache[filename] = cache_entry
-        self.dirty = True
-        return sha256, md5
+                del self._manifests[path]
+
+    def _make_manifest(self, dirname, listings, sha256s):
+        """Returns the DirManifest of dirname from its listing in listings (see walk.scan_tree)
+        and the sha256 of each file in sha256s, reusing those already in self._manifests
+        """
+        if dirname in self._manifests:
+            return self._manifests[dirname]
+        listing = listings[dirname]
+        files = {name: sha256s[os.path.join(dirname, name)] for name in listing.files}
+        dirs = {
+            name: self._make_manifest(os.path.join(dirname, name), listings, sha256s)
+            for name in listing.dirs
+        }
+        executables = frozenset(
+            name for name, st in listing.files.items() if st.executable
+        )
+        manifest = DirManifest(_merkle_digest(files, dirs), files, dirs, executables)
+        self._manifests[dirname] = manifest
+        return manifest
+
+    def _commit(self):
+        self.db.commit()
+        self.uncommitted = 0
 
     def persist(self):
-        if self.dirty:
-            with open(self.filename, "wt") as fd:
-                json.dump(self.cache, fd, indent=1)
-            self.dirty = False
+        with self._lock:
+            if self.uncommitted > 0:
+                self._commit()
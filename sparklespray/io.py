@@ -1,84 +1,232 @@
 from google.cloud.storage.client import Client as GSClient
+from google.cloud.exceptions import NotFound, RequestRangeNotSatisfiable
 import os
 import re
 import hashlib
+import base64
 import json
-from .util import compute_hash
+import shutil
+from .util import compute_hash, url_join, get_url_scheme
+from .compression import compress, decompress_if_needed
+from .chunking import ContentDefinedChunker
+from . import chunking
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import itertools
+import collections
 
 from .log import log
 
-use_gustil = False
 import datetime
 
+DEFAULT_CONCURRENCY = 16
+DEFAULT_PARALLEL_DOWNLOAD_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_PARALLEL_DOWNLOAD_PARTS = 8
+DEFAULT_PARALLEL_UPLOAD_THRESHOLD = 64 * 1024 * 1024
+DEFAULT_PARALLEL_UPLOAD_PARTS = 8
+# the most requests the asyncio engine will have in flight at once
+DEFAULT_ASYNC_CONCURRENCY = 256
+# the most objects GCS will accept in a single compose request
+MAX_COMPOSE_SOURCES = 32
+
+
+class ChecksumMismatch(Exception):
+    pass
+
+
+class _PositionalWriter:
+    """File-like object which writes sequentially into fd starting at offset. Uses pwrite
+    so that several writers can fill in different ranges of one file at the same time.
+    """
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        view = memoryview(data)
+        while len(view) > 0:
+            written = os.pwrite(self.fd, view, self.offset)
+            self.offset += written
+            view = view[written:]
+        return len(data)
+
+
+def _verify_checksum(filename, url, crc32c=None, md5_hash=None):
+    """Compares the downloaded file against the base64 encoded crc32c (or md5 when crc32c isn't
+    available) that GCS reports for url"""
+    try:
+        import google_crc32c
+    except ImportError:
+        google_crc32c = None
+
+    if crc32c is not None and google_crc32c is not None:
+        checksum = google_crc32c.Checksum()
+        expected = base64.b64decode(crc32c)
+    elif md5_hash is not None:
+        checksum = hashlib.md5()
+        expected = base64.b64decode(md5_hash)
+    else:
+        log.warning("No checksum available to verify download of %s", filename)
+        return
+
+    with open(filename, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1024 * 1024), b""):
+            checksum.update(chunk)
+
+    if checksum.digest() != expected:
+        raise ChecksumMismatch(
+            "Downloaded {} but its checksum did not match the checksum of {}".format(
+                filename, url
+            )
+        )
 
-class IO:
-    def __init__(
-        self, project, cas_url_prefix, credentials=None, compute_hash=compute_hash
-    ):
-        assert project is not None
 
-        self.buckets = {}
-        self.credentials = credentials
-        self.project = project
-        self.client = GSClient(project, credentials=credentials)
-        if cas_url_prefix[-1] == "/":
-            cas_url_prefix = cas_url_prefix[:-1]
-        self.cas_url_prefix = cas_url_prefix
-        self.compute_hash = compute_hash
+class RequestCounter:
+    "Counts the HTTP requests made through a session, grouped by method"
 
-    def generate_signed_url(self, path, expiry=datetime.timedelta(days=30)):
-        bucket, key = self._get_bucket_and_path(path)
-        blob = bucket.get_blob(key)
-        return blob.generate_signed_url(expiry)
+    def __init__(self):
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
 
-    def bulk_get_as_str(self, paths):
-        from multiprocessing.pool import ThreadPool
-        import threading
+    def instrument(self, session):
+        request = session.request
 
-        my = threading.local()
+        def counting_request(method, url, *args, **kwargs):
+            with self.lock:
+                self.counts[method.upper()] += 1
+            return request(method, url, *args, **kwargs)
 
-        def init_thread():
-            my.client = GSClient(self.project, credentials=self.credentials)
+        session.request = counting_request
+        return session
 
-        pool = ThreadPool(processes=10, initializer=init_thread)
+    def total(self):
+        with self.lock:
+            return sum(self.counts.values())
 
-        def get_as_str(url):
-            m = re.match("^gs://([^/]+)/(.*)$", url)
-            assert m != None, "invalid remote path: {}".format(url)
-            bucket_name = m.group(1)
-            path = m.group(2)
-            bucket = my.client.bucket(bucket_name)
-            blob = bucket.blob(path)
-            if not blob.exists():
-                return (url, None)
-            return (url, blob.download_as_string())
+    def __str__(self):
+        with self.lock:
+            by_method = ", ".join(
+                "{}: {}".format(method, count)
+                for method, count in sorted(self.counts.items())
+            )
+        return "{} requests ({})".format(sum(self.counts.values()), by_method)
 
-        result = dict(pool.map(get_as_str, paths))
-        return result
 
-    def bulk_exists_check(self, paths):
-        from multiprocessing.pool import ThreadPool
-        import threading
+class Storage:
+    """The operations IO needs from an object store. Each implementation handles the urls of
+    one scheme (ie: gs:// or file://). Implementations must be safe to call from multiple threads.
+    """
 
-        my = threading.local()
+    def exists(self, url):
+        raise NotImplementedError()
 
-        def init_thread():
-            my.client = GSClient(self.project, credentials=self.credentials)
+    def read(self, url, start=None):
+        """Fetch the object (or the bytes from offset start onwards). Returns None if the object
+        does not exist and b"" if there is nothing past start."""
+        raise NotImplementedError()
 
-        pool = ThreadPool(processes=10, initializer=init_thread)
+    def get(self, url, dst_filename):
+        "Download the object to dst_filename. Returns False (leaving no file behind) if it does not exist."
+        raise NotImplementedError()
 
-        def check(url):
-            m = re.match("^gs://([^/]+)/(.*)$", url)
-            assert m != None, "invalid remote path: {}".format(url)
-            bucket_name = m.group(1)
-            path = m.group(2)
-            bucket = my.client.bucket(bucket_name)
-            blob = bucket.blob(path)
-            return (url, blob.exists())
+    def put(self, src_filename, url):
+        raise NotImplementedError()
 
-        result = dict(pool.map(check, paths))
-        return result
+    def put_str(self, content, url, content_encoding=None):
+        raise NotImplementedError()
+
+    def list(self, url):
+        "Returns the urls of all objects whose names start with url + '/'"
+        raise NotImplementedError()
+
+    def compose(self, src_urls, dst_url):
+        "Write the concatenation of the objects src_urls to dst_url"
+        raise NotImplementedError()
+
+    def delete(self, url):
+        raise NotImplementedError()
+
+    def generate_signed_url(self, url, expiry):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class GCSStorage(Storage):
+    def __init__(
+        self,
+        project,
+        credentials=None,
+        concurrency=DEFAULT_CONCURRENCY,
+        parallel_download_threshold=DEFAULT_PARALLEL_DOWNLOAD_THRESHOLD,
+        parallel_download_parts=DEFAULT_PARALLEL_DOWNLOAD_PARTS,
+        parallel_upload_threshold=DEFAULT_PARALLEL_UPLOAD_THRESHOLD,
+        parallel_upload_parts=DEFAULT_PARALLEL_UPLOAD_PARTS,
+    ):
+        assert project is not None
+        self.project = project
+        self.credentials = credentials
+        self.concurrency = concurrency
+        # objects larger than this are downloaded as parallel_download_parts concurrent byte ranges
+        self.parallel_download_threshold = parallel_download_threshold
+        self.parallel_download_parts = parallel_download_parts
+        # files larger than this are uploaded as parallel_upload_parts parts and composed
+        self.parallel_upload_threshold = parallel_upload_threshold
+        self.parallel_upload_parts = parallel_upload_parts
+
+        # the http session and per-thread clients are created on first use and shared until
+        # close() is called
+        self._lock = threading.Lock()
+        self._http = None
+        self._thread_state = threading.local()
+        self.request_counter = RequestCounter()
+
+    @property
+    def client(self):
+        "The storage client for the calling thread"
+        client = getattr(self._thread_state, "client", None)
+        if client is None:
+            client = GSClient(
+                self.project, credentials=self.credentials, _http=self._get_http()
+            )
+            self._thread_state.client = client
+        return client
+
+    def get_credentials(self):
+        with self._lock:
+            if self.credentials is None:
+                import google.auth
+
+                self.credentials, _ = google.auth.default(scopes=GSClient.SCOPE)
+            return self.credentials
+
+    def _get_http(self):
+        # One authorized session is shared by all of the per-thread clients so that there's a
+        # single connection pool, sized so that every worker can hold a connection open.
+        credentials = self.get_credentials()
+        with self._lock:
+            if self._http is None:
+                from google.auth.transport.requests import AuthorizedSession
+                import requests.adapters
+
+                http = AuthorizedSession(credentials)
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self.concurrency, pool_maxsize=self.concurrency
+                )
+                http.mount("https://", adapter)
+                self._http = self.request_counter.instrument(http)
+            return self._http
+
+    def close(self):
+        with self._lock:
+            if self._http is not None:
+                self._http.close()
+                self._http = None
+                log.info("Storage requests made: %s", self.request_counter)
+        self._thread_state = threading.local()
 
     def _get_bucket_and_path(self, path):
         m = re.match("^gs://([^/]+)/(.*)$", path)
@@ -86,19 +234,21 @@ class IO:
         bucket_name = m.group(1)
         path = m.group(2)
 
-        if bucket_name in self.buckets:
-            bucket = self.buckets[bucket_name]
-        else:
-            bucket = self.client.bucket(bucket_name)
+        bucket = self.client.bucket(bucket_name)
         return bucket, path
 
-    def exists(self, src_url):
-        bucket, path = self._get_bucket_and_path(src_url)
+    def generate_signed_url(self, url, expiry):
+        bucket, key = self._get_bucket_and_path(url)
+        blob = bucket.get_blob(key)
+        return blob.generate_signed_url(expiry)
+
+    def exists(self, url):
+        bucket, path = self._get_bucket_and_path(url)
         blob = bucket.blob(path)
         return blob.exists()
 
-    def get_child_keys(self, src_url):
-        bucket, path = self._get_bucket_and_path(src_url)
+    def list(self, url):
+        bucket, path = self._get_bucket_and_path(url)
         keys = []
 
         # I'm unclear if _I_ am responsible for requesting the next page or whether iterator does it for me.
@@ -107,77 +257,623 @@ class IO:
 
         return keys
 
-    def get(self, src_url, dst_filename, must=True):
-        log.info("Downloading %s -> %s", src_url, dst_filename)
-        bucket, path = self._get_bucket_and_path(src_url)
+    def read(self, url, start=None):
+        # a single request, rather than checking for existence first
+        bucket, path = self._get_bucket_and_path(url)
         blob = bucket.blob(path)
-        if blob.exists():
-            blob.download_to_filename(dst_filename)
-        else:
-            assert not must, "Could not find {}".format(path)
-
-    def get_as_str(self, src_url, must=True, start=None):
+        try:
+            return blob.download_as_string(start=start)
+        except NotFound:
+            return None
+        except RequestRangeNotSatisfiable:
+            # start is at (or past) the end of the object, so there's no new data
+            return b""
 
-        bucket, path = self._get_bucket_and_path(src_url)
+    def get(self, url, dst_filename):
+        bucket, path = self._get_bucket_and_path(url)
         blob = bucket.blob(path)
-        if blob.exists():
-            end = None
-            if start is not None:
-                blob.reload()
-                end = blob.size
-                if start == end:
-                    return ""
-            # log.warning("Downloading %s (%s, %s)", src_url, start, end)
-            return blob.download_as_string(start=start, end=end).decode("utf8")
+        threshold = self.parallel_download_threshold
+        try:
+            with open(dst_filename, "wb") as fd:
+                if threshold is None:
+                    blob.download_to_file(fd)
+                    return True
+                # Fetch up to the threshold with a single request. Only objects which turn out
+                # to be larger pay for looking up the size and fetching the rest in parallel.
+                blob.download_to_file(fd, start=0, end=threshold - 1)
+                if fd.tell() < threshold:
+                    return True
+            self._get_remainder_in_parts(url, dst_filename, threshold)
+        except NotFound:
+            # don't leave behind the empty file that was opened for the download
+            if os.path.exists(dst_filename):
+                os.unlink(dst_filename)
+            return False
+        except RequestRangeNotSatisfiable:
+            # the object exists but is empty, as is the file we created
+            pass
+        return True
+
+    def _get_remainder_in_parts(self, src_url, dst_filename, offset):
+        bucket, path = self._get_bucket_and_path(src_url)
+        blob = bucket.get_blob(path)
+        if blob is None:
+            raise NotFound("{} was deleted during download".format(src_url))
+        size = blob.size
+        if size <= offset:
+            # the object was exactly threshold bytes, so the first request got all of it
+            return
+
+        part_size = -(-(size - offset) // self.parallel_download_parts)
+        ranges = [
+            (start, min(start + part_size, size) - 1)
+            for start in range(offset, size, part_size)
+        ]
+        log.info(
+            "Downloading remaining %d bytes of %s in %d parts",
+            size - offset,
+            src_url,
+            len(ranges),
+        )
+
+        def download_range(start, end):
+            # pin the generation so every part comes from the same version of the object
+            bucket, path = self._get_bucket_and_path(src_url)
+            part_blob = bucket.blob(path, generation=blob.generation)
+            part_blob.download_to_file(
+                _PositionalWriter(fd, start), start=start, end=end
+            )
+
+        fd = os.open(dst_filename, os.O_WRONLY)
+        try:
+            os.ftruncate(fd, size)
+            # use a dedicated pool so that a get() issued from the shared executor can't
+            # deadlock waiting on its own parts
+            with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+                futures = [
+                    executor.submit(download_range, start, end) for start, end in ranges
+                ]
+                for future in futures:
+                    future.result()
+        finally:
+            os.close(fd)
+
+        _verify_checksum(dst_filename, src_url, blob.crc32c, blob.md5_hash)
+
+    def put(self, src_filename, url):
+        threshold = self.parallel_upload_threshold
+        if threshold is not None and os.path.getsize(src_filename) > threshold:
+            self._put_in_parts(src_filename, url)
         else:
-            assert not must, "Could not find {}".format(path)
+            bucket, path = self._get_bucket_and_path(url)
+            bucket.blob(path).upload_from_filename(src_filename)
+
+    def _put_in_parts(self, src_filename, dst_url):
+        """Upload src_filename as several parts in parallel and then compose them into dst_url.
+        Part names are deterministic, so if an earlier attempt failed part way through, any
+        part which was already uploaded with the same content is reused instead of being
+        sent again."""
+        size = os.path.getsize(src_filename)
+        part_count = min(self.parallel_upload_parts, MAX_COMPOSE_SOURCES)
+        part_size = -(-size // part_count)
+        ranges = [
+            (start, min(part_size, size - start)) for start in range(0, size, part_size)
+        ]
+        part_urls = [
+            "{}.sparkles-part-{}-of-{}".format(dst_url, i + 1, len(ranges))
+            for i in range(len(ranges))
+        ]
+        log.info("Uploading %s in %d parts", src_filename, len(ranges))
+
+        def upload_part(part_url, start, length):
+            bucket, part_path = self._get_bucket_and_path(part_url)
+            with open(src_filename, "rb") as fd:
+                fd.seek(start)
+                md5 = hashlib.md5()
+                remaining = length
+                while remaining > 0:
+                    chunk = fd.read(min(remaining, 1024 * 1024))
+                    md5.update(chunk)
+                    remaining -= len(chunk)
+                md5_hash = base64.b64encode(md5.digest()).decode("utf8")
+
+                existing = bucket.get_blob(part_path)
+                if existing is not None and existing.md5_hash == md5_hash:
+                    log.info("Reusing previously uploaded part %s", part_url)
+                    return
+
+                fd.seek(start)
+                bucket.blob(part_path).upload_from_file(fd, size=length)
+
+        # use a dedicated pool so that a put() issued from the shared executor can't
+        # deadlock waiting on its own parts
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [
+                executor.submit(upload_part, part_url, start, length)
+                for part_url, (start, length) in zip(part_urls, ranges)
+            ]
+            for future in futures:
+                future.result()
+
+        self.compose(part_urls, dst_url)
+
+        for part_url in part_urls:
+            self.delete(part_url)
+
+    def put_str(self, content, url, content_encoding=None):
+        bucket, path = self._get_bucket_and_path(url)
+        blob = bucket.blob(path)
+        blob.content_encoding = content_encoding
+        blob.upload_from_string(content)
+
+    def compose(self, src_urls, dst_url):
+        assert len(src_urls) <= MAX_COMPOSE_SOURCES
+        bucket, path = self._get_bucket_and_path(dst_url)
+        sources = []
+        for src_url in src_urls:
+            src_bucket, src_path = self._get_bucket_and_path(src_url)
+            assert (
+                src_bucket.name == bucket.name
+            ), "compose sources must be in the destination's bucket"
+            sources.append(bucket.blob(src_path))
+        blob = bucket.blob(path)
+        blob.content_type = "application/octet-stream"
+        blob.compose(sources)
+
+    def delete(self, url):
+        bucket, path = self._get_bucket_and_path(url)
+        try:
+            bucket.blob(path).delete()
+        except NotFound:
+            pass
+
+
+class LocalStorage(Storage):
+    """Stores objects as files under the local filesystem, addressed with file:// urls. Useful for
+    running without network access, and for measuring sparkles' own overhead without storage
+    latency."""
+
+    def _get_path(self, url):
+        m = re.match("^file://(/.*)$", url)
+        assert m != None, "invalid local path: {}".format(url)
+        return m.group(1)
+
+    def generate_signed_url(self, url, expiry):
+        # anything able to reach the file can read it directly
+        return url
+
+    def exists(self, url):
+        return os.path.isfile(self._get_path(url))
+
+    def list(self, url):
+        root = self._get_path(url)
+        keys = []
+        for dirpath, _, filenames in os.walk(root):
+            for filename in filenames:
+                keys.append("file://" + os.path.join(dirpath, filename))
+        return keys
+
+    def read(self, url, start=None):
+        try:
+            with open(self._get_path(url), "rb") as fd:
+                if start is not None:
+                    fd.seek(start)
+                return fd.read()
+        except FileNotFoundError:
             return None
 
+    def get(self, url, dst_filename):
+        try:
+            shutil.copyfile(self._get_path(url), dst_filename)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _write(self, url, write):
+        # write to a temp file and rename so readers never see a partially written object
+        path = self._get_path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = "{}.{}-{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "wb") as fd:
+            write(fd)
+        os.replace(tmp_path, path)
+
+    def put(self, src_filename, url):
+        def write(fd):
+            with open(src_filename, "rb") as src:
+                shutil.copyfileobj(src, fd)
+
+        self._write(url, write)
+
+    def put_str(self, content, url, content_encoding=None):
+        # content is stored as given. Readers detect compressed content themselves.
+        if isinstance(content, str):
+            content = content.encode("utf8")
+        self._write(url, lambda fd: fd.write(content))
+
+    def compose(self, src_urls, dst_url):
+        def write(fd):
+            for src_url in src_urls:
+                with open(self._get_path(src_url), "rb") as src:
+                    shutil.copyfileobj(src, fd)
+
+        self._write(dst_url, write)
+
+    def delete(self, url):
+        try:
+            os.unlink(self._get_path(url))
+        except FileNotFoundError:
+            pass
+
+
+class IO:
+    def __init__(
+        self,
+        project,
+        cas_url_prefix,
+        credentials=None,
+        compute_hash=compute_hash,
+        concurrency=DEFAULT_CONCURRENCY,
+        parallel_download_threshold=DEFAULT_PARALLEL_DOWNLOAD_THRESHOLD,
+        parallel_download_parts=DEFAULT_PARALLEL_DOWNLOAD_PARTS,
+        parallel_upload_threshold=DEFAULT_PARALLEL_UPLOAD_THRESHOLD,
+        parallel_upload_parts=DEFAULT_PARALLEL_UPLOAD_PARTS,
+        known_cas_keys=None,
+        use_asyncio=False,
+        async_concurrency=DEFAULT_ASYNC_CONCURRENCY,
+        compression=None,
+        chunked_upload_threshold=None,
+    ):
+        if cas_url_prefix[-1] == "/":
+            cas_url_prefix = cas_url_prefix[:-1]
+        self.cas_url_prefix = cas_url_prefix
+        self.compute_hash = compute_hash
+        self.concurrency = concurrency
+        # optional KnownCASKeys index used to skip existence checks on CAS urls
+        self.known_cas_keys = known_cas_keys
+        # when set, bulk operations run on the asyncio engine in aio.py instead of the executor
+        self.use_asyncio = use_asyncio
+        self.async_concurrency = async_concurrency
+        # how JSON written to CAS is compressed (see compression.py). Reads handle either form.
+        self.compression = compression
+        # when set, files larger than this are written to CAS as content-defined chunks which
+        # are composed into the final object, so a new version of a large file only uploads
+        # the chunks which changed
+        if chunked_upload_threshold is not None and not chunking.is_available():
+            log.warning(
+                "numpy is not installed, so chunked_upload_threshold is ignored and large files are uploaded whole"
+            )
+            chunked_upload_threshold = None
+        self.chunked_upload_threshold = chunked_upload_threshold
+        self.chunker = ContentDefinedChunker()
+
+        self.gcs = GCSStorage(
+            project,
+            credentials,
+            concurrency=concurrency,
+            parallel_download_threshold=parallel_download_threshold,
+            parallel_download_parts=parallel_download_parts,
+            parallel_upload_threshold=parallel_upload_threshold,
+            parallel_upload_parts=parallel_upload_parts,
+        )
+        # the storage implementation to use for each url scheme
+        self.storage_by_scheme = {"gs": self.gcs, "file": LocalStorage()}
+
+        # the executor (or with use_asyncio, the event loop thread and its session) is created
+        # on first use and shared by every bulk operation until close() is called
+        self._lock = threading.Lock()
+        self._executor = None
+        self._async_engine_thread = None
+        self._written_cas_urls = set()
+
+    def _get_storage(self, url):
+        scheme = get_url_scheme(url)
+        assert scheme is not None, "invalid url: {}".format(url)
+        storage = self.storage_by_scheme.get(scheme)
+        assert storage is not None, "unsupported url: {}".format(url)
+        return storage
+
+    def get_executor(self):
+        "Returns the thread pool used for all concurrent IO, creating it if necessary"
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.concurrency, thread_name_prefix="sparkles-io"
+                )
+            return self._executor
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True)
+                self._executor = None
+            if self._async_engine_thread is not None:
+                self._async_engine_thread.close()
+                self._async_engine_thread = None
+        for storage in self.storage_by_scheme.values():
+            storage.close()
+        if self.known_cas_keys is not None:
+            self.known_cas_keys.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def generate_signed_url(self, path, expiry=datetime.timedelta(days=30)):
+        return self._get_storage(path).generate_signed_url(path, expiry)
+
+    def _iter_bulk(self, method, calls, max_in_flight=None):
+        """Call the storage method named method with each tuple of arguments in calls (the first
+        of which is always the url), yielding (args, result) pairs in the order the calls
+        complete. At most max_in_flight calls are outstanding at once, so only completed results
+        which haven't been consumed yet are held in memory."""
+        if self.use_asyncio:
+            if max_in_flight is None:
+                max_in_flight = self.async_concurrency
+            yield from self._get_async_engine_thread().iter_results(
+                lambda engine, args: self._call_async(engine, method, *args),
+                calls,
+                max_in_flight,
+            )
+            return
+
+        if max_in_flight is None:
+            max_in_flight = self.concurrency * 2
+
+        def call(args):
+            return (args, getattr(self._get_storage(args[0]), method)(*args))
+
+        executor = self.get_executor()
+        calls = iter(calls)
+        pending = set(
+            executor.submit(call, args)
+            for args in itertools.islice(calls, max_in_flight)
+        )
+        while len(pending) > 0:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            # top up the queue before handing results back so calls continue while the caller works
+            for args in itertools.islice(calls, len(done)):
+                pending.add(executor.submit(call, args))
+            for future in done:
+                yield future.result()
+
+    def _get_async_engine_thread(self):
+        "Returns the event loop thread used for bulk operations, starting it if necessary"
+        from .aio import AsyncEngineThread
+
+        with self._lock:
+            if self._async_engine_thread is None:
+                self._async_engine_thread = AsyncEngineThread(self._make_async_engine)
+            return self._async_engine_thread
+
+    def _make_async_engine(self):
+        from .aio import AsyncGCS
+
+        return AsyncGCS(
+            self.gcs.get_credentials(),
+            max_concurrency=self.async_concurrency,
+            parallel_download_threshold=self.gcs.parallel_download_threshold,
+            parallel_download_parts=self.gcs.parallel_download_parts,
+        )
+
+    async def _call_async(self, engine, method, url, *args):
+        if url.startswith("gs://"):
+            return await getattr(engine, method)(url, *args)
+        # other storage has no async implementation, so run it on the loop's executor
+        import asyncio
+
+        storage = self._get_storage(url)
+        return await asyncio.get_running_loop().run_in_executor(
+            None, getattr(storage, method), url, *args
+        )
+
+    def iter_bulk_get(self, paths, max_in_flight=None, decompress=False):
+        """Download each path, yielding (path, bytes) pairs in the order the downloads complete.
+        Missing objects are yielded as (path, None). See _iter_bulk for max_in_flight. Set
+        decompress when reading JSON written by write_json_to_cas, which may be compressed.
+        """
+        for (url,), content in self._iter_bulk(
+            "read", ((url,) for url in paths), max_in_flight
+        ):
+            if content is None:
+                self._forget_cas_key(url)
+            if decompress:
+                content = decompress_if_needed(content)
+            yield url, content
+
+    def bulk_get_as_str(self, paths, decompress=False):
+        return dict(self.iter_bulk_get(paths, decompress=decompress))
+
+    def bulk_get(self, pairs, must=True):
+        "Download each (src_url, dst_filename) in pairs concurrently"
+        for (src_url, dst_filename), found in self._iter_bulk("get", pairs):
+            log.info("Downloaded %s -> %s", src_url, dst_filename)
+            if not found:
+                self._forget_cas_key(src_url)
+                assert not must, "Could not find {}".format(src_url)
+
+    def bulk_exists_check(self, paths):
+        result = {}
+        to_check = []
+        for url in paths:
+            if self._is_known_cas_key(url):
+                result[url] = True
+            else:
+                to_check.append(url)
+
+        for (url,), exists in self._iter_bulk("exists", [(url,) for url in to_check]):
+            result[url] = exists
+            if exists:
+                self._remember_cas_key(url)
+        return result
+
+    def _is_cas_url(self, url):
+        return url.startswith(self.cas_url_prefix + "/")
+
+    def _is_known_cas_key(self, url):
+        return self.known_cas_keys is not None and url in self.known_cas_keys
+
+    def _remember_cas_key(self, url):
+        if self.known_cas_keys is not None and self._is_cas_url(url):
+            self.known_cas_keys.add(url)
+
+    def _forget_cas_key(self, url):
+        if self.known_cas_keys is not None:
+            self.known_cas_keys.discard(url)
+
+    def exists(self, src_url):
+        return self._get_storage(src_url).exists(src_url)
+
+    def get_child_keys(self, src_url):
+        return self._get_storage(src_url).list(src_url)
+
+    def _download_as_bytes(self, src_url, start=None):
+        content = self._get_storage(src_url).read(src_url, start=start)
+        if content is None:
+            self._forget_cas_key(src_url)
+        return content
+
+    def get(self, src_url, dst_filename, must=True):
+        log.info("Downloading %s -> %s", src_url, dst_filename)
+        if not self._get_storage(src_url).get(src_url, dst_filename):
+            self._forget_cas_key(src_url)
+            assert not must, "Could not find {}".format(src_url)
+
+    def get_as_str(self, src_url, must=True, start=None, decompress=False):
+        "See iter_bulk_get for decompress"
+        content = self._download_as_bytes(src_url, start=start)
+        if content is None:
+            assert not must, "Could not find {}".format(src_url)
+            return None
+        if decompress:
+            assert start is None, "Cannot decompress part of an object"
+            content = decompress_if_needed(content)
+        return content.decode("utf8")
+
     def put(self, src_filename, dst_url, must=True, skip_if_exists=False):
         if must:
             assert os.path.exists(src_filename), "{} does not exist".format(
                 src_filename
             )
 
-        bucket, path = self._get_bucket_and_path(dst_url)
-        blob = bucket.blob(path)
-        if skip_if_exists and blob.exists():
+        if skip_if_exists and self.exists(dst_url):
             log.info("Already in CAS cache, skipping upload of %s", src_filename)
             log.debug("skipping put %s -> %s", src_filename, dst_url)
         else:
             log.info("put %s -> %s", src_filename, dst_url)
-            # if greater than 10MB ask gsutil to upload for us
-            if use_gustil and os.path.getsize(src_filename) > 10 * 1024 * 1024:
-                import subprocess
-
-                subprocess.check_call(["gsutil", "cp"] + [src_filename, dst_url])
+            threshold = self.chunked_upload_threshold
+            if (
+                threshold is not None
+                and self._is_cas_url(dst_url)
+                and os.path.getsize(src_filename) > threshold
+            ):
+                self._put_chunked(src_filename, dst_url)
             else:
-                blob.upload_from_filename(src_filename)
-
-    def _get_url_prefix(self):
-        return "gs://"
+                self._get_storage(dst_url).put(src_filename, dst_url)
+            self._remember_cas_key(dst_url)
+
+    def _put_chunked(self, src_filename, dst_url):
+        """Upload src_filename as content-defined chunks (see chunking.py), each stored in CAS
+        under its own hash, and then compose them into dst_url. Chunks which are already in CAS,
+        such as the unchanged parts of an earlier version of the file, aren't sent again.
+        """
+        storage = self._get_storage(dst_url)
+
+        def upload_chunk(chunk_url, offset, length):
+            if self._is_known_cas_key(chunk_url) or storage.exists(chunk_url):
+                return False
+            with open(src_filename, "rb") as fd:
+                fd.seek(offset)
+                content = fd.read(length)
+            storage.put_str(content, chunk_url)
+            return True
+
+        # chunks are uploaded as they're found, while the rest of the file is still being read.
+        # Use a dedicated pool so that a put() issued from the shared executor can't deadlock
+        # waiting on its own chunks.
+        chunk_urls = []
+        futures = {}
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for offset, length, sha256 in self.chunker.iter_chunks(src_filename):
+                chunk_url = url_join(self.cas_url_prefix, sha256)
+                chunk_urls.append(chunk_url)
+                # a chunk which occurs several times in the file only needs uploading once
+                if chunk_url not in futures:
+                    futures[chunk_url] = executor.submit(
+                        upload_chunk, chunk_url, offset, length
+                    )
+            uploaded = sum(future.result() for future in futures.values())
+        for chunk_url in futures:
+            self._remember_cas_key(chunk_url)
+        log.info(
+            "Uploaded %d of %d distinct chunks of %s",
+            uploaded,
+            len(futures),
+            src_filename,
+        )
+
+        self._compose_all(storage, chunk_urls, dst_url)
+
+    def _compose_all(self, storage, src_urls, dst_url):
+        """Compose any number of src_urls into dst_url. A single compose accepts at most
+        MAX_COMPOSE_SOURCES objects, so longer lists are first composed into intermediate
+        objects, which are deleted afterwards."""
+        intermediate_urls = []
+        level = 0
+        while len(src_urls) > MAX_COMPOSE_SOURCES:
+            next_urls = []
+            for i in range(0, len(src_urls), MAX_COMPOSE_SOURCES):
+                url = "{}.sparkles-compose-{}-{}".format(
+                    dst_url, level, i // MAX_COMPOSE_SOURCES
+                )
+                storage.compose(src_urls[i : i + MAX_COMPOSE_SOURCES], url)
+                next_urls.append(url)
+            intermediate_urls.extend(next_urls)
+            src_urls = next_urls
+            level += 1
+        storage.compose(src_urls, dst_url)
+        for url in intermediate_urls:
+            storage.delete(url)
+
+    def put_str(self, text, dst_url, content_encoding=None):
+        self._get_storage(dst_url).put_str(
+            text, dst_url, content_encoding=content_encoding
+        )
 
     def write_file_to_cas(self, filename):
-        m = hashlib.sha256()
-        with open(filename, "rb") as fd:
-            for chunk in iter(lambda: fd.read(10000), b""):
-                m.update(chunk)
-        hash = m.hexdigest()
-        dst_url = self.cas_url_prefix + hash
-        bucket, path = self._get_bucket_and_path(dst_url)
-        blob = bucket.blob(path)
-        blob.upload_from_filename(filename)
-        return self._get_url_prefix() + bucket.name + "/" + path
+        dst_url = url_join(self.cas_url_prefix, self.compute_hash(filename))
+        self._write_to_cas_once(dst_url, lambda: self.put(filename, dst_url))
+        return dst_url
 
     def write_str_to_cas(self, text):
         text = text.encode("utf8")
-        hash = hashlib.sha256(text).hexdigest()
-        dst_url = self.cas_url_prefix + "/" + hash
-        bucket, path = self._get_bucket_and_path(dst_url)
-        blob = bucket.blob(path)
-        blob.upload_from_string(text)
-        return self._get_url_prefix() + bucket.name + "/" + path
+        dst_url = url_join(self.cas_url_prefix, hashlib.sha256(text).hexdigest())
+        self._write_to_cas_once(dst_url, lambda: self.put_str(text, dst_url))
+        return dst_url
+
+    def _write_to_cas_once(self, dst_url, upload):
+        # CAS keys are content hashes, so each only needs writing once per process, and
+        # not at all if an earlier run already put it there
+        with self._lock:
+            if dst_url in self._written_cas_urls:
+                return
+        if not (self._is_known_cas_key(dst_url) or self.exists(dst_url)):
+            upload()
+        self._remember_cas_key(dst_url)
+        with self._lock:
+            self._written_cas_urls.add(dst_url)
 
     def write_json_to_cas(self, obj):
-        obj_str = json.dumps(obj)
-        return self.write_str_to_cas(obj_str)
+        "Like write_str_to_cas, but compresses the JSON first if compression is enabled"
+        text = json.dumps(obj).encode("utf8")
+        # the key is always the hash of the uncompressed JSON, so the same object has the same
+        # key whether or not compression is enabled
+        dst_url = url_join(self.cas_url_prefix, hashlib.sha256(text).hexdigest())
+        content, content_encoding = compress(text, self.compression)
+        self._write_to_cas_once(
+            dst_url,
+            lambda: self.put_str(content, dst_url, content_encoding=content_encoding),
+        )
+        return dst_url
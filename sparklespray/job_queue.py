@@ -16,7 +16,13 @@ from .task_store import (
     STATUS_PENDING,
     INCOMPLETE_TASK_STATES,
 )
-from .job_store import JobStore, Job, JOB_STATUS_SUBMITTED, JOB_STATUS_KILLED
+from .job_store import (
+    JobStore,
+    Job,
+    JOB_STATUS_PENDING,
+    JOB_STATUS_SUBMITTED,
+    JOB_STATUS_KILLED,
+)
 from .task_store import TaskStore, TaskHistory, Task
 
 from fnmatch import fnmatch
@@ -175,6 +181,13 @@ class JobQueue:
         task = self.task_storage.get_task(task_id)
         self._reset_task(task, status)
 
+    def _delete_partial_job(self, job_id, task_count):
+        batch = Batch(self.client)
+        for task_index in range(1, task_count + 1):
+            self.task_storage.delete("{}.{}".format(job_id, task_index), batch=batch)
+        self.job_storage.delete(job_id, batch=batch)
+        batch.flush()
+
     def submit(
         self,
         job_id,
@@ -184,44 +197,63 @@ class JobQueue:
         cluster,
         target_node_count,
         max_preemptable_attempts,
+        prepare=None,
     ):
+        """Writes the job and a task for each (task spec url, command result url, log url) in
+        args, which may be a generator: tasks are written a batch at a time as they're taken
+        from it. The job is written first, as pending, so that its tasks never exist without it,
+        and is only marked submitted once every task has been written and prepare() (if
+        provided) has returned. If anything fails, whatever was written is deleted."""
         kube_job_spec = json.dumps(kube_job_spec)
-        tasks = []
         now = time.time()
-
-        batch = Batch(self.client)
-        task_index = 1
-        for arg, command_result_url, log_url in args:
-            task_id = "{}.{}".format(job_id, task_index)
-            task = Task(
-                task_id=task_id,
-                task_index=task_index,
-                job_id=job_id,
-                status="pending",
-                args=arg,
-                history=[TaskHistory(timestamp=now, status="pending")],
-                owner=None,
-                command_result_url=command_result_url,
-                cluster=cluster,
-                monitor_address=None,
-                log_url=log_url,
-            )
-            self.task_storage.insert(task, batch=batch)
-            task_index += 1
-
         job = Job(
             job_id=job_id,
-            tasks=[t.task_id for t in tasks],
+            tasks=[],
             kube_job_spec=kube_job_spec,
             metadata=metadata,
             cluster=cluster,
-            status=JOB_STATUS_SUBMITTED,
-            submit_time=time.time(),
+            status=JOB_STATUS_PENDING,
+            submit_time=now,
             target_node_count=target_node_count,
             max_preemptable_attempts=max_preemptable_attempts,
         )
-        self.job_storage.insert(job, batch=batch)
-        batch.flush()
+        self.job_storage.insert(job)
+
+        # tasks are written as they're created, so that their entities aren't all held at once
+        batch = Batch(self.client, write_full_batches=True)
+        try:
+            for arg, command_result_url, log_url in args:
+                task_index = len(job.tasks) + 1
+                task_id = "{}.{}".format(job_id, task_index)
+                task = Task(
+                    task_id=task_id,
+                    task_index=task_index,
+                    job_id=job_id,
+                    status="pending",
+                    args=arg,
+                    history=[TaskHistory(timestamp=now, status="pending")],
+                    owner=None,
+                    command_result_url=command_result_url,
+                    cluster=cluster,
+                    monitor_address=None,
+                    log_url=log_url,
+                )
+                self.task_storage.insert(task, batch=batch)
+                job.tasks.append(task_id)
+            batch.flush()
+
+            if prepare is not None:
+                prepare()
+
+            job.status = JOB_STATUS_SUBMITTED
+            job.submit_time = time.time()
+            self.job_storage.insert(job)
+        except BaseException:
+            log.warning(
+                "Submitting %s failed, deleting what was written so far", job_id
+            )
+            self._delete_partial_job(job_id, len(job.tasks))
+            raise
         # log.info("Saved task definition batch containing %d tasks", len(batch))
 
 
@@ -28,6 +28,8 @@ class Job(object):
     target_node_count = attr.ib(default=1)
 
 
+# while a job's tasks are still being written
+JOB_STATUS_PENDING = "pending"
 JOB_STATUS_SUBMITTED = "submitted"
 JOB_STATUS_KILLED = "killed"
 
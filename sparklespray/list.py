@@ -2,6 +2,7 @@ from typing import List
 import re
 import json
 import csv
+import collections
 from .job_queue import JobQueue
 import attr
 import sys
@@ -86,31 +87,41 @@ def list_tasks(
     if params_only:
         needs_full_task_def = True
 
-    def to_record(task, task_specs_str):
+    filters = [make_predicate(f) for f in filter_expressions]
+
+    def to_filtered_record(task, task_spec):
         row = attr.asdict(task)
-        if needs_full_task_def:
-            assert task_specs_str is not None
-            task_spec = json.loads(task_specs_str)
+        if task_spec is not None:
             row["args_url"] = task.args
             row["args"] = task_spec
+        # perform the filtering before applying params_only so we can do things like "find parameters of failed tasks"
+        row = process_record(row, fields, filters)
+        if row is not None and params_only:
+            row = row["args"]["parameters"]
         return row
 
     tasks = jq.task_storage.get_tasks(job_id)
 
-    task_spec_strs = {}
     if needs_full_task_def:
-        task_spec_strs = io.bulk_get_as_str([task.args for task in tasks])
-
-    records = []
-    for i, task in enumerate(tasks):
-        # print("{}/{}".format(i, len(tasks)))
-        records.append(to_record(task, task_spec_strs.get(task.args)))
+        # specs are identical (and share a CAS key) for some tasks, so only fetch each once
+        task_indices_by_url = collections.defaultdict(list)
+        for i, task in enumerate(tasks):
+            task_indices_by_url[task.args].append(i)
+
+        # filter and project each record as its spec arrives, so we never hold all of the
+        # fetched specs at once
+        records = [None] * len(tasks)
+        for url, task_spec_str in io.iter_bulk_get(
+            task_indices_by_url.keys(), decompress=True
+        ):
+            assert task_spec_str is not None, "Missing task spec {}".format(url)
+            task_spec = json.loads(task_spec_str)
+            for i in task_indices_by_url[url]:
+                records[i] = to_filtered_record(tasks[i], task_spec)
+    else:
+        records = [to_filtered_record(task, None) for task in tasks]
 
-    # perform the filtering before applying params_only so we can do things like "find parameters of failed tasks"
-    filtered = process_records(records, fields, filter_expressions)
-
-    if params_only:
-        filtered = [record["args"]["parameters"] for record in filtered]
+    filtered = [record for record in records if record is not None]
 
     write(filtered, output_mode, output_filename)
 
@@ -118,21 +129,26 @@ def list_tasks(
 def process_records(records, fields, filter_expressions):
     filters = [make_predicate(f) for f in filter_expressions]
 
-    # make a predicate which represents all predicates being satisified
-    def predicate(record):
-        for filter in filters:
-            if not filter(record):
-                return False
-        return True
+    filtered = []
+    for record in records:
+        record = process_record(record, fields, filters)
+        if record is not None:
+            filtered.append(record)
+
+    return filtered
+
 
-    # perform filtering
-    filtered = [rec for rec in records if predicate(rec)]
+def process_record(record, fields, filters):
+    "Returns None if record fails any of the filters, otherwise the record projected down to fields"
+    for filter in filters:
+        if not filter(record):
+            return None
 
     # project out a subset of columns if requested
     if fields is not None:
-        filtered = [project(rec, fields) for rec in filtered]
+        record = project(record, fields)
 
-    return filtered
+    return record
 
 
 def _get(d: dict, path: str):
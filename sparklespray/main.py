@@ -1,6 +1,7 @@
 import re
 import logging
 import os
+import collections
 import json
 import sys
 import attr
@@ -80,9 +81,7 @@ def show_cmd(jq: JobQueue, io: IO, args):
     else:
         log.info("Getting parameters from %d tasks" % len(tasks))
 
-        rows = []
-
-        def make_simple_row(task):
+        def make_simple_row(task, task_spec):
             row = {}
             row["sparklespray_task_id"] = task.task_id
             row["sparklespray_exit_code"] = task.exit_code
@@ -90,15 +89,13 @@ def show_cmd(jq: JobQueue, io: IO, args):
             row["sparklespray_status"] = task.status
 
             if args.params:
-                task_spec = json.loads(io.get_as_str(task.args))
                 task_parameters = task_spec.get("parameters", {})
                 row.update(task_parameters)
 
             return row
 
-        def make_full_row(task):
+        def make_full_row(task, task_spec):
             row = attr.asdict(task)
-            task_spec = json.loads(io.get_as_str(task.args))
             row["args_url"] = task.args
             row["args"] = task_spec
             return row
@@ -122,17 +119,32 @@ def show_cmd(jq: JobQueue, io: IO, args):
                 w.writerow(row)
 
         if args.detailed:
-            for task in tasks:
-                rows.append(make_full_row(task))
+            make_row = make_full_row
             write = write_json_rows
         else:
-            for task in tasks:
-                rows.append(make_simple_row(task))
+            make_row = make_simple_row
             if args.csv:
                 write = write_csv_rows
             else:
                 write = write_json_rows
 
+        if args.detailed or args.params:
+            # specs are identical (and share a CAS key) for some tasks, so only fetch each once.
+            # Each row is made as its spec arrives, so the fetched specs are never all held at once.
+            task_indices_by_url = collections.defaultdict(list)
+            for i, task in enumerate(tasks):
+                task_indices_by_url[task.args].append(i)
+            rows = [None] * len(tasks)
+            for url, task_spec_str in io.iter_bulk_get(
+                task_indices_by_url.keys(), decompress=True
+            ):
+                assert task_spec_str is not None, "Missing task spec {}".format(url)
+                task_spec = json.loads(task_spec_str)
+                for i in task_indices_by_url[url]:
+                    rows[i] = make_row(tasks[i], task_spec)
+        else:
+            rows = [make_row(task, None) for task in tasks]
+
         if args.out:
             with open(args.out, "wt") as fd:
                 write(rows, fd)
@@ -288,9 +300,11 @@ def status_cmd(jq: JobQueue, io: IO, cluster: Cluster, args):
             )
 
             txtui.user_print("Getting memory stats...")
-            results = io.bulk_get_as_str(command_result_urls).values()
-            results = [json.loads(body) for body in results if body is not None]
-            max_memory_size = [x["resource_usage"]["max_memory_size"] for x in results]
+            max_memory_size = []
+            for _, body in io.iter_bulk_get(command_result_urls):
+                if body is not None:
+                    result = json.loads(body)
+                    max_memory_size.append(result["resource_usage"]["max_memory_size"])
             max_memory_size.sort()
             n = len(max_memory_size)
             txtui.user_print(
@@ -319,11 +333,6 @@ def fetch_cmd(jq, io, args):
 
 
 def fetch_cmd_(jq, io, jobid, dest_root, force=False, flat=False):
-    def get(src, dst, **kwargs):
-        if os.path.exists(dst) and not force:
-            log.warning("%s exists, skipping download", dst)
-        return io.get(src, dst, **kwargs)
-
     tasks = jq.get_tasks(jobid)
 
     if not os.path.exists(dest_root):
@@ -331,43 +340,54 @@ def fetch_cmd_(jq, io, jobid, dest_root, force=False, flat=False):
 
     include_index = not flat
 
+    # fetch the specs of every task concurrently, keeping only the urls needed from each
+    urls_by_spec = {}
+    for url, spec in io.iter_bulk_get(
+        set(task.args for task in tasks), decompress=True
+    ):
+        spec = json.loads(spec)
+        urls_by_spec[url] = (spec["command_result_url"], spec["stdout_url"])
+
+    tasks_by_result_url = collections.defaultdict(list)
     for task in tasks:
-        spec = json.loads(io.get_as_str(task.args))
-        log.debug("task %d spec: %s", task.task_index, spec)
+        command_result_url, stdout_url = urls_by_spec[task.args]
+        tasks_by_result_url[command_result_url].append((task, stdout_url))
+
+    # handle each task's result as it arrives rather than holding every result in memory, and
+    # then download all of the output files in one batch
+    to_download = []
+    for command_result_url, command_result_json in io.iter_bulk_get(
+        tasks_by_result_url.keys()
+    ):
+        for task, stdout_url in tasks_by_result_url[command_result_url]:
+            if include_index:
+                dest = os.path.join(dest_root, str(task.task_index))
+                if not os.path.exists(dest):
+                    os.mkdir(dest)
+            else:
+                dest = dest_root
 
-        if include_index:
-            dest = os.path.join(dest_root, str(task.task_index))
-            if not os.path.exists(dest):
-                os.mkdir(dest)
-        else:
-            dest = dest_root
-
-        # save parameters taken from spec
-        # with open(os.path.join(dest, "parameters.json"), "wt") as fd:
-        #     fd.write(json.dumps(spec['parameters']))
-        command_result_json = io.get_as_str(spec["command_result_url"], must=False)
-        to_download = []
-        if command_result_json is None:
-            log.warning(
-                "Results did not appear to be written yet at %s",
-                spec["command_result_url"],
-            )
-        else:
-            get(spec["stdout_url"], os.path.join(dest, "stdout.txt"))
+            if command_result_json is None:
+                log.warning(
+                    "Results did not appear to be written yet at %s",
+                    command_result_url,
+                )
+                continue
+
+            to_download.append((stdout_url, os.path.join(dest, "stdout.txt")))
             command_result = json.loads(command_result_json)
             log.debug("command_result: %s", json.dumps(command_result))
             for ul in command_result["files"]:
-                to_download.append((ul["src"], ul["dst_url"]))
+                localpath = os.path.join(dest, ul["src"])
+                pdir = os.path.dirname(localpath)
+                if not os.path.exists(pdir):
+                    os.makedirs(pdir)
+                to_download.append((ul["dst_url"], localpath))
 
-        for src, dst_url in to_download:
-            if include_index:
-                localpath = os.path.join(dest_root, str(task.task_index), src)
-            else:
-                localpath = os.path.join(dest_root, src)
-            pdir = os.path.dirname(localpath)
-            if not os.path.exists(pdir):
-                os.makedirs(pdir)
-            get(dst_url, localpath)
+    for _, dst in to_download:
+        if os.path.exists(dst) and not force:
+            log.warning("%s exists, skipping download", dst)
+    io.bulk_get(to_download)
 
 
 def _is_terminal_status(status):
@@ -557,6 +577,7 @@ def main(argv=None):
     from .submit import add_submit_cmd
     from .watch import add_watch_cmd
     from .list import add_list_cmd, add_list_nodes_cmd
+    from .hashd import add_hash_daemon_cmd
 
     parse = argparse.ArgumentParser()
     parse.add_argument("--config", default=None)
@@ -568,6 +589,7 @@ def main(argv=None):
     add_submit_cmd(subparser)
     add_list_cmd(subparser)
     add_list_nodes_cmd(subparser)
+    add_hash_daemon_cmd(subparser)
 
     parser = subparser.add_parser(
         "validate", help="Run a series of tests to confirm the configuration is valid"
@@ -725,6 +747,7 @@ def main(argv=None):
         args.func(args, config)
     else:
         func_param_names = get_func_parameters(args.func)
+        io = None
         if (
             len(set(["config", "jq", "io", "cluster"]).intersection(func_param_names))
             > 0
@@ -742,7 +765,11 @@ def main(argv=None):
         if "cluster" in func_param_names:
             func_params["cluster"] = cluster
 
-        return args.func(**func_params)
+        try:
+            return args.func(**func_params)
+        finally:
+            if io is not None:
+                io.close()
 
 
 if __name__ == "__main__":
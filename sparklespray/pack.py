@@ -0,0 +1,149 @@
+"""Bundles small files which would otherwise each become their own CAS object into "pack" objects.
+
+A pack is the concatenation of its members' contents and is itself stored in CAS under the
+hash of that content. Each member keeps its own CAS url in the task spec (so the worker's cache
+is still keyed by the member's hash) and the download entry records which pack holds it and at
+what offset, so the worker fetches each pack once and slices the members out of it. This way
+the number of existence checks and uploads at submit time scales with the number of packs
+rather than the number of files.
+
+Members are only packed if they aren't already in CAS, and are grouped in order of their hashes
+with boundaries chosen by the members' own hashes (much like content-defined chunking), so
+adding or changing a file only changes the pack it falls in, and the other packs keep their
+keys from one submission to the next."""
+
+import hashlib
+import os
+import collections
+
+from .util import url_join
+from .log import log
+
+DEFAULT_PACK_MAX_FILE_SIZE = 1024 * 1024
+# the average size of a pack, and the size at which a pack is ended regardless
+DEFAULT_PACK_TARGET_SIZE = 16 * 1024 * 1024
+DEFAULT_PACK_MAX_SIZE = 64 * 1024 * 1024
+
+PackLocation = collections.namedtuple("PackLocation", "pack_url offset length")
+
+
+def _ends_pack(url, size, target_size):
+    """Whether a pack should end with the member whose CAS url is url. This only depends on the
+    member, which ends a pack with a chance proportional to its size, so packs hold about
+    target_size bytes on average."""
+    sha256 = url.rsplit("/", 1)[1]
+    return int(sha256[:15], 16) / 16**15 < size / target_size
+
+
+def _group_into_packs(members, target_size, max_size):
+    """Splits the (filename, url, size) members, sorted by url, into lists whose total sizes
+    are at most max_size (unless a single member is larger)"""
+    packs = []
+    current = []
+    current_size = 0
+    for filename, url, size in members:
+        if len(current) > 0 and current_size + size > max_size:
+            packs.append(current)
+            current = []
+            current_size = 0
+        current.append((filename, url, size))
+        current_size += size
+        if _ends_pack(url, size, target_size):
+            packs.append(current)
+            current = []
+            current_size = 0
+    if len(current) > 0:
+        packs.append(current)
+    return packs
+
+
+def _write_pack(members, pack_dir):
+    "Concatenates the members into a file in pack_dir, returning (filename, sha256, offsets)"
+    tmp_filename = os.path.join(pack_dir, "pack.tmp")
+    sha256 = hashlib.sha256()
+    offsets = []
+    offset = 0
+    with open(tmp_filename, "wb") as out:
+        for filename, _, _ in members:
+            with open(filename, "rb") as fd:
+                content = fd.read()
+            out.write(content)
+            sha256.update(content)
+            offsets.append((offset, len(content)))
+            offset += len(content)
+    pack_hash = sha256.hexdigest()
+    pack_filename = os.path.join(pack_dir, pack_hash)
+    os.rename(tmp_filename, pack_filename)
+    return pack_filename, pack_hash, offsets
+
+
+def pack_small_files(
+    upload_map,
+    cas_url,
+    pack_dir,
+    exists_check=None,
+    max_file_size=DEFAULT_PACK_MAX_FILE_SIZE,
+    target_size=DEFAULT_PACK_TARGET_SIZE,
+    max_pack_size=DEFAULT_PACK_MAX_SIZE,
+):
+    """Moves every non-public file of at most max_file_size bytes in upload_map into pack files
+    written to pack_dir, replacing them in upload_map with the packs. Files whose CAS urls are
+    already in CAS according to exists_check (which takes a list of urls and returns a dict of
+    which exist, like IO.bulk_exists_check) are left as they are. Returns a dict mapping each
+    packed member's CAS url to its PackLocation."""
+    candidates = {}
+    for filename, url, is_public in upload_map.uploads():
+        if is_public:
+            continue
+        size = os.path.getsize(filename)
+        if size > max_file_size:
+            continue
+        candidates.setdefault(url, []).append((filename, size))
+
+    exists = {}
+    if exists_check is not None and len(candidates) > 0:
+        exists = exists_check(list(candidates))
+
+    members = []
+    for url, files in candidates.items():
+        if exists.get(url, False):
+            continue
+        for filename, _ in files:
+            upload_map.remove(filename)
+        # identical content only needs to be packed once
+        filename, size = files[0]
+        members.append((filename, url, size))
+
+    if len(members) < 2:
+        # nothing gained by packing a single file
+        for filename, url, _ in members:
+            upload_map.add_url(filename, url)
+        return {}
+
+    # sort by url so the same files always produce the same packs
+    members.sort(key=lambda member: member[1])
+
+    locations = {}
+    for pack_members in _group_into_packs(members, target_size, max_pack_size):
+        pack_filename, pack_hash, offsets = _write_pack(pack_members, pack_dir)
+        pack_url = url_join(cas_url, pack_hash)
+        upload_map.add_url(pack_filename, pack_url)
+        for (_, url, _), (offset, length) in zip(pack_members, offsets):
+            locations[url] = PackLocation(pack_url, offset, length)
+
+    log.info(
+        "Packed %d small files into %d packs",
+        len(locations),
+        len(set(location.pack_url for location in locations.values())),
+    )
+    return locations
+
+
+def add_pack_locations(downloads, locations):
+    "Adds the location of the pack holding each download which was packed"
+    for download in downloads:
+        location = locations.get(download["src_url"])
+        if location is not None:
+            download["pack_url"] = location.pack_url
+            download["pack_offset"] = location.offset
+            download["pack_length"] = location.length
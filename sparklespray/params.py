@@ -0,0 +1,148 @@
+"""Reads the rows of a --params file in batches of columns, so that commands can be expanded a
+column at a time (see spec.ArgvTemplate.expand_columns) without first making a dict per row.
+
+Parquet and Arrow IPC files need pyarrow ("pip install sparklespray[arrow]"). JSONL files are
+read with the json module. Values from every format are converted to strings by param_to_str, so
+that a parameter expands the same way whichever format it came from, and the way it would be
+written in a csv. Null values are treated as missing from their row."""
+
+import json
+import os
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+PARQUET_EXTENSIONS = [".parquet", ".pq"]
+ARROW_IPC_EXTENSIONS = [".arrow", ".feather", ".ipc"]
+JSONL_EXTENSIONS = [".jsonl", ".ndjson"]
+
+
+class ColumnBatch:
+    "A batch of rows stored as a dict mapping each column name to its list of values"
+
+    def __init__(self, columns, row_count):
+        self.columns = columns
+        self.row_count = row_count
+
+    def __len__(self):
+        return self.row_count
+
+    def rows(self):
+        "Yields a dict per row, leaving out the values which are missing"
+        # a batch may have rows but no columns (e.g. lines of {} in a JSONL file), so count the
+        # rows rather than zipping the columns
+        columns = list(self.columns.items())
+        for i in range(self.row_count):
+            row = {}
+            for name, values in columns:
+                if values[i] is not None:
+                    row[name] = values[i]
+            yield row
+
+
+def is_columnar_params_file(filename):
+    "Returns True if filename should be read with read_parameter_batches rather than as a csv"
+    ext = os.path.splitext(filename)[1].lower()
+    return ext in PARQUET_EXTENSIONS + ARROW_IPC_EXTENSIONS + JSONL_EXTENSIONS
+
+
+def read_parameter_batches(filename, batch_size):
+    "Returns an iterator of ColumnBatches of at most batch_size rows read from filename"
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in JSONL_EXTENSIONS:
+        return _read_jsonl(filename, batch_size)
+
+    if pyarrow is None:
+        raise Exception(
+            "Reading {} requires pyarrow, which can be installed with: pip install pyarrow".format(
+                filename
+            )
+        )
+    if ext in PARQUET_EXTENSIONS:
+        return _read_parquet(filename, batch_size)
+    assert ext in ARROW_IPC_EXTENSIONS, "Unknown params file type: {}".format(filename)
+    return _read_arrow_ipc(filename, batch_size)
+
+
+def param_to_str(value):
+    """Returns the string a parameter value read from a params file is expanded to, or None if
+    it's missing. Booleans are written as true and false, and numbers as Python writes them,
+    so 1 stays 1 and 1.0 stays 1.0, as they would appear in a csv."""
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, (list, dict)):
+        return json.dumps(value)
+    if isinstance(value, bytes):
+        return value.decode("utf8")
+    return str(value)
+
+
+def _from_record_batch(record_batch):
+    columns = {}
+    for name, column in zip(record_batch.schema.names, record_batch.columns):
+        values = column.to_pylist()
+        if not pyarrow.types.is_string(column.type):
+            values = [param_to_str(value) for value in values]
+        columns[name] = values
+    return ColumnBatch(columns, record_batch.num_rows)
+
+
+def _read_parquet(filename, batch_size):
+    parquet_file = pyarrow.parquet.ParquetFile(filename)
+    for record_batch in parquet_file.iter_batches(batch_size=batch_size):
+        yield _from_record_batch(record_batch)
+
+
+def _read_arrow_ipc(filename, batch_size):
+    with pyarrow.memory_map(filename) as source:
+        try:
+            reader = pyarrow.ipc.open_file(source)
+            record_batches = (
+                reader.get_batch(i) for i in range(reader.num_record_batches)
+            )
+        except pyarrow.ArrowInvalid:
+            # not the file format, so try the streaming format instead
+            source.seek(0)
+            record_batches = pyarrow.ipc.open_stream(source)
+        for record_batch in record_batches:
+            # slicing doesn't copy, and keeps a file written as one huge batch from being
+            # converted all at once
+            for offset in range(0, record_batch.num_rows, batch_size):
+                yield _from_record_batch(record_batch.slice(offset, batch_size))
+
+
+def _columns_from_rows(rows):
+    names = {}
+    for row in rows:
+        names.update(dict.fromkeys(row))
+    return ColumnBatch(
+        {name: [param_to_str(row.get(name)) for row in rows] for name in names},
+        len(rows),
+    )
+
+
+def _read_jsonl(filename, batch_size):
+    with open(filename, "rt", encoding="utf8") as fd:
+        rows = []
+        for line_number, line in enumerate(fd, 1):
+            if line.strip() == "":
+                continue
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise Exception(
+                    "Expected a JSON object on line {} of {}".format(
+                        line_number, filename
+                    )
+                )
+            rows.append(row)
+            if len(rows) == batch_size:
+                yield _columns_from_rows(rows)
+                rows = []
+        if len(rows) > 0:
+            yield _columns_from_rows(rows)
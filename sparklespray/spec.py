@@ -1,7 +1,13 @@
 import re
 import collections
+import itertools
+import operator
 import os
-from .util import url_join
+from .util import url_join, get_url_scheme
+from .walk import scan_tree
+
+# the number of rows of parameters which are turned into tasks at a time when building a spec
+TASK_BATCH_SIZE = 1000
 
 
 class UploadMap:
@@ -27,21 +33,130 @@ class UploadMap:
         self.map[filename] = (url, is_public)
         return url
 
+    def add_url(self, filename, url, is_public=False):
+        self.map[filename] = (url, is_public)
 
-def rewrite_argv_with_parameters(argv, parameters):
-    l = []
-    for task_params in parameters:
+    def remove(self, filename):
+        del self.map[filename]
+
+
+class ArgvTemplate:
+    """An argv whose tokens may contain {name} placeholders, parsed once so that it can be expanded
+    for many sets of parameters without rescanning the tokens."""
+
+    def __init__(self, argv):
+        self.argv = list(argv)
+        # for each token, None if it has no placeholders, or a format string with a positional
+        # field per placeholder and the parameter names which fill them
+        self.tokens = []
+        names = set()
+        for x in self.argv:
+            parts = re.split("{([^{}]+)}", x)
+            if len(parts) == 1:
+                self.tokens.append(None)
+                continue
+            literals = [
+                part.replace("{", "{{").replace("}", "}}") for part in parts[0::2]
+            ]
+            slot_names = parts[1::2]
+            fmt = literals[0] + "".join(
+                "{%d}%s" % (i, literal) for i, literal in enumerate(literals[1:])
+            )
+            self.tokens.append((fmt, slot_names))
+            names.update(slot_names)
+        self.names = frozenset(names)
+
+    def expand(self, task_params):
+        return self.expand_all([task_params])[0]
+
+    def _check_for_missing(self, parameters, first_row):
+        missing_rows = collections.defaultdict(list)
+        names = self.names
+        for row_i, task_params in enumerate(parameters):
+            if not names <= task_params.keys():
+                for name in names.difference(task_params):
+                    missing_rows[name].append(row_i)
+        if len(missing_rows) > 0:
+            self._raise_missing(missing_rows, len(parameters), first_row)
+
+    def _raise_missing(self, missing_rows, row_count, first_row):
+        # any earlier rows were already checked, so these are the only misses so far
+        raise Exception(
+            "The command references parameters which are missing: {}".format(
+                ", ".join(
+                    "{} (missing from {} of {} rows, first row {})".format(
+                        name,
+                        len(rows),
+                        first_row + row_count,
+                        first_row + rows[0] + 1,
+                    )
+                    for name, rows in sorted(missing_rows.items())
+                )
+            )
+        )
+
+    def _transpose(self, columns, row_count):
+        # columns holds the expansion of each token across all the rows
+        if len(columns) == 0:
+            return [[] for _ in range(row_count)]
+        return [list(row) for row in zip(*columns)]
+
+    def expand_all(self, parameters, first_row=0):
+        """Returns the expanded argv for each of parameters. Raises an exception naming every
+        placeholder which is missing from any of the parameters. first_row is the number of rows
+        which came before parameters, when expanding a large set of rows a batch at a time.
+        """
+        parameters = list(parameters)
+        if len(self.names) > 0:
+            self._check_for_missing(parameters, first_row)
+
+        # expand a token at a time across all the rows, and then transpose
+        columns = []
+        for x, token in zip(self.argv, self.tokens):
+            if token is None:
+                columns.append([x] * len(parameters))
+                continue
+            fmt, slot_names = token
+            format = fmt.format
+            if len(slot_names) == 1:
+                get = operator.itemgetter(slot_names[0])
+                columns.append([format(get(task_params)) for task_params in parameters])
+            else:
+                get = operator.itemgetter(*slot_names)
+                columns.append(
+                    [format(*get(task_params)) for task_params in parameters]
+                )
+        return self._transpose(columns, len(parameters))
+
+    def expand_columns(self, columns, row_count, first_row=0):
+        """Like expand_all, but takes the parameters as a dict mapping each name to its list of
+        row_count values, in which None marks a value missing from that row."""
+        if row_count == 0:
+            return []
+        missing_rows = {}
+        for name in self.names:
+            values = columns.get(name)
+            if values is None:
+                missing_rows[name] = range(row_count)
+            elif None in values:
+                missing_rows[name] = [i for i, x in enumerate(values) if x is None]
+        if len(missing_rows) > 0:
+            self._raise_missing(missing_rows, row_count, first_row)
+
+        argv_columns = []
+        for x, token in zip(self.argv, self.tokens):
+            if token is None:
+                argv_columns.append([x] * row_count)
+                continue
+            fmt, slot_names = token
+            argv_columns.append(
+                list(map(fmt.format, *[columns[name] for name in slot_names]))
+            )
+        return self._transpose(argv_columns, row_count)
 
-        def expand_parameters(x):
-            while True:
-                m = re.match("(.*){([^}]+)}(.*)", x)
-                if m == None:
-                    return x
-                else:
-                    x = m.group(1) + task_params[m.group(2)] + m.group(3)
 
-        l.append([expand_parameters(x) for x in argv])
-    return l
+def rewrite_argv_with_parameters(argv, parameters):
+    return ArgvTemplate(argv).expand_all(parameters)
 
 
 class Download:
@@ -53,42 +168,156 @@ class Download:
         self.symlink_safe = symlink_safe
 
     def _asdict(self):
-        d = dict(src_url=self.src_url, dst=self.dst)
-        if self.executable:
-            d["executable"] = self.executable
-        if self.is_cas_key:
-            d["is_cas_key"] = self.is_cas_key
-        #
-        if self.symlink_safe:
-            d["symlink_safe"] = self.symlink_safe
-        return d
+        return dict(
+            src_url=self.src_url,
+            dst=self.dst,
+            executable=self.executable,
+            is_cas_key=self.is_cas_key,
+            symlink_safe=self.symlink_safe,
+        )
 
 
 DownloadsAndCommand = collections.namedtuple("DownloadsAndCommand", "downloads command")
 SrcDstPair = collections.namedtuple("SrcDstPair", "src dst")
 
 
+class ScannedDirs:
+    """Lists each pushed directory once with walk.scan_tree, so that the same stat of each file
+    is used both to find the files to hash and to make their Downloads"""
+
+    def __init__(self):
+        # maps each directory listed so far to its walk.DirListing
+        self.listings = {}
+
+    def get(self, dirname):
+        "Returns the listings of dirname and every directory beneath it, listing them if needed"
+        dirname = os.path.normpath(dirname)
+        if dirname not in self.listings:
+            self.listings.update(scan_tree(dirname))
+        return self.listings
+
+    def iter_files(self, dirname):
+        "Yields the path of every file beneath dirname"
+        dirname = os.path.normpath(dirname)
+        listing = self.get(dirname)[dirname]
+        for name in listing.files:
+            yield os.path.join(dirname, name)
+        for name in listing.dirs:
+            yield from self.iter_files(os.path.join(dirname, name))
+
+
 def _add_files_in_dir_to_pull_to_wd(
     src_dst_pair,
     upload_map,
     hash_function,
-    is_executable_function,
     cas_url,
     files_to_dl,
     allow_symlinks,
+    manifest_function=None,
+    scanned_dirs=None,
 ):
-    for filename in os.listdir(src_dst_pair.src):
-        src_filename = os.path.join(src_dst_pair.src, filename)
-        dst_filename = os.path.join(src_dst_pair.dst, filename)
-        add_file_to_pull_to_wd(
-            SrcDstPair(src=src_filename, dst=dst_filename),
+    if manifest_function is not None:
+        _add_manifest_files_to_pull_to_wd(
+            src_dst_pair,
+            manifest_function(src_dst_pair.src),
+            upload_map,
+            cas_url,
+            files_to_dl,
+            allow_symlinks,
+        )
+        return
+
+    if scanned_dirs is None:
+        scanned_dirs = ScannedDirs()
+    src = os.path.normpath(src_dst_pair.src)
+    listing = scanned_dirs.get(src)[src]
+    for name, file_stat in listing.files.items():
+        _add_local_file_to_pull_to_wd(
+            SrcDstPair(
+                src=os.path.join(src, name), dst=os.path.join(src_dst_pair.dst, name)
+            ),
+            file_stat.executable,
             upload_map,
             hash_function,
-            is_executable_function,
             cas_url,
             files_to_dl,
             allow_symlinks,
         )
+    for name in listing.dirs:
+        _add_files_in_dir_to_pull_to_wd(
+            SrcDstPair(
+                src=os.path.join(src, name), dst=os.path.join(src_dst_pair.dst, name)
+            ),
+            upload_map,
+            hash_function,
+            cas_url,
+            files_to_dl,
+            allow_symlinks,
+            scanned_dirs=scanned_dirs,
+        )
+
+
+def _add_manifest_files_to_pull_to_wd(
+    src_dst_pair,
+    manifest,
+    upload_map,
+    cas_url,
+    files_to_dl,
+    allow_symlinks,
+):
+    """Like _add_files_in_dir_to_pull_to_wd, but takes the files, their hashes and which are
+    executable from manifest"""
+    for filename, sha256 in manifest.files.items():
+        src_filename = os.path.join(src_dst_pair.src, filename)
+        url = upload_map.get_dst_url(src_filename, must=False)
+        if url is None:
+            url = url_join(cas_url, sha256)
+            upload_map.add_url(src_filename, url)
+        files_to_dl.append(
+            Download(
+                url,
+                os.path.join(src_dst_pair.dst, filename),
+                filename in manifest.executables,
+                url.startswith(cas_url),
+                allow_symlinks,
+            )
+        )
+    for dirname, child in manifest.dirs.items():
+        _add_manifest_files_to_pull_to_wd(
+            SrcDstPair(
+                os.path.join(src_dst_pair.src, dirname),
+                os.path.join(src_dst_pair.dst, dirname),
+            ),
+            child,
+            upload_map,
+            cas_url,
+            files_to_dl,
+            allow_symlinks,
+        )
+
+
+def _add_local_file_to_pull_to_wd(
+    src_dst_pair,
+    executable_flag,
+    upload_map,
+    hash_function,
+    cas_url,
+    files_to_dl,
+    allow_symlinks,
+):
+    url = upload_map.get_dst_url(src_dst_pair.src, must=False)
+    if url is None:
+        assert len(src_dst_pair.src) > 0
+        url = upload_map.add(hash_function, cas_url, src_dst_pair.src)
+    files_to_dl.append(
+        Download(
+            url,
+            src_dst_pair.dst,
+            executable_flag,
+            url.startswith(cas_url),
+            allow_symlinks,
+        )
+    )
 
 
 def add_file_to_pull_to_wd(
@@ -99,9 +328,11 @@ def add_file_to_pull_to_wd(
     cas_url,
     files_to_dl,
     allow_symlinks,
+    manifest_function=None,
+    scanned_dirs=None,
 ):
     assert isinstance(src_dst_pair, SrcDstPair)
-    if src_dst_pair.src.startswith("gs://"):
+    if get_url_scheme(src_dst_pair.src) is not None:
         url = src_dst_pair.src
         executable_flag = False
     else:
@@ -110,18 +341,24 @@ def add_file_to_pull_to_wd(
                 src_dst_pair,
                 upload_map,
                 hash_function,
-                is_executable_function,
                 cas_url,
                 files_to_dl,
                 allow_symlinks,
+                manifest_function,
+                scanned_dirs,
             )
             return
         else:
-            executable_flag = is_executable_function(src_dst_pair.src)
-            url = upload_map.get_dst_url(src_dst_pair.src, must=False)
-            if url is None:
-                assert len(src_dst_pair.src) > 0
-                url = upload_map.add(hash_function, cas_url, src_dst_pair.src)
+            _add_local_file_to_pull_to_wd(
+                src_dst_pair,
+                is_executable_function(src_dst_pair.src),
+                upload_map,
+                hash_function,
+                cas_url,
+                files_to_dl,
+                allow_symlinks,
+            )
+            return
 
     is_cas_key = url.startswith(cas_url)
     # print("add_file_to_pull_to_wd url={} cas_url={}, is_cas_key={}".format(
@@ -131,20 +368,44 @@ def add_file_to_pull_to_wd(
     )
 
 
-def rewrite_argvs_files_to_upload(
-    list_of_argvs,
-    cas_url,
+def _add_extra_files_to_pull_to_wd(
+    extra_files,
+    upload_map,
     hash_function,
     is_executable_function,
-    extra_files,
+    cas_url,
     allow_symlinks,
+    manifest_function=None,
+    scanned_dirs=None,
 ):
-    assert cas_url is not None
-    if not cas_url.endswith("/"):
-        cas_url += "/"
+    "Returns the Downloads for extra_files, which are needed by every task"
+    files_to_dl = []
+    for src_dst_pair in extra_files:
+        add_file_to_pull_to_wd(
+            src_dst_pair,
+            upload_map,
+            hash_function,
+            is_executable_function,
+            cas_url,
+            files_to_dl,
+            allow_symlinks,
+            manifest_function,
+            scanned_dirs,
+        )
+    return files_to_dl
 
-    l = []
-    upload_map = UploadMap()
+
+def _iter_argvs_files_to_upload(
+    list_of_argvs,
+    upload_map,
+    hash_function,
+    is_executable_function,
+    cas_url,
+    allow_symlinks,
+    manifest_function=None,
+    scanned_dirs=None,
+):
+    "Yields a DownloadsAndCommand for each argv, adding the files it references to upload_map"
     for argv in list_of_argvs:
         files_to_dl = []
 
@@ -162,33 +423,53 @@ def rewrite_argvs_files_to_upload(
                     cas_url,
                     files_to_dl,
                     allow_symlinks,
+                    manifest_function,
+                    scanned_dirs,
                 )
                 return filename
 
-        l.append(
-            DownloadsAndCommand(
-                files_to_dl, " ".join([rewrite_filenames(x) for x in argv])
-            )
+        yield DownloadsAndCommand(
+            files_to_dl, " ".join([rewrite_filenames(x) for x in argv])
         )
 
-        for src_dst_pair in extra_files:
-            add_file_to_pull_to_wd(
-                src_dst_pair,
-                upload_map,
-                hash_function,
-                is_executable_function,
-                cas_url,
-                files_to_dl,
-                allow_symlinks,
-            )
 
-    return upload_map, l
+def find_local_files(list_of_argvs, extra_files, expand_dirs=True, scanned_dirs=None):
+    """Returns the set of local files which make_spec_from_command will need to hash for the
+    given argvs and extra_files. Files within directories are left out if expand_dirs is
+    False. Directories are listed with scanned_dirs (a ScannedDirs) if it's provided."""
+    sources = set(pair.src for pair in extra_files)
+    for argv in list_of_argvs:
+        for x in argv:
+            m = re.match("\\^(.*)", x)
+            if m is not None:
+                sources.add(m.group(1))
+
+    if scanned_dirs is None:
+        scanned_dirs = ScannedDirs()
+    files = set()
+    for src in sources:
+        if get_url_scheme(src) is not None:
+            continue
+        if not os.path.isdir(src):
+            files.add(src)
+        elif expand_dirs:
+            files.update(scanned_dirs.iter_files(src))
+    return files
 
 
 def is_executable(filename):
     return os.access(filename, os.X_OK)
 
 
+def _batches(iterable, size):
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
 def make_spec_from_command(
     argv,
     docker_image,
@@ -204,7 +485,29 @@ def make_spec_from_command(
     working_dir=".",
     allow_symlinks=False,
     exclude_patterns=None,
+    prefetch_hashes=None,
+    manifest_function=None,
+    stream_tasks=False,
+    parameter_batches=None,
 ):
+    """prefetch_hashes, if provided, is called with the set of local files in each batch of tasks
+    before any are passed to hash_function, so that they can be hashed in bulk. manifest_function,
+    if provided, is called with each pushed directory and returns its DirManifest (see
+    hasher.py), which is used in place of listing the directory and hashing its files.
+    is_executable_function is only called for files which are named individually; files within
+    directories are checked using the stats from listing the directory.
+
+    If stream_tasks is set, spec["tasks"] is a generator which only reads parameters (which may
+    be any iterable) as tasks are taken from it, and upload_map is not complete until it has
+    been exhausted.
+
+    parameter_batches, if provided, is an iterable of params.ColumnBatch which is used in place
+    of parameters. Each batch's commands are expanded a column at a time, and the dict of
+    parameters for each task is only made when the task is."""
+
+    assert cas_url is not None
+    if not cas_url.endswith("/"):
+        cas_url += "/"
 
     if src_wildcards is None:
         src_wildcards = ["**"]
@@ -212,35 +515,81 @@ def make_spec_from_command(
     if exclude_patterns is None:
         exclude_patterns = []
 
-    list_of_argvs = rewrite_argv_with_parameters(argv, parameters)
+    # files within directories are hashed by manifest_function when it's provided
+    expand_dirs = manifest_function is None
+    # otherwise each directory is listed once, for both prefetching and making the downloads
+    scanned_dirs = ScannedDirs()
+    upload_map = UploadMap()
 
-    upload_map, list_of_dl_and_commands = rewrite_argvs_files_to_upload(
-        list_of_argvs,
-        cas_url,
+    if prefetch_hashes is not None:
+        prefetch_hashes(find_local_files([], extra_files, expand_dirs, scanned_dirs))
+    # extra_files are needed by every task, so they're only listed once
+    common_files_to_dl = _add_extra_files_to_pull_to_wd(
+        extra_files,
+        upload_map,
         hash_function,
         is_executable_function,
-        extra_files,
+        cas_url,
         allow_symlinks,
+        manifest_function,
+        scanned_dirs,
     )
 
-    # we're able to index into parameters and list_of_dl_and_commands because they should be in
-    # the same order.
-    assert len(list_of_dl_and_commands) == len(parameters)
-
-    tasks = []
-    for task_i, dl_and_command in enumerate(list_of_dl_and_commands):
-        tasks.append(
-            dict(
-                downloads=[dict(d._asdict()) for d in dl_and_command.downloads],
-                command=dl_and_command.command,
-                uploads=dict(
-                    include_patterns=src_wildcards,
-                    exclude_patterns=exclude_patterns,
-                    dst_url=url_join(dest_url, str(task_i + 1)),
-                ),
-                parameters=parameters[task_i],
+    def expanded_batches():
+        "Yields the rows of parameters and their expanded argvs a batch at a time"
+        template = ArgvTemplate(argv)
+        row_count = 0
+        if parameter_batches is not None:
+            for batch in parameter_batches:
+                list_of_argvs = template.expand_columns(
+                    batch.columns, len(batch), first_row=row_count
+                )
+                yield batch.rows(), list_of_argvs
+                row_count += len(batch)
+        else:
+            for batch in _batches(parameters, TASK_BATCH_SIZE):
+                yield batch, template.expand_all(batch, first_row=row_count)
+                row_count += len(batch)
+
+    def make_tasks():
+        task_count = 0
+        for rows, list_of_argvs in expanded_batches():
+            if prefetch_hashes is not None:
+                prefetch_hashes(
+                    set(
+                        filename
+                        for filename in find_local_files(
+                            list_of_argvs, [], expand_dirs, scanned_dirs
+                        )
+                        if upload_map.get_dst_url(filename) is None
+                    )
+                )
+            list_of_dl_and_commands = _iter_argvs_files_to_upload(
+                list_of_argvs,
+                upload_map,
+                hash_function,
+                is_executable_function,
+                cas_url,
+                allow_symlinks,
+                manifest_function,
+                scanned_dirs,
             )
-        )
+            for task_parameters, dl_and_command in zip(rows, list_of_dl_and_commands):
+                task_count += 1
+                yield dict(
+                    downloads=[d._asdict() for d in dl_and_command.downloads],
+                    command=dl_and_command.command,
+                    uploads=dict(
+                        include_patterns=src_wildcards,
+                        exclude_patterns=exclude_patterns,
+                        dst_url=url_join(dest_url, str(task_count)),
+                    ),
+                    parameters=task_parameters,
+                )
+
+    tasks = make_tasks()
+    if not stream_tasks:
+        tasks = list(tasks)
 
     spec = {
         "image": docker_image,
@@ -253,5 +602,7 @@ def make_spec_from_command(
         },
         "tasks": tasks,
     }
+    if len(common_files_to_dl) > 0:
+        spec["common"]["downloads"] = [d._asdict() for d in common_files_to_dl]
 
     return upload_map, spec
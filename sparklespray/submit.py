@@ -1,24 +1,32 @@
 import os
 import json
-import copy
 import argparse
 import re
+import shutil
+import tempfile
+import urllib.parse
 
 from typing import List
 from pydantic import BaseModel
 
 import sparklespray
 
-from .csv_utils import read_csv_as_dicts
-from .util import random_string, url_join
+from .csv_utils import iter_csv_as_dicts
+from .params import is_columnar_params_file, read_parameter_batches
+from .util import random_string, url_join, get_url_scheme
 from .node_service import MachineSpec
 from .hasher import CachingHashFunction
-from .spec import make_spec_from_command, SrcDstPair
+from .cas_index import KnownCASKeys, DEFAULT_CAS_INDEX_PATH, DEFAULT_MAX_AGE_DAYS
+from . import hashd
+from .spec import make_spec_from_command, SrcDstPair, TASK_BATCH_SIZE
 from .main import clean
 from .util import get_timestamp
 from .job_queue import JobQueue
 from .cluster_service import Cluster
 from .io import IO
+from .config import BUNDLED_KUBEQUECONSUME_EXE_PATH
+from .upload import parallel_upload, iter_write_json_to_cas
+from .pack import pack_small_files, add_pack_locations
 from .watch import watch, local_watch
 from . import txtui
 from .watch import DockerFailedException
@@ -63,17 +71,62 @@ class ExistingJobException(Exception):
 #   command_result_url: string ( file containing the retcode info )
 #   uploads: list of {src, dst_url}
 #   downloads: list of {src_url, dst}  if src_url is a local path, rewrite to be CAS url
+#   common_downloads_url: CAS url of a list of downloads shared by every task in the job
+#   spec_version: 2 when common_downloads_url is set, so that a worker which is too old to know
+#     about it can't run the task without those downloads. Omitted (meaning 1) otherwise.
 
+# the version of task specs which use common_downloads_url
+COMMON_DOWNLOADS_SPEC_VERSION = 2
 
-def expand_task_spec(common, task):
-    "returns a list of task specs"
-    # merge the common attrs and the per task attrs
-    task_spec = copy.deepcopy(common)
-    for attr in ["helper_log", "command", "uploads"]:
-        if attr in task:
-            task_spec[attr] = task[attr]
-    task_spec["downloads"].extend(task.get("downloads", []))
-    return task_spec
+
+class SharedFields:
+    """Fields which are the same in every task spec of a job. Each TaskSpec references one
+    instance rather than having its own copy, and the JSON for the fields is rendered once and
+    reused."""
+
+    def __init__(self, fields):
+        self.fields = fields
+        self._json_by_excluded_keys = {}
+
+    def json_excluding(self, keys):
+        "Returns the JSON members (without braces) of the fields whose names aren't in keys"
+        excluded = frozenset(keys).intersection(self.fields)
+        text = self._json_by_excluded_keys.get(excluded)
+        if text is None:
+            fields = {k: v for k, v in self.fields.items() if k not in excluded}
+            text = json.dumps(fields).encode("utf8")[1:-1]
+            self._json_by_excluded_keys[excluded] = text
+        return text
+
+
+class TaskSpec:
+    """A task spec made of the fields specific to the task, in overlay, on top of the SharedFields
+    of the job. Supports reading fields like a dict and to_json() for serialization."""
+
+    def __init__(self, shared, overlay):
+        self.shared = shared
+        self.overlay = overlay
+
+    def __getitem__(self, key):
+        if key in self.overlay:
+            return self.overlay[key]
+        return self.shared.fields[key]
+
+    def __contains__(self, key):
+        return key in self.overlay or key in self.shared.fields
+
+    def keys(self):
+        return set(self.overlay).union(self.shared.fields)
+
+    def to_json(self):
+        "Returns the spec serialized as JSON, as bytes"
+        overlay = json.dumps(self.overlay).encode("utf8")
+        shared = self.shared.json_excluding(self.overlay.keys())
+        if shared == b"":
+            return overlay
+        if overlay == b"{}":
+            return b"{" + shared + b"}"
+        return overlay[:-1] + b", " + shared + b"}"
 
 
 def rewrite_url_with_prefix(url, default_url_prefix):
@@ -87,18 +140,15 @@ def rewrite_url_with_prefix(url, default_url_prefix):
         url = default_url_prefix + url
         if url.endswith("/"):
             url = url[:-1]
-    assert not ("//" in url[4:]), "url=%s, default_url_prefix=%s" % (url, a)
+    path = urllib.parse.urlparse(url).path
+    assert not ("//" in path), "url=%s, default_url_prefix=%s" % (url, a)
     return url
 
 
-def rewrite_url_in_dict(d, prop_name, default_url_prefix):
-    if not (prop_name in d):
-        return d
-
-    d = dict(d)
-    url = d[prop_name]
-    d[prop_name] = rewrite_url_with_prefix(url, default_url_prefix)
-    return d
+DOWNLOAD_FLAGS = ["executable", "is_cas_key", "symlink_safe"]
+DOWNLOAD_KEYS = frozenset(
+    ["src_url", "dst", "pack_url", "pack_offset", "pack_length"] + DOWNLOAD_FLAGS
+)
 
 
 def rewrite_downloads(io, downloads, default_url_prefix):
@@ -114,44 +164,78 @@ def rewrite_downloads(io, downloads, default_url_prefix):
         assert not (dst.startswith("../"))
         assert not (dst.startswith("/"))
 
-        return dict(
+        src_url = rewrite_url_with_prefix(src_url, default_url_prefix)
+        if (
+            url.get("src_url") == src_url
+            and url["dst"] == dst
+            and DOWNLOAD_KEYS.issuperset(url)
+            and all(flag in url for flag in DOWNLOAD_FLAGS)
+        ):
+            # already in its final form, so share it rather than copying it
+            return url
+
+        download = dict(
             src_url=src_url,
             dst=dst,
             executable=url.get("executable", False),
             is_cas_key=url.get("is_cas_key", False),
             symlink_safe=url.get("symlink_safe", False),
         )
+        if "pack_url" in url:
+            # the file was bundled into a pack (see pack.py)
+            for key in ["pack_url", "pack_offset", "pack_length"]:
+                download[key] = url[key]
+        return download
 
-    src_expanded = [rewrite_download(x) for x in downloads]
-
-    return [rewrite_url_in_dict(x, "src_url", default_url_prefix) for x in src_expanded]
+    return [rewrite_download(x) for x in downloads]
 
 
-# include_patterns"`
-# 	ExcludePatterns []string `json:"exclude_patterns"`
-# 	UploadDstURL     string   `json:"dst_url"`
+# fields which a task may set to override the job's common fields
+TASK_OVERRIDABLE_FIELDS = ["helper_log", "command", "uploads"]
 
 
-def expand_tasks(spec, io, default_url_prefix, default_job_url_prefix):
-    common = spec["common"]
-    common["downloads"] = rewrite_downloads(
-        io, common.get("downloads", []), default_url_prefix
+def iter_expanded_tasks(
+    spec, io, default_url_prefix, default_job_url_prefix, share_common_downloads=True
+):
+    """Yields a TaskSpec for each task in spec, taking each task from spec only when it's needed.
+
+    If share_common_downloads is set, the downloads shared by every task are written to CAS once
+    and referenced by each task spec, rather than being repeated in all of them. Only workers
+    which support spec version 2 can run such specs."""
+    common = dict(spec["common"])
+    common_downloads = rewrite_downloads(
+        io, common.pop("downloads", []), default_url_prefix
     )
+    common_downloads_url = None
+    if share_common_downloads and len(common_downloads) > 0:
+        common_downloads_url = io.write_json_to_cas(common_downloads)
+        common["spec_version"] = COMMON_DOWNLOADS_SPEC_VERSION
+    shared = SharedFields(common)
     # common['uploads'] = rewrite_uploads(common.get('uploads', []), default_job_url_prefix)
 
-    tasks = []
     for task_i, spec_task in enumerate(spec["tasks"]):
         task_url_prefix = "{}/{}".format(default_job_url_prefix, task_i + 1)
-        task = expand_task_spec(common, spec_task)
-        task["downloads"] = rewrite_downloads(io, task["downloads"], default_url_prefix)
+        overlay = {
+            attr: spec_task[attr]
+            for attr in TASK_OVERRIDABLE_FIELDS
+            if attr in spec_task
+        }
+        overlay["downloads"] = rewrite_downloads(
+            io, spec_task.get("downloads", []), default_url_prefix
+        )
+        if common_downloads_url is not None:
+            overlay["common_downloads_url"] = common_downloads_url
+        elif len(common_downloads) > 0:
+            overlay["downloads"] = common_downloads + overlay["downloads"]
         # task['uploads'] = rewrite_uploads(task['uploads'], task_url_prefix)
-        task["stdout_url"] = rewrite_url_with_prefix(
-            task["stdout_url"], task_url_prefix
+        overlay["stdout_url"] = rewrite_url_with_prefix(
+            common["stdout_url"], task_url_prefix
         )
-        task["command_result_url"] = rewrite_url_with_prefix(
-            task["command_result_url"], task_url_prefix
+        overlay["command_result_url"] = rewrite_url_with_prefix(
+            common["command_result_url"], task_url_prefix
         )
-        task["parameters"] = spec_task["parameters"]
+        overlay["parameters"] = spec_task["parameters"]
+        task = TaskSpec(shared, overlay)
 
         assert set(spec_task.keys()).issubset(
             task.keys()
@@ -159,8 +243,63 @@ def expand_tasks(spec, io, default_url_prefix, default_job_url_prefix):
             spec_task.keys(), task.keys()
         )
 
-        tasks.append(task)
-    return tasks
+        yield task
+
+
+def expand_tasks(
+    spec, io, default_url_prefix, default_job_url_prefix, share_common_downloads=True
+):
+    "Returns a TaskSpec for each task in spec"
+    return list(
+        iter_expanded_tasks(
+            spec,
+            io,
+            default_url_prefix,
+            default_job_url_prefix,
+            share_common_downloads=share_common_downloads,
+        )
+    )
+
+
+def write_task_specs(
+    io, job_id, spec, default_url_prefix, dry_run=False, share_common_downloads=True
+):
+    """Expands each task in spec and writes it to CAS. Returns a generator of a (task spec url,
+    command result url, log url) tuple for each task, which writes the tasks as it's consumed
+    and yields each tuple once that task's spec is in CAS. share_common_downloads is as for
+    iter_expanded_tasks.
+
+    spec["tasks"] may be a generator (see make_spec_from_command's stream_tasks), in which case
+    each task is written while later ones are still being generated.
+    """
+    default_job_url_prefix = url_join(default_url_prefix, job_id)
+    tasks = iter_expanded_tasks(
+        spec,
+        io,
+        default_url_prefix,
+        default_job_url_prefix,
+        share_common_downloads=share_common_downloads,
+    )
+
+    if dry_run:
+        for task in tasks:
+            log.debug("task post expand: %s", task.to_json().decode("utf8"))
+        return iter([])
+
+    def iter_task_urls():
+        txtui.user_print("Writing task specs to CAS")
+        for task, task_spec_url in iter_write_json_to_cas(
+            tasks,
+            io.cas_url_prefix,
+            io,
+            io.get_executor(),
+            write_progress=txtui.user_print_progress,
+            compression=io.compression,
+        ):
+            yield task_spec_url, task["command_result_url"], task["stdout_url"]
+        txtui.user_print("")
+
+    return iter_task_urls()
 
 
 def _parse_cpu_request(txt):
@@ -198,13 +337,17 @@ def submit(
     io: IO,
     cluster: Cluster,
     job_id: str,
-    spec: dict,
+    task_urls: list,
     config: SubmitConfig,
     metadata: dict = {},
     clean_if_exists: bool = False,
     dry_run: bool = False,
     cluster_name=None,
+    prepare=None,
 ):
+    """task_urls is the urls for each task returned by write_task_specs. Tasks are written as
+    they're taken from it, and prepare (if provided) is called once they've all been written and
+    before the job is marked submitted (see JobQueue.submit)."""
     from .key_store import KeyStore
 
     key_store = KeyStore(cluster.client)
@@ -224,24 +367,6 @@ def submit(
 
     preemptible = config.preemptible
     boot_volume_in_gb = config.boot_volume_in_gb
-    default_url_prefix = config.default_url_prefix
-
-    default_job_url_prefix = url_join(default_url_prefix, job_id)
-    tasks = expand_tasks(spec, io, default_url_prefix, default_job_url_prefix)
-    task_spec_urls = []
-    command_result_urls = []
-    log_urls = []
-
-    # TODO: When len(tasks) is a fair size (>100) this starts taking a noticable amount of time.
-    # Perhaps store tasks in a single blob?  Or do write with multiple requests in parallel?
-    for task in tasks:
-        if not dry_run:
-            url = io.write_json_to_cas(task)
-            task_spec_urls.append(url)
-            command_result_urls.append(task["command_result_url"])
-            log_urls.append(task["stdout_url"])
-        else:
-            log.debug("task post expand: %s", json.dumps(task, indent=2))
 
     if not dry_run:
         image = config.image
@@ -300,15 +425,44 @@ def submit(
 
         jq.submit(
             job_id,
-            list(zip(task_spec_urls, command_result_urls, log_urls)),
+            task_urls,
             pipeline_spec,
             metadata,
             cluster_name,
             config.target_node_count,
             max_preemptable_attempts,
+            prepare=prepare,
         )
 
 
+def upload_files(io, uploads, max_bytes_per_sec=None):
+    "Uploads each (filename, dest url, is_public) in uploads which isn't already in CAS"
+    # First check existance of files, so we can print out a single summary statement
+    needs_upload = []
+    needs_upload_bytes = 0
+
+    key_exists = io.bulk_exists_check([dest for _, dest, _ in uploads])
+
+    for filename, dest, is_public in uploads:
+        if not key_exists[dest]:
+            needs_upload.append((filename, dest, is_public))
+            needs_upload_bytes += os.path.getsize(filename)
+
+    # now upload those which did not exist
+    txtui.user_print(
+        f"{len(needs_upload)} files ({needs_upload_bytes} bytes) out of {len(uploads)} files will be uploaded"
+    )
+    parallel_upload(
+        [(filename, dest) for filename, dest, _ in needs_upload],
+        io,
+        io.get_executor(),
+        max_bytes_per_sec=max_bytes_per_sec,
+        write_progress=txtui.user_print_progress,
+    )
+    if len(needs_upload) > 0:
+        txtui.user_print("")
+
+
 def new_job_id():
     import uuid
 
@@ -316,8 +470,9 @@ def new_job_id():
 
 
 def _split_source_dest(file):
-    if file.startswith("gs://"):
-        index = file.find(":", 5)
+    scheme = get_url_scheme(file)
+    if scheme is not None:
+        index = file.find(":", len(scheme) + 3)
     else:
         index = file.find(":")
 
@@ -326,7 +481,7 @@ def _split_source_dest(file):
     else:
         source = dest = file
 
-    if dest.startswith("/") or dest.startswith("gs://"):
+    if dest.startswith("/") or get_url_scheme(dest) is not None:
         dest = os.path.basename(dest)
 
     return source, dest
@@ -357,7 +512,7 @@ def _parse_push(files):
 def expand_files_to_upload(io, filenames):
     pairs = []
     for src, dst in _parse_push(filenames):
-        if src.startswith("gs://"):
+        if get_url_scheme(src) is not None:
             if io.exists(src):
                 pairs.append(SrcDstPair(src, dst))
             else:
@@ -429,7 +584,7 @@ def add_submit_cmd(subparser):
     parser.add_argument(
         "--params",
         "-p",
-        help="Parameterize the command by the rows in the specified CSV file.  If the CSV file has 5 rows, then 5 commands will be submitted.",
+        help="Parameterize the command by the rows in the specified CSV file.  If the CSV file has 5 rows, then 5 commands will be submitted. Parquet (.parquet) and Arrow IPC (.arrow, .feather) files, which require pyarrow, and JSONL (.jsonl) files can be used instead.",
     )
     # parser.add_argument("--fetch", help="After run is complete, automatically download the results")
     parser.add_argument(
@@ -502,6 +657,17 @@ def add_submit_cmd(subparser):
         action="store_true",
         help="If set, will try to turn on nodes initally as preemptible nodes",
     )
+    parser.add_argument(
+        "--max-upload-rate",
+        type=float,
+        default=None,
+        help="If set, caps the total upload bandwidth used when pushing files to CAS (in megabytes/sec)",
+    )
+    parser.add_argument(
+        "--pack",
+        action="store_true",
+        help="Bundle small files into a few larger CAS objects, so that pushing thousands of small files needs far fewer requests",
+    )
     parser.add_argument("command", nargs=argparse.REMAINDER)
     parser.add_argument(
         "--gpu_count", type=int, help="Number of gpus on your VM", default=0
@@ -578,15 +744,44 @@ def submit_cmd(jq, io, cluster, args, config):
 
     cas_url_prefix = config["cas_url_prefix"]
     default_url_prefix = config["default_url_prefix"]
+    # only submissions upload to CAS, so only they consult the index of keys known to exist
+    io.known_cas_keys = KnownCASKeys(
+        os.path.expanduser(config.get("cas_index_path", DEFAULT_CAS_INDEX_PATH)),
+        max_age_days=float(config.get("cas_index_max_age_days", DEFAULT_MAX_AGE_DAYS)),
+    )
+
+    # a worker from another build may not support common_downloads_url, and would ignore it
+    # rather than failing, so only share downloads when using the worker built with this version
+    share_common_downloads = os.path.abspath(
+        config["kubequeconsume_exe_path"]
+    ) == os.path.abspath(BUNDLED_KUBEQUECONSUME_EXE_PATH)
+
+    max_bytes_per_sec = None
+    if args.max_upload_rate is not None:
+        max_bytes_per_sec = args.max_upload_rate * 1024 * 1024
 
     if args.file:
         assert len(args.command) == 0
         spec = json.load(open(args.file, "rt"))
+        task_urls = write_task_specs(
+            io,
+            job_id,
+            spec,
+            default_url_prefix,
+            dry_run=args.dryrun,
+            share_common_downloads=share_common_downloads,
+        )
+        prepare = None
     else:
+        # rows are read as tasks are generated, rather than all being loaded up front
+        parameter_batches = None
         if args.seq is not None:
-            parameters = [{"index": str(i)} for i in range(args.seq)]
+            parameters = ({"index": str(i)} for i in range(args.seq))
+        elif args.params is not None and is_columnar_params_file(args.params):
+            parameters = None
+            parameter_batches = read_parameter_batches(args.params, TASK_BATCH_SIZE)
         elif args.params is not None:
-            parameters = read_csv_as_dicts(args.params)
+            parameters = iter_csv_as_dicts(args.params)
         else:
             parameters = [{}]
 
@@ -598,6 +793,12 @@ def submit_cmd(jq, io, cluster, args, config):
             assert (
                 args.name is not None
             ), "Cannot re-run a job if the name isn't specified"
+            if parameter_batches is not None:
+                parameters = [
+                    row for batch in parameter_batches for row in batch.rows()
+                ]
+                parameter_batches = None
+            parameters = list(parameters)
             assert len(parameters) == 1, "Cannot re-run a job with more than one task"
             # Add the existing job directory to the list of files to download to the worker
 
@@ -606,18 +807,32 @@ def submit_cmd(jq, io, cluster, args, config):
         hash_db = CachingHashFunction(
             config.get("cache_db_path", ".kubeque-cached-file-hashes")
         )
+        # pushed directories are scanned by the hash daemon when it's running
+        hash_daemon = hashd.connect(
+            os.path.expanduser(
+                config.get("hash_daemon_socket", hashd.DEFAULT_SOCKET_PATH)
+            )
+        )
+        manifest_function = (
+            hash_db.get_manifest if hash_daemon is None else hash_daemon.get_manifest
+        )
         upload_map, spec = make_spec_from_command(
             args.command,
             image,
             dest_url=dest_url,
             cas_url=cas_url_prefix,
             parameters=parameters,
+            parameter_batches=parameter_batches,
             hash_function=hash_db.get_sha256,
+            prefetch_hashes=hash_db.prefetch,
+            manifest_function=manifest_function,
             src_wildcards=args.results_wildcards,
             extra_files=expand_files_to_upload(io, files_to_push),
             working_dir=args.working_dir,
             allow_symlinks=args.symlinks,
             exclude_patterns=args.exclude_wildcards,
+            # packing needs every file to be known before the task specs are written
+            stream_tasks=not args.pack,
         )
 
         kubequeconsume_exe_path = config["kubequeconsume_exe_path"]
@@ -625,33 +840,51 @@ def submit_cmd(jq, io, cluster, args, config):
             hash_db.get_sha256, cas_url_prefix, kubequeconsume_exe_path, is_public=True,
         )
         kubequeconsume_exe_md5 = hash_db.get_md5(kubequeconsume_exe_path)
-        hash_db.persist()
-
-        log.debug("upload_map = %s", upload_map)
-
-        # First check existance of files, so we can print out a single summary statement
-        needs_upload = []
-        needs_upload_bytes = 0
-        pending_uploads = upload_map.uploads()
-
-        key_exists = io.bulk_exists_check([dest for _, dest, _ in pending_uploads])
+        # the job, which is written before the tasks, holds a signed url of the executable, so
+        # it needs uploading before the other files
+        upload_files(
+            io,
+            [(kubequeconsume_exe_path, kubequeconsume_exe_obj_path, True)],
+            max_bytes_per_sec,
+        )
+        # reuse the cached hashes when expanding tasks writes local files to CAS
+        io.compute_hash = hash_db.get_sha256
+
+        pack_dir = None
+        if args.pack:
+            pack_dir = tempfile.mkdtemp(prefix="sparkles-packs-")
+            pack_locations = pack_small_files(
+                upload_map, cas_url_prefix, pack_dir, io.bulk_exists_check
+            )
+            add_pack_locations(spec["common"].get("downloads", []), pack_locations)
+            for task in spec["tasks"]:
+                add_pack_locations(task["downloads"], pack_locations)
+
+        # the task specs are written to CAS as the tasks are submitted, which fills in
+        # upload_map. The files they reference are uploaded once every task is written, but
+        # before the job is marked submitted and any nodes are started.
+        task_urls = write_task_specs(
+            io,
+            job_id,
+            spec,
+            default_url_prefix,
+            dry_run=args.dryrun,
+            share_common_downloads=share_common_downloads,
+        )
 
-        for filename, dest, is_public in pending_uploads:
-            if not key_exists[dest]:
-                needs_upload.append((filename, dest, is_public))
-                needs_upload_bytes += os.path.getsize(filename)
+        def prepare():
+            hash_db.persist()
+            log.debug("upload_map = %s", upload_map)
+            upload_files(io, upload_map.uploads(), max_bytes_per_sec)
+            if pack_dir is not None:
+                shutil.rmtree(pack_dir)
 
-        # now upload those which did not exist
-        txtui.user_print(
-            f"{len(needs_upload)} files ({needs_upload_bytes} bytes) out of {len(upload_map.uploads())} files will be uploaded"
-        )
-        for filename, dest, is_public in needs_upload:
-            log.debug(f"Uploading {filename}-> to {dest} (is_public={is_public}")
-            io.put(filename, dest, skip_if_exists=False)
+        if args.dryrun:
+            prepare()
+            prepare = None
 
-    log.debug("spec: %s", json.dumps(spec, indent=2))
+    log.debug("common spec: %s", json.dumps(spec["common"], indent=2))
 
-    # now that the executable is uploaded, we should be able to get a signed url for it
     kubequeconsume_exe_url = io.generate_signed_url(kubequeconsume_exe_obj_path)
     log.info("kubeconsume at %s", kubequeconsume_exe_url)
 
@@ -684,12 +917,13 @@ def submit_cmd(jq, io, cluster, args, config):
         io,
         cluster,
         job_id,
-        spec,
+        task_urls,
         submit_config,
         metadata=metadata,
         clean_if_exists=True,
         dry_run=args.dryrun,
         cluster_name=cluster_name,
+        prepare=prepare,
     )
 
     finished = False
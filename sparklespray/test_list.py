@@ -1,4 +1,4 @@
-from .list import process_records, write_csv
+from .list import process_records, process_record, make_predicate, write_csv
 import io
 
 
@@ -40,3 +40,12 @@ def test_write_csv():
     f = io.StringIO()
     write_csv([{"a": {"b": "c1", "d": "e2"}}, {"a": {"d": "e2"}, "b": "c2"}], f)
     assert f.getvalue().replace("\r", "") == "a.b,a.d,b\nc1,e2,\n,e2,c2\n"
+
+
+def test_process_record():
+    record = dict(name="puma", type="kitty cat", args=dict(parameters=dict(a="1")))
+    filters = [make_predicate("type=kitty cat")]
+
+    assert process_record(record, ["name"], filters) == {"name": "puma"}
+    assert process_record(record, None, [make_predicate("type=duck")]) is None
+    assert process_record(record, None, []) is record
@@ -3,12 +3,19 @@ import logging.handlers
 from termcolor import colored, cprint
 from .log import log
 import datetime
+import sys
 
 
 def user_print(msg):
     print(msg)
 
 
+def user_print_progress(msg):
+    "Overwrite the current line of the terminal with msg. Used for status lines which update in place."
+    sys.stdout.write("\r" + msg)
+    sys.stdout.flush()
+
+
 def print_log_content(timestamp, payload, from_sparkles=False):
     if timestamp is None:
         timestamp = datetime.datetime.now()
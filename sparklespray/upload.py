@@ -0,0 +1,339 @@
+import os
+import collections
+import json
+import hashlib
+import time
+import threading
+from concurrent.futures import as_completed
+
+from .log import log
+from .util import url_join
+from .compression import compress
+
+# HTTP status codes which GCS documents as safe to retry
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+
+class UploadFailed(Exception):
+    pass
+
+
+def is_transient_error(exc):
+    "Returns True if exc looks like an error which may succeed if the upload is retried"
+    if isinstance(exc, (ConnectionError, TimeoutError)):
+        return True
+    # google.api_core exceptions carry the HTTP status as an int in .code
+    code = getattr(exc, "code", None)
+    if isinstance(code, int) and code in TRANSIENT_STATUS_CODES:
+        return True
+    try:
+        import requests.exceptions
+    except ImportError:
+        return False
+    return isinstance(
+        exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+    )
+
+
+class BandwidthLimiter:
+    """Shared across all upload threads to keep the aggregate upload rate at or below
+    bytes_per_sec. Each upload reserves a slot on a timeline before starting, so the
+    average rate is capped even though individual files are sent in one request."""
+
+    def __init__(self, bytes_per_sec):
+        assert bytes_per_sec > 0
+        self.bytes_per_sec = bytes_per_sec
+        self.next_start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, byte_count):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_start)
+            self.next_start = start + byte_count / self.bytes_per_sec
+        delay = start - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def format_bytes(byte_count):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if byte_count < 1024:
+            return "{:.1f}{}".format(byte_count, unit)
+        byte_count /= 1024
+    return "{:.1f}TB".format(byte_count)
+
+
+class UploadProgress:
+    "Tracks completed uploads and periodically reports transfer rate and files remaining"
+
+    def __init__(self, total_files, total_bytes, write_line, min_interval=0.5):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.write_line = write_line
+        self.min_interval = min_interval
+        self.files_done = 0
+        self.bytes_done = 0
+        self.start = time.monotonic()
+        self.last_report = None
+        self.lock = threading.Lock()
+
+    def file_done(self, byte_count):
+        with self.lock:
+            self.files_done += 1
+            self.bytes_done += byte_count
+            now = time.monotonic()
+            if (
+                self.last_report is None
+                or now - self.last_report >= self.min_interval
+                or self.files_done == self.total_files
+            ):
+                self.last_report = now
+                self.write_line(self._status_line(now))
+
+    def _status_line(self, now):
+        elapsed = max(now - self.start, 1e-6)
+        return "Uploaded {} of {} ({}/s), {} files remaining".format(
+            format_bytes(self.bytes_done),
+            format_bytes(self.total_bytes),
+            format_bytes(self.bytes_done / elapsed),
+            self.total_files - self.files_done,
+        )
+
+
+def _with_retries(func, description, max_attempts, retry_delay):
+    attempt = 1
+    while True:
+        try:
+            return func()
+        except Exception as ex:
+            if attempt >= max_attempts or not is_transient_error(ex):
+                raise
+            delay = retry_delay * (2 ** (attempt - 1))
+            log.warning(
+                "%s failed (%s), retrying in %.1f seconds (attempt %d of %d)",
+                description,
+                ex,
+                delay,
+                attempt,
+                max_attempts,
+            )
+            time.sleep(delay)
+            attempt += 1
+
+
+def parallel_upload(
+    uploads,
+    store,
+    executor,
+    max_bytes_per_sec=None,
+    max_attempts=5,
+    retry_delay=1.0,
+    write_progress=None,
+):
+    """Upload each (filename, dst_url) pair in uploads by calling store.put(filename, dst_url)
+    on the threads of executor. store must be safe to call from multiple threads (IO keeps a
+    client per thread) and the number of concurrent uploads is bounded by the executor's size.
+
+    Transient failures are retried up to max_attempts times with exponential backoff. If any
+    upload ultimately fails, UploadFailed is raised after the remaining uploads complete.
+    """
+
+    uploads = [
+        (filename, dst_url, os.path.getsize(filename)) for filename, dst_url in uploads
+    ]
+    if len(uploads) == 0:
+        return
+
+    limiter = None
+    if max_bytes_per_sec:
+        limiter = BandwidthLimiter(max_bytes_per_sec)
+
+    progress = None
+    if write_progress is not None:
+        progress = UploadProgress(
+            len(uploads), sum(size for _, _, size in uploads), write_progress
+        )
+
+    def upload(filename, dst_url, size):
+        if limiter is not None:
+            limiter.consume(size)
+        _with_retries(
+            lambda: store.put(filename, dst_url),
+            "Upload of {} -> {}".format(filename, dst_url),
+            max_attempts,
+            retry_delay,
+        )
+        if progress is not None:
+            progress.file_done(size)
+
+    failures = []
+    futures = {
+        executor.submit(upload, filename, dst_url, size): filename
+        for filename, dst_url, size in uploads
+    }
+    for future in as_completed(futures):
+        ex = future.exception()
+        if ex is not None:
+            log.error("Failed to upload %s: %s", futures[future], ex)
+            failures.append(futures[future])
+
+    if len(failures) > 0:
+        raise UploadFailed(
+            "Failed to upload {} files: {}".format(len(failures), ", ".join(failures))
+        )
+
+
+def _to_json(obj):
+    # objects such as submit.TaskSpec serialize themselves more cheaply than json.dumps can
+    to_json = getattr(obj, "to_json", None)
+    if to_json is not None:
+        return to_json()
+    return json.dumps(obj).encode("utf8")
+
+
+def parallel_write_json_to_cas(
+    objs,
+    cas_url_prefix,
+    store,
+    executor,
+    max_in_flight=64,
+    max_attempts=5,
+    retry_delay=1.0,
+    write_progress=None,
+    compression=None,
+):
+    """Serialize each obj in objs to JSON and store it in CAS, returning the list of CAS
+    urls in the same order as objs. See iter_write_json_to_cas."""
+    return [
+        url
+        for _, url in iter_write_json_to_cas(
+            objs,
+            cas_url_prefix,
+            store,
+            executor,
+            max_in_flight=max_in_flight,
+            max_attempts=max_attempts,
+            retry_delay=retry_delay,
+            write_progress=write_progress,
+            compression=compression,
+        )
+    ]
+
+
+def iter_write_json_to_cas(
+    objs,
+    cas_url_prefix,
+    store,
+    executor,
+    max_in_flight=64,
+    max_attempts=5,
+    retry_delay=1.0,
+    write_progress=None,
+    compression=None,
+):
+    """Serialize each obj in objs to JSON and store it in CAS, yielding (obj, CAS url) in the
+    same order as objs. Each pair is yielded as soon as that object and every one before it
+    are in CAS, so the caller can act on the urls while later objects are still being written.
+
+    Serialization and hashing happen on the calling thread while previously hashed objects
+    are being checked and uploaded by the pool, so network requests overlap with the CPU
+    work. Objects which already exist in CAS (or appear more than once in objs) are only
+    uploaded once. store must have thread-safe exists(url) and put_str(text, url) methods.
+
+    Objects with a to_json() method are serialized by calling it rather than json.dumps.
+
+    If compression is set (see compression.py), objects are compressed before upload and
+    put_str is also passed the content_encoding. Keys are hashes of the uncompressed JSON.
+    """
+
+    # bound the number of serialized objects waiting on the pool so memory doesn't grow with len(objs)
+    in_flight = threading.BoundedSemaphore(max_in_flight)
+    seen = set()
+    # (obj, url, future of its write) for each object which hasn't been yielded yet. Repeated
+    # objects have no future, since they're written by an earlier entry.
+    pending = collections.deque()
+    counts = {"uploaded": 0, "skipped": 0, "json_bytes": 0, "stored_bytes": 0}
+    counts_lock = threading.Lock()
+    last_report = [0.0]
+
+    def write(content, content_encoding, url, json_byte_count):
+        put_kwargs = {}
+        if content_encoding is not None:
+            put_kwargs["content_encoding"] = content_encoding
+        try:
+            exists = _with_retries(
+                lambda: store.exists(url),
+                "Checking for {}".format(url),
+                max_attempts,
+                retry_delay,
+            )
+            if not exists:
+                _with_retries(
+                    lambda: store.put_str(content, url, **put_kwargs),
+                    "Upload of {}".format(url),
+                    max_attempts,
+                    retry_delay,
+                )
+            with counts_lock:
+                counts["skipped" if exists else "uploaded"] += 1
+                if not exists:
+                    counts["json_bytes"] += json_byte_count
+                    counts["stored_bytes"] += len(content)
+                now = time.monotonic()
+                if write_progress is not None and now - last_report[0] >= 0.5:
+                    last_report[0] = now
+                    write_progress(
+                        "{} objects written to CAS, {} already present".format(
+                            counts["uploaded"], counts["skipped"]
+                        )
+                    )
+        except Exception as ex:
+            log.error("Failed to write %s: %s", url, ex)
+            failures.append(ex)
+        finally:
+            in_flight.release()
+
+    def take_written(wait):
+        "Yields the leading entries of pending which are written, waiting for them if wait is set"
+        while len(pending) > 0:
+            obj, url, future = pending[0]
+            if future is not None:
+                if not (wait or future.done()):
+                    return
+                future.result()
+                if len(failures) > 0:
+                    raise UploadFailed(
+                        "Failed to write {} objects to CAS: {}".format(
+                            len(failures), failures[0]
+                        )
+                    )
+            pending.popleft()
+            yield obj, url
+
+    failures = []
+    for obj in objs:
+        text = _to_json(obj)
+        url = url_join(cas_url_prefix, hashlib.sha256(text).hexdigest())
+        future = None
+        if url not in seen:
+            seen.add(url)
+            content, content_encoding = compress(text, compression)
+            in_flight.acquire()
+            future = executor.submit(write, content, content_encoding, url, len(text))
+        pending.append((obj, url, future))
+        yield from take_written(False)
+        # don't let finished objects pile up behind a slow one
+        if len(pending) > max_in_flight:
+            obj, url = next(take_written(True))
+            yield obj, url
+    # wait for the writes still in progress to finish
+    yield from take_written(True)
+
+    log.info(
+        "Wrote %d objects to CAS (%d already present), %s of JSON stored as %s",
+        counts["uploaded"],
+        counts["skipped"],
+        format_bytes(counts["json_bytes"]),
+        format_bytes(counts["stored_bytes"]),
+    )
@@ -1,4 +1,5 @@
 import random
+import re
 import string
 import datetime
 import hashlib
@@ -12,6 +13,14 @@ def compute_hash(filename):
     return m.hexdigest()
 
 
+def get_url_scheme(url):
+    "Returns the scheme of a storage url such as gs://bucket/key, or None if url is a local path"
+    m = re.match("^([a-z]+)://", url)
+    if m is None:
+        return None
+    return m.group(1)
+
+
 def url_join(*args):
     concated = args[0]
     for x in args[1:]:
@@ -95,7 +95,7 @@ def print_error_lines(lines):
 
 def flush_stdout_from_complete_task(jq, io, task_id, offset):
     task = jq.task_storage.get_task(task_id)
-    spec = json.loads(io.get_as_str(task.args))
+    spec = json.loads(io.get_as_str(task.args, decompress=True))
 
     attempts = 0
     while True:
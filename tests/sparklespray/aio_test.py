@@ -0,0 +1,213 @@
+import asyncio
+import base64
+import hashlib
+import threading
+from urllib.parse import unquote
+
+import pytest
+
+aiohttp = pytest.importorskip("aiohttp")
+from aiohttp import web
+from google.auth.credentials import AnonymousCredentials
+
+from sparklespray.aio import AsyncGCS, AsyncGCSError, AsyncEngineThread
+from sparklespray.io import IO, ChecksumMismatch
+
+LARGE_CONTENT = bytes(range(256)) * 100
+
+
+class FakeGCSServer:
+    "Serves the subset of the GCS JSON API used by AsyncGCS out of a dict"
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.requests = []
+        # the generation of each object, which is 1 unless it's listed here
+        self.generations = {}
+        # called with the name of each object after it's read
+        self.after_read = lambda name: None
+
+    async def handle(self, request):
+        self.requests.append((request.method, request.raw_path))
+        path = request.raw_path.split("?")[0]
+        if request.method == "POST":
+            self.objects[request.query["name"]] = await request.read()
+            return web.json_response({"name": request.query["name"]})
+
+        name = unquote(path.split("/o/", 1)[1])
+        content = self.objects.get(name)
+        if content is None:
+            return web.Response(status=404)
+        generation = str(self.generations.get(name, 1))
+        if request.query.get("generation", generation) != generation:
+            return web.Response(status=404)
+        if request.query.get("alt") != "media":
+            return web.json_response({"name": name})
+        self.after_read(name)
+        md5 = base64.b64encode(hashlib.md5(content).digest()).decode("utf8")
+        headers = {"x-goog-hash": "md5=" + md5, "x-goog-generation": generation}
+        if request.headers.get("Range") is None:
+            return web.Response(body=content, headers=headers)
+        start, end = request.headers["Range"][len("bytes=") :].split("-")
+        start = int(start)
+        end = len(content) - 1 if end == "" else min(int(end), len(content) - 1)
+        if start >= len(content):
+            return web.Response(status=416)
+        return web.Response(
+            status=206,
+            body=content[start : end + 1],
+            headers=dict(
+                headers,
+                **{"Content-Range": "bytes {}-{}/{}".format(start, end, len(content))}
+            ),
+        )
+
+
+@pytest.fixture
+def server():
+    server = FakeGCSServer({"log.txt": b"hello world", "large": LARGE_CONTENT})
+    loop = asyncio.new_event_loop()
+    app = web.Application()
+    app.router.add_route("*", "/{tail:.*}", server.handle)
+    runner = web.AppRunner(app)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    server.endpoint = "http://127.0.0.1:{}".format(
+        site._server.sockets[0].getsockname()[1]
+    )
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield server
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.run_until_complete(runner.cleanup())
+    loop.close()
+
+
+def make_engine(server, **kwargs):
+    return AsyncGCS(AnonymousCredentials(), endpoint=server.endpoint, **kwargs)
+
+
+def test_async_object_operations(server):
+    async def run():
+        async with make_engine(server) as engine:
+            assert await engine.exists("gs://bucket/log.txt")
+            assert not await engine.exists("gs://bucket/missing")
+            assert await engine.read("gs://bucket/log.txt") == b"hello world"
+            assert await engine.read("gs://bucket/log.txt", start=6) == b"world"
+            assert await engine.read("gs://bucket/log.txt", start=11) == b""
+            assert await engine.read("gs://bucket/missing") is None
+            await engine.put_str("uploaded", "gs://bucket/dir/uploaded")
+
+    asyncio.run(run())
+    assert server.objects["dir/uploaded"] == b"uploaded"
+
+
+def test_async_get_in_parts(server, tmpdir):
+    dst = str(tmpdir.join("out"))
+
+    async def run():
+        async with make_engine(
+            server, parallel_download_threshold=1000, parallel_download_parts=7
+        ) as engine:
+            assert await engine.get("gs://bucket/large", dst)
+            assert not await engine.get("gs://bucket/missing", dst + "-missing")
+
+    asyncio.run(run())
+    assert open(dst, "rb").read() == LARGE_CONTENT
+    assert len([r for r in server.requests if "large" in r[1]]) == 8
+
+
+def test_async_get_in_parts_pins_generation(server, tmpdir):
+    dst = str(tmpdir.join("out"))
+
+    def overwrite(name):
+        server.objects[name] = LARGE_CONTENT[::-1]
+        server.generations[name] = 2
+
+    server.after_read = overwrite
+
+    async def run():
+        async with make_engine(server, parallel_download_threshold=1000) as engine:
+            await engine.get("gs://bucket/large", dst)
+
+    with pytest.raises(ChecksumMismatch):
+        asyncio.run(run())
+    assert all("generation=1" in path for _, path in server.requests[1:])
+
+
+def test_async_errors_are_not_retried_unless_transient(server):
+    server.objects = None  # make every request fail with a 500
+
+    async def run():
+        async with make_engine(server, max_attempts=2, retry_delay=0) as engine:
+            await engine.read("gs://bucket/log.txt")
+
+    with pytest.raises(AsyncGCSError):
+        asyncio.run(run())
+    assert len(server.requests) == 2
+
+
+def test_iter_async_results_bounds_in_flight(server):
+    in_flight = [0, 0]
+
+    async def call(engine, item):
+        in_flight[0] += 1
+        in_flight[1] = max(in_flight)
+        await asyncio.sleep(0.001)
+        in_flight[0] -= 1
+        return item * 2
+
+    engine_thread = AsyncEngineThread(lambda: make_engine(server))
+    results = dict(engine_thread.iter_results(call, range(100), 5))
+    assert results == {i: i * 2 for i in range(100)}
+    assert in_flight[1] <= 5
+
+    # stopping early doesn't stop the loop from being used again
+    for _ in engine_thread.iter_results(call, range(100), 5):
+        break
+    assert dict(engine_thread.iter_results(call, range(3), 5)) == {0: 0, 1: 2, 2: 4}
+
+    # items are produced on the calling thread, not on the loop
+    item_threads = set()
+
+    def items():
+        for i in range(10):
+            item_threads.add(threading.current_thread())
+            yield i
+
+    assert len(dict(engine_thread.iter_results(call, items(), 5))) == 10
+    assert item_threads == {threading.current_thread()}
+    engine_thread.close()
+    assert not engine_thread.thread.is_alive()
+
+
+def test_io_bulk_operations_on_asyncio(server, tmpdir):
+    io = IO(
+        "project",
+        "gs://bucket/CAS",
+        credentials=AnonymousCredentials(),
+        use_asyncio=True,
+    )
+    io._make_async_engine = lambda: make_engine(server)
+    local_url = "file://" + str(tmpdir.join("local"))
+    io.put_str("local", local_url)
+
+    assert io.bulk_get_as_str(
+        ["gs://bucket/log.txt", "gs://bucket/missing", local_url]
+    ) == {
+        "gs://bucket/log.txt": b"hello world",
+        "gs://bucket/missing": None,
+        local_url: b"local",
+    }
+    assert io.bulk_exists_check(["gs://bucket/log.txt", "gs://bucket/missing"]) == {
+        "gs://bucket/log.txt": True,
+        "gs://bucket/missing": False,
+    }
+    dst = str(tmpdir.join("out"))
+    io.bulk_get([("gs://bucket/log.txt", dst)])
+    assert open(dst, "rb").read() == b"hello world"
+    with pytest.raises(AssertionError):
+        io.bulk_get([("gs://bucket/missing", dst)])
+    io.close()
@@ -0,0 +1,29 @@
+import random
+
+import pytest
+
+from sparklespray.chunking import ContentDefinedChunker
+
+pytest.importorskip("numpy")
+
+
+def test_chunk_boundaries_follow_content(tmpdir):
+    chunker = ContentDefinedChunker(min_size=1024, avg_size=4096, max_size=16384)
+    content = random.Random(0).getrandbits(8 * 300000).to_bytes(300000, "big")
+    src = tmpdir.join("src")
+    src.write_binary(content)
+    chunks = chunker.chunks(str(src))
+
+    assert sum(length for _, length, _ in chunks) == len(content)
+    assert all(1024 <= length <= 16384 for _, length, _ in chunks[:-1])
+    # inserting bytes near the start shifts every offset but leaves most chunks unchanged
+    src.write_binary(content[:5000] + b"inserted" + content[5000:])
+    shifted = chunker.chunks(str(src))
+    unchanged = set(h for _, _, h in chunks) & set(h for _, _, h in shifted)
+    assert len(unchanged) >= len(chunks) - 2
+
+
+def test_empty_file_has_no_chunks(tmpdir):
+    src = tmpdir.join("src")
+    src.write_binary(b"")
+    assert ContentDefinedChunker().chunks(str(src)) == []
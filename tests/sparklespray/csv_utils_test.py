@@ -1,4 +1,4 @@
-from sparklespray.csv_utils import read_csv_as_dicts
+from sparklespray.csv_utils import read_csv_as_dicts, iter_csv_as_dicts
 import os
 from collections import OrderedDict
 
@@ -16,3 +16,10 @@ def test_read_csv_as_dicts():
 
     l = read_csv_as_dicts(data_dir + "/plain.csv")
     assert l == expected
+
+
+def test_iter_csv_as_dicts():
+    data_dir = os.path.join(os.path.dirname(__file__), "csv_utils_test_data")
+    rows = iter_csv_as_dicts(data_dir + "/excel-utf8.csv")
+    assert next(rows) == OrderedDict([("alpha", "1"), ("beta", "2")])
+    assert list(rows) == [OrderedDict([("alpha", "3"), ("beta", "4")])]
@@ -0,0 +1,54 @@
+import os
+import threading
+import time
+
+import pytest
+
+from sparklespray import hashd
+from sparklespray.hasher import CachingHashFunction
+
+
+@pytest.fixture
+def daemon(tmpdir):
+    try:
+        inotify = hashd.Inotify()
+    except hashd.HashDaemonError:
+        pytest.skip("inotify is not available")
+    daemon = hashd.HashDaemon(CachingHashFunction(str(tmpdir.join("cache"))), inotify)
+    socket_path = str(tmpdir.join("hashd.sock"))
+    threading.Thread(target=daemon.serve, args=(socket_path,), daemon=True).start()
+    for _ in range(100):
+        if os.path.exists(socket_path):
+            break
+        time.sleep(0.01)
+    daemon.socket_path = socket_path
+    return daemon
+
+
+def test_daemon_notices_changes(daemon, tmpdir, monkeypatch):
+    for name in ["a/f1", "a/sub/f2", "b/f3"]:
+        tmpdir.join("tree", name).write(name, ensure=True)
+    root = str(tmpdir.join("tree"))
+
+    first = hashd.connect(daemon.socket_path).get_manifest(root)
+    assert sorted(first.dirs["a"].dirs["sub"].files) == ["f2"]
+    # once the watches are in place, a clean tree is answered without looking at it
+    hashd.connect(daemon.socket_path).get_manifest(root)
+    monkeypatch.setattr(
+        daemon.hash_db, "_make_manifest", lambda *args: pytest.fail("rescanned")
+    )
+    assert hashd.connect(daemon.socket_path).get_manifest(root) == first
+    monkeypatch.undo()
+
+    tmpdir.join("tree", "a/sub/f2").write("changed")
+    tmpdir.join("tree", "b/new").write("new")
+    second = hashd.connect(daemon.socket_path).get_manifest(root)
+    assert (
+        second.dirs["a"].dirs["sub"].files["f2"]
+        != first.dirs["a"].dirs["sub"].files["f2"]
+    )
+    assert sorted(second.dirs["b"].files) == ["f3", "new"]
+
+
+def test_connect_without_daemon(tmpdir):
+    assert hashd.connect(str(tmpdir.join("missing.sock"))) is None
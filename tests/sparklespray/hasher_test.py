@@ -0,0 +1,160 @@
+import hashlib
+import json
+import os
+
+from sparklespray.hasher import CachingHashFunction
+
+
+def test_hashes_are_cached_until_file_changes(tmpdir, monkeypatch):
+    import sparklespray.hasher
+
+    hashed = []
+    original = sparklespray.hasher.file_digests
+
+    def counting_file_digests(filename, algorithms):
+        hashed.append((filename, tuple(algorithms)))
+        return original(filename, algorithms)
+
+    monkeypatch.setattr(sparklespray.hasher, "file_digests", counting_file_digests)
+    db_path = str(tmpdir.join("cache"))
+    src = tmpdir.join("src")
+    src.write("hello")
+
+    cache = CachingHashFunction(db_path)
+    assert cache.get_sha256(str(src)) == hashlib.sha256(b"hello").hexdigest()
+    cache.persist()
+
+    # a second run reads the hash back without rehashing, and only computes the md5 once it's
+    # asked for
+    cache = CachingHashFunction(db_path)
+    assert cache.get_sha256(str(src)) == hashlib.sha256(b"hello").hexdigest()
+    assert cache.get_md5(str(src)) == hashlib.md5(b"hello").hexdigest()
+    assert cache.get_md5(str(src)) == hashlib.md5(b"hello").hexdigest()
+    assert hashed == [(str(src), ("sha256",)), (str(src), ("md5",))]
+
+    # changing the size is noticed even if the mtime is restored
+    st = os.stat(str(src))
+    src.write("hello world")
+    os.utime(str(src), ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert cache.get_sha256(str(src)) == hashlib.sha256(b"hello world").hexdigest()
+    assert len(hashed) == 3
+
+
+def test_file_digests_of_mapped_file(tmpdir):
+    from sparklespray.hasher import file_digests, MMAP_THRESHOLD
+
+    content = bytes(range(256)) * (MMAP_THRESHOLD // 100)
+    src = tmpdir.join("src")
+    src.write_binary(content)
+    assert file_digests(str(src), ("sha256", "md5")) == (
+        hashlib.sha256(content).hexdigest(),
+        hashlib.md5(content).hexdigest(),
+    )
+    src.write_binary(b"")
+    assert file_digests(str(src)) == (hashlib.sha256(b"").hexdigest(),)
+
+
+def test_old_json_cache_is_migrated(tmpdir, monkeypatch):
+    import sparklespray.hasher
+
+    hashed = []
+    original = sparklespray.hasher.file_digests
+
+    def counting_file_digests(filename, algorithms):
+        hashed.append(filename)
+        return original(filename, algorithms)
+
+    monkeypatch.setattr(sparklespray.hasher, "file_digests", counting_file_digests)
+    unchanged = tmpdir.join("unchanged")
+    unchanged.write("hello")
+    changed = tmpdir.join("changed")
+    changed.write("world")
+    db_path = tmpdir.join("cache")
+    db_path.write(
+        json.dumps(
+            {
+                # older versions trusted an entry as long as the mtime matched
+                str(unchanged): {
+                    "sha256": "cached-sha256",
+                    "md5": "cached-md5",
+                    "mtime": os.path.getmtime(str(unchanged)),
+                },
+                str(changed): {"sha256": "x", "md5": "y", "mtime": 1.0},
+                str(tmpdir.join("missing")): {"sha256": "x", "md5": "y", "mtime": 1.0},
+            }
+        )
+    )
+
+    cache = CachingHashFunction(str(db_path))
+    assert cache.get_hashes(str(unchanged)) == ("cached-sha256", "cached-md5")
+    assert cache.get_sha256(str(changed)) == hashlib.sha256(b"world").hexdigest()
+    assert hashed == [str(changed)]
+    cache.persist()
+
+    # the JSON file has been replaced by the db, which the next run reads
+    cache = CachingHashFunction(str(db_path))
+    assert cache.get_sha256(str(unchanged)) == "cached-sha256"
+
+
+def test_prefetch_fills_cache(tmpdir, monkeypatch):
+    import sparklespray.hasher
+
+    filenames = []
+    for i in range(5):
+        src = tmpdir.join("src{}".format(i))
+        src.write("content {}".format(i))
+        filenames.append(str(src))
+    cache = CachingHashFunction(str(tmpdir.join("cache")))
+    cache.prefetch(filenames, max_workers=3)
+
+    def fail(filename, algorithms):
+        raise AssertionError("{} was hashed again".format(filename))
+
+    monkeypatch.setattr(sparklespray.hasher, "file_digests", fail)
+    for i, filename in enumerate(filenames):
+        expected = hashlib.sha256("content {}".format(i).encode("utf8")).hexdigest()
+        assert cache.get_sha256(filename) == expected
+
+
+def test_manifest_only_changes_along_modified_path(tmpdir, monkeypatch):
+    import sparklespray.hasher
+
+    for name in ["a/b/f1", "a/b/f2", "a/g", "c/h"]:
+        tmpdir.join("tree", name).write(name, ensure=True)
+    root = str(tmpdir.join("tree"))
+    db_path = str(tmpdir.join("cache"))
+
+    cache = CachingHashFunction(db_path)
+    first = cache.get_manifest(root)
+    assert sorted(first.dirs) == ["a", "c"]
+    assert first.dirs["a"].dirs["b"].files["f1"] == (
+        hashlib.sha256(b"a/b/f1").hexdigest()
+    )
+    cache.persist()
+
+    hashed = []
+    original = sparklespray.hasher.file_digests
+
+    def counting_file_digests(filename, algorithms):
+        hashed.append(filename)
+        return original(filename, algorithms)
+
+    monkeypatch.setattr(sparklespray.hasher, "file_digests", counting_file_digests)
+    tmpdir.join("tree", "a/b/f2").write("modified in place")
+
+    cache = CachingHashFunction(db_path)
+    second = cache.get_manifest(root)
+    assert hashed == [str(tmpdir.join("tree", "a/b/f2"))]
+    assert second.digest != first.digest
+    assert second.dirs["a"].digest != first.dirs["a"].digest
+    assert second.dirs["c"].digest == first.dirs["c"].digest
+
+
+def test_manifest_records_executables(tmpdir):
+    tmpdir.join("tree", "run.sh").write("#!/bin/sh", ensure=True)
+    tmpdir.join("tree", "data").write("data")
+    os.chmod(str(tmpdir.join("tree", "run.sh")), 0o755)
+
+    cache = CachingHashFunction(str(tmpdir.join("cache")))
+    manifest = cache.get_manifest(str(tmpdir.join("tree")))
+    assert manifest.executables == frozenset(["run.sh"])
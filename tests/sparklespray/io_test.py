@@ -0,0 +1,431 @@
+import base64
+import hashlib
+import json
+import random
+import re
+from urllib.parse import urlparse, unquote, parse_qs
+
+import pytest
+from google.auth.credentials import AnonymousCredentials
+from requests.structures import CaseInsensitiveDict
+
+from sparklespray.io import IO, ChecksumMismatch
+
+
+class FakeRequest:
+    def __init__(self, method, url):
+        self.method = method
+        self.url = url
+
+
+class FakeResponse:
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.text = content.decode("utf8", "replace")
+        self.reason = ""
+        self.request = None
+
+    @property
+    def raw(self):
+        return self
+
+    def json(self):
+        return json.loads(self.content)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        yield self.content
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def close(self):
+        pass
+
+
+def _error(code):
+    return FakeResponse(
+        code,
+        json.dumps({"error": {"code": code, "message": "error"}}).encode("utf8"),
+        {"content-type": "application/json"},
+    )
+
+
+class FakeGCSSession:
+    "Minimal stand-in for the authorized session which serves objects out of a dict"
+
+    is_mtls = False
+
+    def __init__(self, objects):
+        self.objects = objects
+        self.requests = []
+
+    def object_request_count(self):
+        # newer storage clients also fetch bucket metadata in the background, so only count
+        # requests which touch objects
+        return len([url for _, url in self.requests if "/o/" in url])
+
+    def request(self, method, url, data=None, headers=None, timeout=None, **kwargs):
+        self.requests.append((method, url))
+        headers = CaseInsensitiveDict(headers or {})
+        if method == "POST":
+            response = self._respond_to_post(url, data, headers)
+        elif method == "DELETE":
+            response = self._respond_to_delete(url)
+        else:
+            response = self._respond(url, headers)
+        response.request = FakeRequest(method, url)
+        return response
+
+    def _metadata(self, bucket, name):
+        content = self.objects[name]
+        metadata = {
+            "name": name,
+            "bucket": bucket,
+            "size": str(len(content)),
+            "generation": "1",
+            "md5Hash": base64.b64encode(hashlib.md5(content).digest()).decode("utf8"),
+        }
+        return FakeResponse(
+            200,
+            json.dumps(metadata).encode("utf8"),
+            {"content-type": "application/json"},
+        )
+
+    def _respond_to_post(self, url, data, headers):
+        parsed = urlparse(url)
+        m = re.match("^/upload/storage/v1/b/([^/]+)/o$", parsed.path)
+        if m is not None:
+            # multipart upload: a JSON metadata part followed by the content
+            content_type = headers["content-type"]
+            if isinstance(content_type, str):
+                content_type = content_type.encode("utf8")
+            boundary = re.search(b'boundary="?([^";]+)', content_type).group(1)
+            parts = data.split(b"--" + boundary)
+            metadata = json.loads(parts[1].split(b"\r\n\r\n", 1)[1])
+            content = parts[2].split(b"\r\n\r\n", 1)[1][: -len(b"\r\n")]
+            self.objects[metadata["name"]] = content
+            return self._metadata(m.group(1), metadata["name"])
+        m = re.match("^/storage/v1/b/([^/]+)/o/(.+)/compose$", parsed.path)
+        if m is not None:
+            sources = json.loads(data)["sourceObjects"]
+            name = unquote(m.group(2))
+            self.objects[name] = b"".join(
+                self.objects[source["name"]] for source in sources
+            )
+            return self._metadata(m.group(1), name)
+        return _error(404)
+
+    def _respond_to_delete(self, url):
+        m = re.match("^/storage/v1/b/([^/]+)/o/(.+)$", urlparse(url).path)
+        if m is None or self.objects.pop(unquote(m.group(2)), None) is None:
+            return _error(404)
+        return FakeResponse(204)
+
+    def _respond(self, url, headers):
+        parsed = urlparse(url)
+        m = re.match("^(?:/download)?/storage/v1/b/([^/]+)/o/(.+)$", parsed.path)
+        if m is None:
+            return _error(404)
+        content = self.objects.get(unquote(m.group(2)))
+        if content is None:
+            return _error(404)
+        if parse_qs(parsed.query).get("alt") != ["media"]:
+            return self._metadata(m.group(1), unquote(m.group(2)))
+        if "range" not in headers:
+            return FakeResponse(200, content)
+        m = re.match("bytes=(\\d+)-(\\d*)", headers["range"])
+        start = int(m.group(1))
+        end = len(content) - 1
+        if m.group(2) != "":
+            end = min(int(m.group(2)), end)
+        if start >= len(content):
+            return _error(416)
+        return FakeResponse(
+            206,
+            content[start : end + 1],
+            {"content-range": "bytes {}-{}/{}".format(start, end, len(content))},
+        )
+
+    def close(self):
+        pass
+
+
+LARGE_CONTENT = bytes(range(256)) * 100
+
+
+@pytest.fixture
+def session():
+    return FakeGCSSession({"log.txt": b"hello world", "large": LARGE_CONTENT})
+
+
+@pytest.fixture
+def io(session):
+    io = IO("project", "gs://bucket/CAS", credentials=AnonymousCredentials())
+    io.gcs._http = io.gcs.request_counter.instrument(session)
+    yield io
+    io.close()
+
+
+def test_request_counter(io):
+    io.get_as_str("gs://bucket/log.txt")
+    io.exists("gs://bucket/log.txt")
+    assert io.gcs.request_counter.counts["GET"] >= 2
+    assert str(io.gcs.request_counter).startswith(
+        "{} requests".format(io.gcs.request_counter.total())
+    )
+
+
+def test_get_as_str_single_request(io, session):
+    assert io.get_as_str("gs://bucket/log.txt") == "hello world"
+    assert session.object_request_count() == 1
+
+
+def test_get_as_str_missing(io):
+    assert io.get_as_str("gs://bucket/missing.txt", must=False) is None
+
+    with pytest.raises(AssertionError):
+        io.get_as_str("gs://bucket/missing.txt")
+
+
+def test_get_as_str_from_offset(io, session):
+    assert io.get_as_str("gs://bucket/log.txt", start=6) == "world"
+    # reading from the end of the object returns no new data instead of failing
+    assert io.get_as_str("gs://bucket/log.txt", start=11) == ""
+    assert session.object_request_count() == 2
+
+
+def test_bulk_get(io, session):
+    result = io.bulk_get_as_str(["gs://bucket/log.txt", "gs://bucket/missing.txt"])
+    assert result == {
+        "gs://bucket/log.txt": b"hello world",
+        "gs://bucket/missing.txt": None,
+    }
+
+    session.requests.clear()
+    io.bulk_get_as_str(["gs://bucket/log.txt"] * 5)
+    assert session.object_request_count() == 5
+
+
+def test_get_missing_removes_file(io, tmpdir):
+    dst = str(tmpdir.join("out"))
+    io.get("gs://bucket/missing.txt", dst, must=False)
+    assert not tmpdir.join("out").exists()
+
+    io.get("gs://bucket/log.txt", dst)
+    assert tmpdir.join("out").read() == "hello world"
+
+
+def test_parallel_download(io, session, tmpdir):
+    io.gcs.parallel_download_threshold = 1000
+    io.gcs.parallel_download_parts = 7
+    dst = str(tmpdir.join("out"))
+
+    io.get("gs://bucket/large", dst)
+
+    with open(dst, "rb") as fd:
+        assert fd.read() == LARGE_CONTENT
+    # first range, metadata lookup and then each of the parts
+    assert session.object_request_count() == 1 + 1 + 7
+
+
+def test_parallel_download_detects_corruption(io, session, tmpdir):
+    io.gcs.parallel_download_threshold = 1000
+    session.objects["large"] = LARGE_CONTENT
+    original_respond = session._respond
+
+    def corrupt_respond(url, headers):
+        response = original_respond(url, headers)
+        if "range" in headers and headers["range"].startswith("bytes=1000-"):
+            response.content = b"x" * len(response.content)
+        return response
+
+    session._respond = corrupt_respond
+
+    with pytest.raises(ChecksumMismatch):
+        io.get("gs://bucket/large", str(tmpdir.join("out")))
+
+
+def test_download_exactly_threshold(io, session, tmpdir):
+    io.gcs.parallel_download_threshold = len(LARGE_CONTENT)
+    dst = str(tmpdir.join("out"))
+
+    io.get("gs://bucket/large", dst)
+
+    assert tmpdir.join("out").read_binary() == LARGE_CONTENT
+
+
+def test_put_in_parts(io, session, tmpdir):
+    io.gcs.parallel_upload_threshold = 1000
+    io.gcs.parallel_upload_parts = 7
+    src = tmpdir.join("src")
+    src.write_binary(LARGE_CONTENT)
+
+    io.put(str(src), "gs://bucket/uploaded")
+
+    assert session.objects["uploaded"] == LARGE_CONTENT
+    # the parts are removed once they've been composed
+    assert sorted(session.objects.keys()) == ["large", "log.txt", "uploaded"]
+
+
+def test_put_in_parts_reuses_uploaded_parts(io, session, tmpdir):
+    io.gcs.parallel_upload_threshold = 1000
+    io.gcs.parallel_upload_parts = 2
+    src = tmpdir.join("src")
+    src.write_binary(LARGE_CONTENT)
+    # pretend a previous attempt uploaded the first part before failing
+    half = len(LARGE_CONTENT) // 2
+    session.objects["uploaded.sparkles-part-1-of-2"] = LARGE_CONTENT[:half]
+
+    io.put(str(src), "gs://bucket/uploaded")
+
+    assert session.objects["uploaded"] == LARGE_CONTENT
+    uploads = [url for method, url in session.requests if "/upload/" in url]
+    assert len(uploads) == 1
+
+
+def test_known_cas_keys_skip_exists_check(io, session, tmpdir):
+    from sparklespray.cas_index import KnownCASKeys
+
+    index_path = str(tmpdir.join("known"))
+    io.known_cas_keys = KnownCASKeys(index_path)
+    session.objects["CAS/abc"] = b"abc"
+    urls = ["gs://bucket/CAS/abc", "gs://bucket/CAS/def"]
+
+    assert io.bulk_exists_check(urls) == {urls[0]: True, urls[1]: False}
+
+    # a second index on the same db answers for the key which was found without a request
+    io.known_cas_keys = KnownCASKeys(index_path)
+    before = session.object_request_count()
+    assert io.bulk_exists_check([urls[0]]) == {urls[0]: True}
+    assert session.object_request_count() == before
+
+    # if the object disappears it's forgotten once we find out
+    del session.objects["CAS/abc"]
+    assert io.get_as_str(urls[0], must=False) is None
+    assert urls[0] not in io.known_cas_keys
+
+
+def test_known_cas_keys_expire(tmpdir, monkeypatch):
+    from sparklespray import cas_index
+
+    index_path = str(tmpdir.join("known"))
+    first = cas_index.KnownCASKeys(index_path, max_age_days=1)
+    second = cas_index.KnownCASKeys(index_path, max_age_days=1)
+    # keys added by concurrent submissions are all kept
+    first.add("gs://bucket/CAS/a")
+    second.add("gs://bucket/CAS/b")
+    assert "gs://bucket/CAS/b" in first and "gs://bucket/CAS/a" in second
+
+    # entries older than the max age are checked again
+    now = cas_index.time.time()
+    monkeypatch.setattr(cas_index.time, "time", lambda: now + 2 * 24 * 60 * 60)
+    assert "gs://bucket/CAS/a" not in first
+    first.add("gs://bucket/CAS/a")
+    assert "gs://bucket/CAS/a" in second
+    first.close()
+    second.close()
+
+
+def test_write_to_cas_skips_existing_content(io, session, tmpdir):
+    src = tmpdir.join("src")
+    src.write_binary(b"content")
+    sha256 = hashlib.sha256(b"content").hexdigest()
+
+    url = io.write_file_to_cas(str(src))
+    assert url == "gs://bucket/CAS/" + sha256
+    assert session.objects["CAS/" + sha256] == b"content"
+
+    # identical content is only written once, whether it comes from a file or a string
+    assert io.write_file_to_cas(str(src)) == url
+    assert io.write_str_to_cas("content") == url
+    uploads = [url for method, url in session.requests if "/upload/" in url]
+    assert len(uploads) == 1
+
+    session.objects["CAS/" + hashlib.sha256(b"other").hexdigest()] = b"other"
+    io.write_str_to_cas("other")
+    uploads = [url for method, url in session.requests if "/upload/" in url]
+    assert len(uploads) == 1
+
+
+def test_local_storage(tmpdir):
+    root = "file://" + str(tmpdir)
+    io = IO("project", root + "/CAS")
+
+    src = tmpdir.join("src")
+    src.write_binary(b"hello world")
+    io.put(str(src), root + "/files/a")
+    io.put_str("text", root + "/files/sub/b")
+
+    assert io.exists(root + "/files/a")
+    assert not io.exists(root + "/files/missing")
+    assert io.get_as_str(root + "/files/a", start=6) == "world"
+    assert io.get_as_str(root + "/files/missing", must=False) is None
+    assert sorted(io.get_child_keys(root + "/files")) == [
+        root + "/files/a",
+        root + "/files/sub/b",
+    ]
+
+    dst = str(tmpdir.join("dst"))
+    io.get(root + "/files/a", dst)
+    assert open(dst, "rb").read() == b"hello world"
+
+    url = io.write_str_to_cas("cas content")
+    assert url.startswith(root + "/CAS/")
+    assert io.bulk_get_as_str([url]) == {url: b"cas content"}
+    io.close()
+
+
+def test_compressed_json_in_cas(io, session):
+    io.compression = "gzip"
+    obj = {"downloads": ["gs://bucket/CAS/abc"] * 10}
+
+    url = io.write_json_to_cas(obj)
+
+    assert (
+        url
+        == "gs://bucket/CAS/"
+        + hashlib.sha256(json.dumps(obj).encode("utf8")).hexdigest()
+    )
+    stored = session.objects[url[len("gs://bucket/") :]]
+    assert stored[:2] == b"\x1f\x8b"
+    # reads of CAS JSON detect the compression regardless of how they fetch the object
+    assert json.loads(io.get_as_str(url, decompress=True)) == obj
+    assert json.loads(io.bulk_get_as_str([url], decompress=True)[url]) == obj
+
+    # but other reads return objects as they are, even if they happen to be gzipped
+    session.objects["job/output.gz"] = stored
+    assert io.bulk_get_as_str(["gs://bucket/job/output.gz"]) == {
+        "gs://bucket/job/output.gz": stored
+    }
+
+
+def test_chunked_upload_only_sends_changed_chunks(io, session, tmpdir):
+    pytest.importorskip("numpy")
+    from sparklespray.chunking import ContentDefinedChunker
+
+    io.chunked_upload_threshold = 1000
+    io.chunker = ContentDefinedChunker(min_size=1024, avg_size=4096, max_size=16384)
+    content = random.Random(0).getrandbits(8 * 256000).to_bytes(256000, "big")
+    src = tmpdir.join("src")
+    src.write_binary(content)
+
+    url = io.write_file_to_cas(str(src))
+    assert session.objects[url[len("gs://bucket/") :]] == content
+    first_uploads = len([u for _, u in session.requests if "/upload/" in u])
+    # enough chunks that they had to be composed in more than one round
+    assert first_uploads > 32
+
+    # an edit in the middle of the file only changes the chunks around it
+    edited = content[:100000] + b"edit" + content[100000:]
+    src.write_binary(edited)
+    url = io.write_file_to_cas(str(src))
+    assert session.objects[url[len("gs://bucket/") :]] == edited
+    uploads = len([u for _, u in session.requests if "/upload/" in u])
+    assert uploads - first_uploads <= 3
+    # only the chunks and the composed files are left behind
+    assert not any(".sparkles-compose-" in name for name in session.objects)
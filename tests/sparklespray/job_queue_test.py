@@ -0,0 +1,83 @@
+import pytest
+from google.cloud import datastore
+
+from sparklespray.job_queue import JobQueue
+from sparklespray.job_store import JobStore
+from sparklespray.task_store import TaskStore
+
+
+class FakeDatastoreClient:
+    "Holds the entities written through put_multi in a dict keyed by (kind, name)"
+
+    def __init__(self):
+        self.entities = {}
+        self.put_count = 0
+
+    def key(self, kind, name):
+        return datastore.Key(kind, name, project="test")
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        self.put_count += len(entities)
+        for entity in entities:
+            self.entities[entity.key.flat_path] = entity
+
+    def delete_multi(self, keys):
+        for key in keys:
+            self.entities.pop(key.flat_path, None)
+
+
+def _submit(client, args, prepare=None):
+    jq = JobQueue(client, JobStore(client), TaskStore(client))
+    jq.submit("job", args, {}, {}, "cluster", 1, 2, prepare=prepare)
+
+
+def _args(count, fail_after=None):
+    for i in range(count):
+        if i == fail_after:
+            raise KeyboardInterrupt()
+        yield ("gs://bucket/CAS/spec", "gs://bucket/result{}".format(i), "log")
+
+
+def test_submit_writes_job_and_tasks():
+    client = FakeDatastoreClient()
+    job_status = []
+
+    def args():
+        # the job is written before its tasks, and is pending until they've all been written
+        job_status.append(client.entities[("Job", "job")]["status"])
+        yield from _args(700)
+
+    def prepare():
+        job_status.append(client.entities[("Job", "job")]["status"])
+        assert len([key for key in client.entities if key[0] == "Task"]) == 700
+
+    _submit(client, args(), prepare)
+    job = client.entities[("Job", "job")]
+    assert job_status == ["pending", "pending"]
+    assert job["status"] == "submitted"
+    assert job["tasks"] == ["job.{}".format(i + 1) for i in range(700)]
+    assert len([key for key in client.entities if key[0] == "Task"]) == 700
+
+
+def test_failed_submit_leaves_no_tasks_behind():
+    client = FakeDatastoreClient()
+    with pytest.raises(KeyboardInterrupt):
+        # by the time the generator fails, the job and the first two batches of tasks have
+        # been written
+        _submit(client, _args(700, fail_after=650))
+    assert client.put_count == 601
+    assert client.entities == {}
+
+
+def test_failed_prepare_leaves_nothing_behind():
+    client = FakeDatastoreClient()
+
+    def prepare():
+        raise Exception("upload failed")
+
+    with pytest.raises(Exception, match="upload failed"):
+        _submit(client, _args(10), prepare)
+    assert client.entities == {}
@@ -0,0 +1,106 @@
+import tempfile
+
+from sparklespray.hasher import hashes_from_file
+from sparklespray.pack import pack_small_files, add_pack_locations
+from sparklespray.spec import UploadMap
+
+
+def _sha256(filename):
+    return hashes_from_file(filename)[0]
+
+
+def test_pack_small_files(tmpdir):
+    upload_map = UploadMap()
+    contents = {}
+    for i in range(10):
+        filename = str(tmpdir.join("small{}".format(i)))
+        contents[filename] = "file {}".format(i).encode("utf8") * (i + 1)
+        with open(filename, "wb") as fd:
+            fd.write(contents[filename])
+        upload_map.add(_sha256, "gs://bucket/CAS", filename)
+    large = str(tmpdir.join("large"))
+    with open(large, "wb") as fd:
+        fd.write(b"x" * 2000)
+    upload_map.add(_sha256, "gs://bucket/CAS", large)
+
+    pack_dir = str(tmpdir.mkdir("packs"))
+    locations = pack_small_files(
+        upload_map,
+        "gs://bucket/CAS",
+        pack_dir,
+        max_file_size=1000,
+        target_size=50,
+        max_pack_size=100,
+    )
+
+    # the large file is still uploaded on its own, and the small ones as a few packs
+    uploads = upload_map.uploads()
+    assert large in [filename for filename, _, _ in uploads]
+    packs = [(filename, url) for filename, url, _ in uploads if filename != large]
+    assert 1 < len(packs) < 10
+    for filename, url in packs:
+        # packs are content addressed like any other CAS object
+        assert url == "gs://bucket/CAS/" + _sha256(filename)
+
+    pack_filenames = {url: filename for filename, url in packs}
+    for filename, content in contents.items():
+        location = locations["gs://bucket/CAS/" + _sha256(filename)]
+        with open(pack_filenames[location.pack_url], "rb") as fd:
+            fd.seek(location.offset)
+            assert fd.read(location.length) == content
+
+    small_url = "gs://bucket/CAS/" + _sha256(str(tmpdir.join("small0")))
+    downloads = [
+        {"src_url": "gs://bucket/CAS/" + _sha256(large), "dst": "large"},
+        {"src_url": small_url, "dst": "small0"},
+    ]
+    add_pack_locations(downloads, locations)
+    assert "pack_url" not in downloads[0]
+    assert downloads[1]["pack_url"] == locations[small_url].pack_url
+    assert downloads[1]["pack_offset"] == locations[small_url].offset
+    assert downloads[1]["pack_length"] == len(b"file 0")
+
+
+def _make_files(tmpdir, names):
+    upload_map = UploadMap()
+    for name in names:
+        filename = str(tmpdir.join(name))
+        with open(filename, "wt") as fd:
+            fd.write(name * 10)
+        upload_map.add(_sha256, "gs://bucket/CAS", filename)
+    return upload_map
+
+
+def _pack_urls(tmpdir, upload_map, **kwargs):
+    pack_dir = tempfile.mkdtemp(dir=str(tmpdir))
+    locations = pack_small_files(
+        upload_map, "gs://bucket/CAS", pack_dir, target_size=100, **kwargs
+    )
+    return set(location.pack_url for location in locations.values())
+
+
+def test_adding_a_file_only_changes_one_pack(tmpdir):
+    names = ["file{}".format(i) for i in range(200)]
+    before = _pack_urls(tmpdir, _make_files(tmpdir, names))
+    after = _pack_urls(tmpdir, _make_files(tmpdir, names + ["new file"]))
+    assert len(before) > 5
+    # the new file either joins a pack or starts one of its own, and no other pack changes
+    assert len(before - after) <= 1
+    assert len(after - before) == 1
+
+
+def test_files_already_in_cas_are_not_packed(tmpdir):
+    upload_map = _make_files(tmpdir, ["a", "b", "c"])
+    existing = upload_map.get_dst_url(str(tmpdir.join("a")))
+    checked = []
+
+    def exists_check(urls):
+        checked.extend(urls)
+        return {url: url == existing for url in urls}
+
+    packs = _pack_urls(tmpdir, upload_map, exists_check=exists_check)
+    assert len(checked) == 3
+    assert len(packs) > 0
+    # the existing file is left to be checked and skipped like any other upload
+    assert existing in [url for _, url, _ in upload_map.uploads()]
+    assert len(upload_map.uploads()) == 1 + len(packs)
@@ -0,0 +1,114 @@
+import json
+
+import pytest
+
+from sparklespray.csv_utils import iter_csv_as_dicts
+from sparklespray.params import read_parameter_batches
+from sparklespray.spec import ArgvTemplate, make_spec_from_command
+
+
+def test_jsonl_batches(tmpdir):
+    filename = tmpdir.join("params.jsonl")
+    rows = [dict(x="a", n=1), dict(x="b", n=2.5, flag=True), dict(x="c", n=None)]
+    filename.write("\n".join(json.dumps(row) for row in rows) + "\n\n")
+
+    batches = list(read_parameter_batches(str(filename), 2))
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert batches[0].columns == dict(x=["a", "b"], n=["1", "2.5"], flag=[None, "true"])
+    assert list(batches[1].rows()) == [dict(x="c")]
+
+    _, spec = make_spec_from_command(
+        ["echo", "{x}-{n}"],
+        docker_image="image",
+        dest_url="gs://bucket/dest",
+        cas_url="gs://bucket/cas",
+        parameter_batches=batches[:1],
+    )
+    assert [task["command"] for task in spec["tasks"]] == ["echo a-1", "echo b-2.5"]
+    assert spec["tasks"][1]["parameters"] == dict(x="b", n="2.5", flag="true")
+
+
+def test_jsonl_rows_without_columns(tmpdir):
+    filename = tmpdir.join("params.jsonl")
+    filename.write("{}\n{}\n")
+
+    (batch,) = read_parameter_batches(str(filename), 10)
+    assert len(batch) == 2
+    assert list(batch.rows()) == [{}, {}]
+
+    _, spec = make_spec_from_command(
+        ["echo", "hello"],
+        docker_image="image",
+        dest_url="gs://bucket/dest",
+        cas_url="gs://bucket/cas",
+        parameter_batches=[batch],
+    )
+    assert [task["command"] for task in spec["tasks"]] == ["echo hello"] * 2
+
+
+def test_expand_columns_reports_missing_values():
+    template = ArgvTemplate(["run", "{a}", "{b}"])
+    assert template.expand_columns(dict(a=["1", "2"], b=["x", "y"]), 2) == [
+        ["run", "1", "x"],
+        ["run", "2", "y"],
+    ]
+    with pytest.raises(
+        Exception, match="a \\(missing from 1 of 12 rows, first row 12\\)"
+    ):
+        template.expand_columns(dict(a=["1", None], b=["x", "y"]), 2, first_row=10)
+
+
+def test_parquet_batches(tmpdir):
+    pyarrow = pytest.importorskip("pyarrow")
+    import pyarrow.parquet
+
+    filename = str(tmpdir.join("params.parquet"))
+    table = pyarrow.table(dict(seed=[1, 2, 3], name=["a", None, "c"]))
+    pyarrow.parquet.write_table(table, filename)
+
+    batches = list(read_parameter_batches(filename, 2))
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert batches[0].columns == dict(seed=["1", "2"], name=["a", None])
+    assert list(batches[1].rows()) == [dict(seed="3", name="c")]
+
+
+def _expand_commands(filename):
+    kwargs = {}
+    if filename.endswith(".csv"):
+        kwargs["parameters"] = iter_csv_as_dicts(filename)
+    else:
+        kwargs["parameter_batches"] = read_parameter_batches(filename, 1000)
+    _, spec = make_spec_from_command(
+        ["echo", "{x}", "{n}", "{f}", "{flag}"],
+        docker_image="image",
+        dest_url="gs://bucket/dest",
+        cas_url="gs://bucket/cas",
+        **kwargs
+    )
+    return [task["command"] for task in spec["tasks"]]
+
+
+def test_formats_expand_identically(tmpdir):
+    # each column has one type, since columnar formats can't mix ints and floats
+    columns = dict(x=["a", "b"], n=[1, 2], f=[1.5, 3.0], flag=[True, False])
+    rows = [dict(zip(columns, values)) for values in zip(*columns.values())]
+    expected = ["echo a 1 1.5 true", "echo b 2 3.0 false"]
+
+    filenames = [str(tmpdir.join("params.csv")), str(tmpdir.join("params.jsonl"))]
+    tmpdir.join("params.csv").write("x,n,f,flag\na,1,1.5,true\nb,2,3.0,false\n")
+    tmpdir.join("params.jsonl").write("".join(json.dumps(row) + "\n" for row in rows))
+    try:
+        import pyarrow
+        import pyarrow.feather
+        import pyarrow.parquet
+    except ImportError:
+        pass
+    else:
+        table = pyarrow.table(columns)
+        filenames.append(str(tmpdir.join("params.parquet")))
+        pyarrow.parquet.write_table(table, filenames[-1])
+        filenames.append(str(tmpdir.join("params.arrow")))
+        pyarrow.feather.write_feather(table, filenames[-1])
+
+    for filename in filenames:
+        assert _expand_commands(filename) == expected, filename
@@ -1,3 +1,5 @@
+import pytest
+
 from sparklespray.spec import make_spec_from_command
 from sparklespray.submit import expand_tasks
 
@@ -173,3 +175,241 @@ def test_parameterized():
             },
         ],
     }
+
+
+def test_find_local_files(tmpdir):
+    from sparklespray.spec import find_local_files, SrcDstPair
+
+    tmpdir.join("dir/sub").ensure(dir=True)
+    for name in ["script.py", "dir/a", "dir/sub/b"]:
+        tmpdir.join(name).write(name)
+    script = str(tmpdir.join("script.py"))
+    directory = str(tmpdir.join("dir"))
+
+    files = find_local_files(
+        [["python", "^" + script, "x"], ["python", "^" + script, "y"]],
+        [SrcDstPair(directory, "dir"), SrcDstPair("gs://bucket/obj", "obj")],
+    )
+    assert files == {
+        script,
+        str(tmpdir.join("dir/a")),
+        str(tmpdir.join("dir/sub/b")),
+    }
+
+
+def test_pushed_dir_from_manifest(tmpdir):
+    from sparklespray.hasher import CachingHashFunction
+    from sparklespray.spec import SrcDstPair
+
+    for name in ["dir/a", "dir/sub/b"]:
+        tmpdir.join(name).write(name, ensure=True)
+    hash_db = CachingHashFunction(str(tmpdir.join("cache")))
+
+    def make_spec(**kwargs):
+        upload_map, spec = make_spec_from_command(
+            ["date"],
+            docker_image="image",
+            dest_url="gs://bucket/dest",
+            cas_url="gs://bucket/cas",
+            hash_function=hash_db.get_sha256,
+            is_executable_function=lambda fn: False,
+            extra_files=[SrcDstPair(str(tmpdir.join("dir")), "dir")],
+            **kwargs
+        )
+        return upload_map.uploads(), spec["common"]["downloads"]
+
+    uploads, downloads = make_spec()
+    manifest_uploads, manifest_downloads = make_spec(
+        manifest_function=hash_db.get_manifest
+    )
+    assert sorted(manifest_uploads) == sorted(uploads)
+    key = lambda d: d["dst"]
+    assert sorted(manifest_downloads, key=key) == sorted(downloads, key=key)
+    assert len(downloads) == 2
+
+
+def test_pushed_dir_is_listed_once(tmpdir, monkeypatch):
+    import os
+    import sparklespray.spec
+    from sparklespray.spec import SrcDstPair
+
+    for name in ["dir/run.sh", "dir/sub/b"]:
+        tmpdir.join(name).write(name, ensure=True)
+    os.chmod(str(tmpdir.join("dir/run.sh")), 0o755)
+
+    scanned = []
+    original = sparklespray.spec.scan_tree
+
+    def counting_scan_tree(root, *args, **kwargs):
+        scanned.append(root)
+        return original(root, *args, **kwargs)
+
+    monkeypatch.setattr(sparklespray.spec, "scan_tree", counting_scan_tree)
+    prefetched = []
+    _, spec = make_spec_from_command(
+        ["date"],
+        docker_image="image",
+        dest_url="gs://bucket/dest",
+        cas_url="gs://bucket/cas",
+        hash_function=dummy_hash,
+        prefetch_hashes=prefetched.extend,
+        is_executable_function=lambda fn: pytest.fail("checked " + fn),
+        extra_files=[SrcDstPair(str(tmpdir.join("dir")), "dir")],
+    )
+    assert scanned == [str(tmpdir.join("dir"))]
+    assert sorted(prefetched) == [
+        str(tmpdir.join("dir/run.sh")),
+        str(tmpdir.join("dir/sub/b")),
+    ]
+    executable = {d["dst"]: d["executable"] for d in spec["common"]["downloads"]}
+    assert executable == {"dir/run.sh": True, "dir/sub/b": False}
+
+
+def test_rewrite_argv_with_parameters():
+    import pytest
+    from sparklespray.spec import rewrite_argv_with_parameters
+
+    argv = ["python", "^{script}", "--range={start}-{end}", "{}", "plain"]
+    assert rewrite_argv_with_parameters(
+        argv,
+        [
+            dict(script="a.py", start="1", end="2"),
+            dict(script="b.py", start="3", end="4", unused="x"),
+        ],
+    ) == [
+        ["python", "^a.py", "--range=1-2", "{}", "plain"],
+        ["python", "^b.py", "--range=3-4", "{}", "plain"],
+    ]
+
+    with pytest.raises(
+        Exception, match="end \\(missing from 2 of 3 rows, first row 2\\)"
+    ):
+        rewrite_argv_with_parameters(
+            argv,
+            [
+                dict(script="a.py", start="1", end="2"),
+                dict(script="b.py", start="3"),
+                dict(script="c.py", start="5"),
+            ],
+        )
+
+
+def test_pushed_files_are_common_downloads():
+    from sparklespray.spec import SrcDstPair
+
+    upload_map, spec = make_spec_from_command(
+        ["python", "^{script}"],
+        docker_image="image",
+        dest_url="gs://bucket/dest",
+        cas_url="gs://bucket/cas",
+        parameters=[dict(script="a.py"), dict(script="b.py")],
+        hash_function=dummy_hash,
+        is_executable_function=lambda fn: False,
+        extra_files=[SrcDstPair("gs://bucket/data", "data")],
+    )
+    assert spec["common"]["downloads"] == [
+        dict(
+            src_url="gs://bucket/data",
+            dst="data",
+            executable=False,
+            is_cas_key=False,
+            symlink_safe=False,
+        )
+    ]
+    assert [task["downloads"][0]["dst"] for task in spec["tasks"]] == ["a.py", "b.py"]
+    assert [len(task["downloads"]) for task in spec["tasks"]] == [1, 1]
+
+    class FakeIO:
+        written = []
+
+        def write_json_to_cas(self, obj):
+            self.written.append(obj)
+            return "gs://bucket/cas/common"
+
+    tasks = expand_tasks(spec, FakeIO(), "gs://bucket", "gs://bucket/job")
+    assert len(FakeIO.written) == 1
+    assert FakeIO.written[0][0]["src_url"] == "gs://bucket/data"
+    assert [task["common_downloads_url"] for task in tasks] == [
+        "gs://bucket/cas/common"
+    ] * 2
+    assert [task["spec_version"] for task in tasks] == [2, 2]
+    assert [len(task["downloads"]) for task in tasks] == [1, 1]
+    # downloads which need no rewriting are shared with the spec rather than copied
+    assert tasks[0]["downloads"][0] is spec["tasks"][0]["downloads"][0]
+
+    # for workers which don't support common_downloads_url, they're written into every task
+    tasks = expand_tasks(
+        spec, FakeIO(), "gs://bucket", "gs://bucket/job", share_common_downloads=False
+    )
+    assert len(FakeIO.written) == 1
+    assert [[download["dst"] for download in task["downloads"]] for task in tasks] == [
+        ["data", "a.py"],
+        ["data", "b.py"],
+    ]
+    assert ["common_downloads_url" in task for task in tasks] == [False, False]
+    assert ["spec_version" in task for task in tasks] == [False, False]
+
+
+def test_task_spec_json_matches_merged_fields():
+    import json
+    from sparklespray.submit import SharedFields, TaskSpec
+
+    shared = SharedFields({"working_dir": ".", "command": "default", "stdout_url": "x"})
+    task = TaskSpec(shared, {"command": "echo {hi}", "downloads": []})
+    assert task["working_dir"] == "."
+    assert task["command"] == "echo {hi}"
+    assert json.loads(task.to_json()) == {
+        "working_dir": ".",
+        "command": "echo {hi}",
+        "stdout_url": "x",
+        "downloads": [],
+    }
+    assert json.loads(TaskSpec(shared, {}).to_json()) == shared.fields
+    assert json.loads(TaskSpec(SharedFields({}), {"a": 1}).to_json()) == {"a": 1}
+
+
+def test_streamed_tasks_read_parameters_lazily(tmpdir, monkeypatch):
+    import pytest
+    import sparklespray.spec
+
+    monkeypatch.setattr(sparklespray.spec, "TASK_BATCH_SIZE", 2)
+    for i in range(5):
+        tmpdir.join("in{}.txt".format(i)).write(str(i))
+    rows_read = []
+
+    def read_rows():
+        for i in range(5):
+            rows_read.append(i)
+            yield dict(input=str(tmpdir.join("in{}.txt".format(i))))
+
+    upload_map, spec = make_spec_from_command(
+        ["cat", "^{input}"],
+        docker_image="image",
+        dest_url="gs://bucket/dest",
+        cas_url="gs://bucket/cas",
+        parameters=read_rows(),
+        hash_function=dummy_hash,
+        is_executable_function=lambda fn: False,
+        stream_tasks=True,
+    )
+    assert rows_read == []
+    first = next(spec["tasks"])
+    assert first["uploads"]["dst_url"] == "gs://bucket/dest/1"
+    assert rows_read == [0, 1]
+    rest = list(spec["tasks"])
+    assert [task["uploads"]["dst_url"] for task in rest][-1] == "gs://bucket/dest/5"
+    assert len(upload_map.uploads()) == 5
+
+    # rows are numbered from the start of the parameters, not the start of the batch
+    _, spec = make_spec_from_command(
+        ["echo", "{x}"],
+        docker_image="image",
+        dest_url="gs://bucket/dest",
+        cas_url="gs://bucket/cas",
+        parameters=[dict(x="1"), dict(x="2"), dict(x="3"), dict()],
+        stream_tasks=True,
+    )
+    with pytest.raises(
+        Exception, match="x \\(missing from 1 of 4 rows, first row 4\\)"
+    ):
+        list(spec["tasks"])
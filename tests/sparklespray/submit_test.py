@@ -0,0 +1,44 @@
+import json
+
+from sparklespray.io import IO
+from sparklespray.spec import make_spec_from_command
+from sparklespray.submit import expand_files_to_upload, write_task_specs
+from sparklespray.util import compute_hash
+
+
+def test_write_task_specs_to_local_storage(tmpdir, monkeypatch):
+    root = "file://" + str(tmpdir.join("bucket"))
+    io = IO("project", root + "/CAS")
+    io.put_str("reference", root + "/inputs/ref.txt")
+
+    monkeypatch.chdir(tmpdir)
+    tmpdir.join("data.txt").write("data")
+    upload_map, spec = make_spec_from_command(
+        ["cat", "^data.txt", "ref.txt"],
+        "image",
+        dest_url=root + "/results/job",
+        cas_url=root + "/CAS",
+        parameters=[{"i": "1"}, {"i": "2"}],
+        hash_function=compute_hash,
+        extra_files=expand_files_to_upload(io, [root + "/inputs/ref.txt"]),
+    )
+    task_urls = list(write_task_specs(io, "job", spec, root + "/results"))
+    for filename, dst_url, _ in upload_map.uploads():
+        io.put(filename, dst_url)
+
+    assert len(task_urls) == 2
+    for i, (task_spec_url, command_result_url, log_url) in enumerate(task_urls):
+        assert task_spec_url.startswith(root + "/CAS/")
+        assert command_result_url.startswith(root + "/results/job/{}/".format(i + 1))
+        task_spec = json.loads(io.get_as_str(task_spec_url, decompress=True))
+        downloads = task_spec["downloads"]
+        if "common_downloads_url" in task_spec:
+            downloads = downloads + json.loads(
+                io.get_as_str(task_spec["common_downloads_url"], decompress=True)
+            )
+        contents = {
+            download["dst"]: io.get_as_str(download["src_url"])
+            for download in downloads
+        }
+        assert contents == {"data.txt": "data", "ref.txt": "reference"}
+    io.close()
@@ -0,0 +1,177 @@
+import os
+import json
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from sparklespray.compression import decompress_if_needed
+from sparklespray.upload import (
+    parallel_upload,
+    parallel_write_json_to_cas,
+    iter_write_json_to_cas,
+    UploadFailed,
+)
+
+
+class LocalStore:
+    "Stand-in for IO which writes gs://bucket/path urls into a local directory"
+
+    def __init__(self, root, failures_before_success=0, error=ConnectionError):
+        self.root = root
+        self.failures_before_success = failures_before_success
+        self.error = error
+        self.attempts = {}
+        self.content_encodings = {}
+        self.lock = threading.Lock()
+
+    def _get_filename(self, dst_url):
+        with self.lock:
+            attempt = self.attempts.get(dst_url, 0) + 1
+            self.attempts[dst_url] = attempt
+        if attempt <= self.failures_before_success:
+            raise self.error("simulated failure")
+        assert dst_url.startswith("gs://")
+        dst_filename = os.path.join(self.root, dst_url[len("gs://") :])
+        os.makedirs(os.path.dirname(dst_filename), exist_ok=True)
+        return dst_filename
+
+    def put(self, src_filename, dst_url):
+        shutil.copy(src_filename, self._get_filename(dst_url))
+
+    def put_str(self, text, dst_url, content_encoding=None):
+        with open(self._get_filename(dst_url), "wb") as fd:
+            fd.write(text)
+        self.content_encodings[dst_url] = content_encoding
+
+    def exists(self, dst_url):
+        return os.path.exists(os.path.join(self.root, dst_url[len("gs://") :]))
+
+
+def _make_files(tmpdir, count, size=100):
+    uploads = []
+    for i in range(count):
+        fn = str(tmpdir.join("file{}".format(i)))
+        with open(fn, "wb") as fd:
+            fd.write(bytes([i % 256]) * size)
+        uploads.append((fn, "gs://bucket/CAS/{}".format(i)))
+    return uploads
+
+
+@pytest.fixture
+def executor():
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        yield executor
+
+
+def test_parallel_upload(tmpdir, executor):
+    root = str(tmpdir.join("gcs"))
+    uploads = _make_files(tmpdir, 20)
+
+    progress_lines = []
+    parallel_upload(
+        uploads, LocalStore(root), executor, write_progress=progress_lines.append
+    )
+
+    for fn, dst_url in uploads:
+        with open(os.path.join(root, dst_url[len("gs://") :]), "rb") as fd:
+            assert fd.read() == open(fn, "rb").read()
+
+    assert progress_lines[-1].endswith("0 files remaining")
+
+
+def test_retries_transient_errors(tmpdir, executor):
+    root = str(tmpdir.join("gcs"))
+    uploads = _make_files(tmpdir, 3)
+    store = LocalStore(root, failures_before_success=2)
+
+    parallel_upload(uploads, store, executor, retry_delay=0)
+
+    assert set(store.attempts.values()) == {3}
+
+
+def test_does_not_retry_other_errors(tmpdir, executor):
+    root = str(tmpdir.join("gcs"))
+    uploads = _make_files(tmpdir, 3)
+    store = LocalStore(root, failures_before_success=1, error=ValueError)
+
+    with pytest.raises(UploadFailed):
+        parallel_upload(uploads, store, executor, retry_delay=0)
+
+    assert set(store.attempts.values()) == {1}
+
+
+def test_bandwidth_cap(tmpdir, executor):
+    root = str(tmpdir.join("gcs"))
+    uploads = _make_files(tmpdir, 4, size=10000)
+
+    start = time.monotonic()
+    parallel_upload(uploads, LocalStore(root), executor, max_bytes_per_sec=100000)
+    # 40000 bytes at 100000 bytes/sec. The first file starts immediately so we
+    # should take at least the time needed to send the other three
+    assert time.monotonic() - start >= 0.29
+
+
+def test_parallel_write_json_to_cas(tmpdir, executor):
+    root = str(tmpdir.join("gcs"))
+    store = LocalStore(root)
+    objs = [{"task": i % 5} for i in range(20)]
+
+    urls = parallel_write_json_to_cas(objs, "gs://bucket/CAS/", store, executor)
+
+    assert len(urls) == 20
+    # identical objects share a CAS key and are only written once
+    assert len(set(urls)) == 5
+    assert len(store.attempts) == 5
+    for obj, url in zip(objs, urls):
+        with open(os.path.join(root, url[len("gs://") :]), "rt") as fd:
+            assert json.load(fd) == obj
+
+    # objects already in CAS are not uploaded again
+    store.attempts = {}
+    assert parallel_write_json_to_cas(objs, "gs://bucket/CAS", store, executor) == urls
+    assert store.attempts == {}
+
+
+def test_iter_write_json_to_cas_yields_written_objects(tmpdir, executor):
+    root = str(tmpdir.join("gcs"))
+    store = LocalStore(root)
+    taken = []
+
+    def objs():
+        for i in range(200):
+            taken.append(i)
+            yield {"task": i}
+
+    for i, (obj, url) in enumerate(
+        iter_write_json_to_cas(objs(), "gs://bucket/CAS", store, executor)
+    ):
+        assert obj == {"task": i}
+        assert os.path.exists(os.path.join(root, url[len("gs://") :]))
+        # each url is available while later objects are still to be written
+        if i == 0:
+            assert len(taken) < 200
+
+
+def test_parallel_write_json_to_cas_compressed(tmpdir, executor):
+    root = str(tmpdir.join("gcs"))
+    store = LocalStore(root)
+    objs = [{"task": i, "downloads": ["gs://bucket/CAS/abc"] * 10} for i in range(3)]
+
+    urls = parallel_write_json_to_cas(
+        objs, "gs://bucket/CAS", store, executor, compression="gzip"
+    )
+
+    # keys don't depend on whether the content was compressed
+    uncompressed_urls = parallel_write_json_to_cas(
+        objs, "gs://bucket/uncompressed", store, executor
+    )
+    assert uncompressed_urls == [url.replace("CAS", "uncompressed") for url in urls]
+    for obj, url in zip(objs, urls):
+        with open(os.path.join(root, url[len("gs://") :]), "rb") as fd:
+            content = fd.read()
+        assert json.loads(decompress_if_needed(content)) == obj
+        assert len(content) < len(json.dumps(obj))
+        assert store.content_encodings[url] == "gzip"
@@ -0,0 +1,28 @@
+import os
+
+from sparklespray.walk import scan_tree
+
+
+def test_scan_tree(tmpdir):
+    for name in ["a/f1", "a/sub/f2", "b/f3", "top"]:
+        tmpdir.join("tree", name).write(name, ensure=True)
+    os.chmod(str(tmpdir.join("tree", "a/f1")), 0o755)
+    root = str(tmpdir.join("tree"))
+
+    listings = scan_tree(root, max_workers=3)
+    assert sorted(listings) == [
+        root,
+        os.path.join(root, "a"),
+        os.path.join(root, "a/sub"),
+        os.path.join(root, "b"),
+    ]
+    assert sorted(listings[root].dirs) == ["a", "b"]
+    f1 = listings[os.path.join(root, "a")].files["f1"]
+    assert f1.size == len("a/f1")
+    assert f1.executable == os.access(str(tmpdir.join("tree", "a/f1")), os.X_OK)
+    assert not listings[root].files["top"].executable
+
+    # pruned directories are named by their parent but not listed
+    listings = scan_tree(root, prune=lambda path: path.endswith("a"))
+    assert sorted(listings) == [root, os.path.join(root, "b")]
+    assert sorted(listings[root].dirs) == ["a", "b"]